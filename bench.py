@@ -0,0 +1,341 @@
+"""Офлайн-бенчмарки бота: python bench.py [--users 10000] [--broadcasts 2000] ...
+
+Обработчики bot.py работают против заглушки Bot API (без сети, с настраиваемой
+задержкой и долей ответов 429) на синтетическом клане во временной БД.
+Печатает p50/p95/p99 и пропускную способность для голосования, статистики,
+карточки рассылки, массовой рассылки и сверки статистики.
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+bot = None  # модуль bot импортируется после настройки окружения (DB_PATH, TOKEN)
+
+
+class FakeBotAPI(BaseRequest):
+    """Транспорт Bot API без сети: отвечает успехом через latency секунд.
+
+    rate429 — доля запросов, получающих 429 с retry_after секунд.
+    """
+
+    def __init__(self, latency=0.0, rate429=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.rate429 = rate429
+        self.retry_after = retry_after
+        self.calls = {}
+        self._message_ids = itertools.count(1000)
+        self._random = random.Random(seed)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 5
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate429 and self._random.random() < self.rate429:
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                'parameters': {'retry_after': self.retry_after},
+            }).encode()
+        chat_id = params.get('chat_id') or 0
+        if name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif name in ('sendMessage', 'editMessageText', 'sendDocument', 'editMessageReplyMarkup'):
+            result = {
+                'message_id': params.get('message_id') or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        elif name == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': params.get('user_id'), 'is_bot': False, 'first_name': 'U'}}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+# ---------- Синтетический клан ----------
+def seed_clan(users, broadcasts, votes_per_broadcast, admin_id, seed=0):
+    """Заполняет пустую БД; возвращает id рассылок от старых к новым."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    user_ids = range(1, users + 1)
+    broadcast_ids = [uuid.UUID(int=rng.getrandbits(128)).hex for _ in range(broadcasts)]
+    with bot.db.write() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            'INSERT INTO users (user_id, username, first_name, nickname, verified_at) VALUES (?, ?, ?, ?, ?)',
+            ((uid, f'user{uid}', f'User {uid}', f'nick{uid}', (now - timedelta(seconds=uid)).isoformat())
+             for uid in user_ids)
+        )
+        for i, bid in enumerate(broadcast_ids):
+            created_at = (now - timedelta(hours=broadcasts - i)).isoformat()
+            cur.execute(
+                'INSERT INTO broadcast_texts (broadcast_id, text, created_at, cooldown_minutes) VALUES (?, ?, ?, 0)',
+                (bid, f'Синтетическая рассылка №{i}', created_at)
+            )
+            cur.execute(
+                'INSERT INTO stats_messages (broadcast_id, admin_id, message_id, created_at) VALUES (?, ?, ?, ?)',
+                (bid, admin_id, 1, created_at)
+            )
+            voters = rng.sample(user_ids, min(votes_per_broadcast, users))
+            cur.executemany(
+                'INSERT INTO votes (user_id, broadcast_id, choice, voted_at) VALUES (?, ?, ?, ?)',
+                ((uid, bid, rng.choice(('going', 'not_going')), created_at) for uid in voters)
+            )
+            cur.executemany(
+                'INSERT INTO user_activity (user_id, broadcast_id, attended, marked_at) VALUES (?, ?, ?, ?)',
+                ((uid, bid, int(rng.random() < 0.7), created_at) for uid in voters[:len(voters) // 2])
+            )
+    bot.roster.load()
+    return broadcast_ids
+
+
+# ---------- Измерения ----------
+def report(name, samples, wall):
+    """Печатает перцентили (мс) и пропускную способность (операций в секунду)."""
+    samples = sorted(samples)
+    if len(samples) > 1:
+        cuts = statistics.quantiles(samples, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = samples[0] if samples else 0.0
+    print(f"{name:<24} n={len(samples):<6} p50 {p50 * 1e3:8.2f} ms  p95 {p95 * 1e3:8.2f} ms  "
+          f"p99 {p99 * 1e3:8.2f} ms  {len(samples) / wall if wall else 0:9.1f} ops/s")
+
+
+async def measure(name, calls):
+    """Выполняет корутины-фабрики из calls по очереди."""
+    samples = []
+    start = time.perf_counter()
+    for call in calls:
+        call_start = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - call_start)
+    report(name, samples, time.perf_counter() - start)
+
+
+class UpdateDriver:
+    """Пропускает апдейты через очередь приложения и его обработчик апдейтов, как в проде
+    (параллельность и очередь на пользователя — из UPDATE_CONCURRENCY бота).
+
+    Все апдейты замера ставятся в очередь разом, так что задержка апдейта — от
+    постановки в очередь до завершения последнего обработчика — включает ожидание
+    в очереди. Замыкающий TypeHandler стоит в группе после всех обработчиков бота.
+    """
+    GROUP = 1000
+
+    def __init__(self, app):
+        self.app = app
+        self._update_ids = itertools.count(1)
+        self._enqueued = {}
+        self._samples = []
+        self._done = None
+        app.add_handler(TypeHandler(Update, self._finished), group=self.GROUP)
+
+    async def _finished(self, update, context):
+        started = self._enqueued.pop(update.update_id, None)
+        if started is not None:
+            self._samples.append(time.perf_counter() - started)
+            if not self._enqueued:
+                self._done.set()
+
+    def callback_update(self, user_id, data):
+        return Update.de_json({
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': '1', 'chat_instance': 'bench', 'data': data,
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'U'},
+                'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': 'bench'},
+            },
+        }, self.app.bot)
+
+    async def run(self, name, updates):
+        self._samples = []
+        self._done = asyncio.Event()
+        start = time.perf_counter()
+        for update in updates:
+            self._enqueued[update.update_id] = time.perf_counter()
+            self.app.update_queue.put_nowait(update)
+        if self._enqueued:
+            await self._done.wait()
+        report(name, self._samples, time.perf_counter() - start)
+
+
+async def bench_votes(driver, broadcast_ids, users, count, rng):
+    hot = broadcast_ids[-5:]
+    updates = [
+        driver.callback_update(
+            rng.randint(1, users),
+            bot.pack_callback(rng.choice(('going', 'not_going')), rng.choice(hot)),
+        )
+        for _ in range(count)
+    ]
+    await driver.run('vote path', updates)
+
+
+async def bench_stats(broadcast_ids, count, rng):
+    def stats():
+        bid = rng.choice(broadcast_ids)
+        return lambda: bot.run_db(bot.get_formatted_stats, bid)
+
+    await measure('get_formatted_stats', [stats() for _ in range(count)])
+
+
+async def bench_detail(driver, broadcast_ids, count, rng):
+    admin_id = bot.ADMIN_IDS[0]
+    updates = [
+        driver.callback_update(admin_id, bot.pack_callback('broadcast_detail', rng.choice(broadcast_ids)))
+        for _ in range(count)
+    ]
+    await driver.run('show_broadcast_detail', updates)
+
+
+async def bench_fanout(app, broadcast_ids, users, recipients):
+    user_ids = list(range(1, min(recipients, users) + 1))
+    job_id = await bot.run_db(
+        bot.enqueue_delivery, broadcast_ids[-1], 'broadcast', 'bench fan-out', None, bot.ADMIN_IDS[0], user_ids
+    )
+    start = time.perf_counter()
+    result = await bot.drain_delivery_job(app.bot, job_id)
+    wall = time.perf_counter() - start
+    print(f"{'fan-out':<24} n={len(user_ids):<6} доставлено {result.delivered}, ошибок {result.failed}, "
+          f"{wall:.2f} s  {len(user_ids) / wall:9.1f} msg/s")
+
+
+async def bench_recalc(rounds):
+    await measure('recalc_all_stats', [lambda: bot.run_db(bot.recalc_all_stats) for _ in range(rounds)])
+
+
+def bench_router(rounds=200_000):
+    """Стоимость маршрутизации callback_data (без вызова обработчика)."""
+    bid = '5f0e6c2a9b3d4e1f8a7b6c5d4e3f2a1b'
+    samples = [
+        bot.pack_callback('going', bid), bot.pack_callback('refresh_stats', bid),
+        bot.pack_callback('admin_users', 3),
+        'going_1a2b3c4d', 'not_going_1a2b3c4d', 'refresh_stats_1a2b3c4d',
+        'mark_attendance_1a2b3c4d', 'admin_users_3', 'confirm_delete_all',
+        'my_broadcasts_page_2', 'admin_back', 'unknown_action_x', 'stale',
+    ]
+    resolve = bot.callbacks.resolve
+    timings = []
+    for data in samples:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            resolve(data)
+        timings.append((data, (time.perf_counter() - start) / rounds * 1e9))
+    print(f"router.resolve, {rounds} вызовов на ключ:")
+    for data, ns in timings:
+        print(f"  {data:<28} {ns:7.1f} ns")
+    print(f"  медиана {statistics.median(ns for _, ns in timings):.1f} ns")
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    bot.init_db()
+    broadcast_ids = seed_clan(args.users, args.broadcasts, args.votes_per_broadcast, bot.ADMIN_IDS[0], args.seed)
+    print(f"Клан: {args.users} пользователей, {args.broadcasts} рассылок, "
+          f"{args.broadcasts * min(args.votes_per_broadcast, args.users)} голосов "
+          f"(заполнение {time.perf_counter() - start:.1f} s)\n")
+
+    api = FakeBotAPI(args.latency, args.rate429, args.retry_after, args.seed)
+    app = bot.build_application(request=api)
+    # Фоновые задачи (напоминания, сверка) в замеры не входят
+    for job in app.job_queue.jobs():
+        job.schedule_removal()
+    driver = UpdateDriver(app)
+    print(f"Обработка апдейтов: до {app.update_processor.max_concurrent_updates} одновременно\n")
+    await app.initialize()
+    await bot.on_startup(app)
+    await app.start()
+    try:
+        await bench_votes(driver, broadcast_ids, args.users, args.votes, rng)
+        await bench_stats(broadcast_ids, args.stats, rng)
+        await bench_detail(driver, broadcast_ids, args.details, rng)
+        await bench_fanout(app, broadcast_ids, args.users, args.fanout)
+        await bench_recalc(args.recalc)
+    finally:
+        await app.stop()
+        await bot.on_stop(app)
+        await app.shutdown()
+        await bot.on_shutdown(app)
+    print(f"\nВызовы Bot API: {dict(sorted(api.calls.items()))}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--broadcasts', type=int, default=2_000)
+    parser.add_argument('--votes-per-broadcast', type=int, default=50)
+    parser.add_argument('--votes', type=int, default=2_000, help='голосов в замере голосования')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='UPDATE_CONCURRENCY на время замера (по умолчанию как в боте)')
+    parser.add_argument('--stats', type=int, default=500)
+    parser.add_argument('--details', type=int, default=200)
+    parser.add_argument('--fanout', type=int, default=2_000, help='получателей массовой рассылки')
+    parser.add_argument('--recalc', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа Bot API, с')
+    parser.add_argument('--rate429', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--fanout-rate', type=float, default=100_000,
+                        help='FANOUT_RATE на время замера (по умолчанию без лимита Telegram)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--router-only', action='store_true', help='только замер маршрутизации callback')
+    parser.add_argument('--keep-db', action='store_true', help='не удалять БД бенчмарка')
+    return parser.parse_args()
+
+
+def main():
+    global bot
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='clanbot-bench-')
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bench.db')
+    os.environ.setdefault('TOKEN', '0:bench')
+    os.environ['FANOUT_RATE'] = str(args.fanout_rate)
+    if args.concurrency is not None:
+        os.environ['UPDATE_CONCURRENCY'] = str(args.concurrency)
+    bot = importlib.import_module('bot')
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    try:
+        bench_router()
+        print()
+        if not args.router_only:
+            asyncio.run(run(args))
+    finally:
+        if args.keep_db:
+            print(f"\nБД бенчмарка: {os.environ['DB_PATH']}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
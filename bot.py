@@ -1,9 +1,27 @@
 import logging
+import logging.handlers
 import sqlite3
 import uuid
 import html
 import os
+import queue
+import threading
 import io
+import itertools
+import time
+import json
+import asyncio
+import atexit
+import base64
+import binascii
+import bisect
+import functools
+import hashlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 
 from telegram import Update, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
@@ -14,11 +32,15 @@ from telegram.ext import (
     filters,
     ContextTypes,
     CallbackQueryHandler,
+    ChatMemberHandler,
+    SimpleUpdateProcessor,
 )
-from telegram.error import BadRequest  # для обработки ошибок 400
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut  # для обработки ошибок 400 и 429
 
 # ========================== КОНСТАНТЫ И НАСТРОЙКИ ==========================
-if os.environ.get('RAILWAY_ENVIRONMENT') or os.path.exists('/railway'):
+if os.environ.get('DB_PATH'):
+    DB_PATH = os.environ['DB_PATH']
+elif os.environ.get('RAILWAY_ENVIRONMENT') or os.path.exists('/railway'):
     DB_PATH = '/data/clanbot.db'
     os.makedirs('/data', exist_ok=True)
 else:
@@ -31,10 +53,85 @@ if not TOKEN:
 CLAN_CHAT_ID = -1003378716036
 ADMIN_IDS = [906717241]
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# ---------- Логирование ----------
+# Обработчики только кладут запись в очередь; в stderr её пишет отдельный поток
+# (QueueListener), так что event loop не ждёт вывода. LOG_FORMAT=json — одна
+# JSON-запись на строку. Частые события помечаются extra={'sample': ключ} и
+# пропускаются не чаще LOG_SAMPLE_PER_SEC раз в секунду на ключ.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_SAMPLE_PER_SEC = int(os.environ.get('LOG_SAMPLE_PER_SEC', '5'))
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{text} (+{suppressed} похожих пропущено)" if suppressed else text
+
+class SamplingFilter(logging.Filter):
+    """Не больше per_second записей в секунду на ключ sample; число пропущенных
+    приписывается к следующей прошедшей записи (поле suppressed)."""
+
+    def __init__(self, per_second):
+        super().__init__()
+        self.per_second = per_second
+        self._lock = threading.Lock()
+        self._windows = {}  # ключ -> [секунда, прошло, пропущено]
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None or self.per_second <= 0:
+            return True
+        now = int(time.monotonic())
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = [now, 0, 0]
+            elif window[0] != now:
+                window[0], window[1] = now, 0
+            if window[1] >= self.per_second:
+                window[2] += 1
+                return False
+            window[1] += 1
+            if window[2]:
+                record.suppressed, window[2] = window[2], 0
+        return True
+
+def setup_logging():
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter(TEXT_LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_PER_SEC))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый запрос к Bot API
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # ========================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========================
@@ -47,131 +144,887 @@ def escape_markdown_v2(text):
         text = text.replace(char, '\\' + char)
     return text
 
+# ========================== МЕТРИКИ ==========================
+# Счётчики и гистограммы задержек обработчиков, задач и функций БД.
+# Снимок — командой /metrics; в формате Prometheus — на http://METRICS_HOST:METRICS_PORT/metrics
+# (по умолчанию сервер выключен).
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+
+class Histogram:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    __slots__ = ('buckets', 'count', 'sum')
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BUCKETS) + 1)  # последний — +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попадает квантиль q (None — выше последней)."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+class Metrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+
+    def inc(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, metric, seconds, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def histograms(self, metric):
+        """[(labels, count, sum, p95)] по метрике metric."""
+        with self._lock:
+            return [(dict(labels), h.count, h.sum, h.quantile(0.95))
+                    for (name, labels), h in self._histograms.items() if name == metric]
+
+    def counter(self, metric, **labels):
+        with self._lock:
+            return self._counters.get((metric, tuple(sorted(labels.items()))), 0)
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus."""
+        def fmt(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f'# TYPE {name} counter')
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{fmt(labels)} {value}')
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (metric, labels), h in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, n in zip((*Histogram.BUCKETS, '+Inf'), h.buckets):
+                        cumulative += n
+                        lines.append(f'{name}_bucket{fmt(labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_sum{fmt(labels)} {h.sum:.6f}')
+                    lines.append(f'{name}_count{fmt(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def timed(kind, name=None):
+    """Декоратор корутины: время и ошибки в clanbot_handler_seconds / clanbot_handler_errors_total."""
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                metrics.inc('clanbot_handler_errors_total', kind=kind, name=label)
+                raise
+            finally:
+                metrics.observe('clanbot_handler_seconds', time.perf_counter() - start, kind=kind, name=label)
+        return wrapper
+    return decorator
+
+def format_metrics_summary(limit=10):
+    """HTML-сводка для /metrics: самые затратные обработчики и функции БД."""
+    def table(rows, label):
+        rows = sorted(rows, key=lambda row: row[2], reverse=True)[:limit]
+        if not rows:
+            return "<i>нет данных</i>\n"
+        out = [f"{'имя':<26}{'n':>7}{'сред.':>9}{'p95≤':>8}"]
+        for labels, count, total, p95 in rows:
+            name = labels.get(label, '?')[:25]
+            p95_text = f"{p95 * 1000:.0f}" if p95 is not None else ">10с"
+            out.append(f"{name:<26}{count:>7}{total / count * 1000:>9.1f}{p95_text:>8}")
+        return "<pre>" + html.escape("\n".join(out)) + "</pre>\n"
+
+    uptime = int(time.monotonic() - metrics.started)
+    text = f"<b>📈 Метрики</b> (за {uptime // 3600}ч {uptime % 3600 // 60}м, время в мс)\n\n"
+    text += "<b>Обработчики и задачи</b>\n" + table(metrics.histograms('clanbot_handler_seconds'), 'name')
+    text += "\n<b>Функции БД</b>\n" + table(metrics.histograms('clanbot_db_seconds'), 'helper')
+    queue = metrics.histograms('clanbot_db_queue_seconds')
+    if queue:
+        _, count, total, p95 = queue[0]
+        p95_text = f"{p95 * 1000:.0f} мс" if p95 is not None else ">10 с"
+        text += f"\n⏳ Ожидание потока БД: сред. {total / count * 1000:.1f} мс, p95 ≤ {p95_text}\n"
+    unknown = metrics.counter('clanbot_callback_unknown_total')
+    if unknown:
+        text += f"❓ Неизвестных кнопок: {unknown}\n"
+    return text
+
+async def _serve_metrics(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b'/metrics':
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """Поднимает HTTP-эндпоинт метрик, если задан METRICS_PORT."""
+    if not METRICS_PORT:
+        return None
+    server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+    logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return server
+
 # ========================== РАБОТА С БАЗОЙ ДАННЫХ ==========================
-def get_connection():
-    return sqlite3.connect(DB_PATH)
+DB_READ_POOL_SIZE = int(os.environ.get('DB_READ_POOL_SIZE', '4'))
+DB_WORKERS = int(os.environ.get('DB_WORKERS', str(DB_READ_POOL_SIZE)))
+
+# Применяются к каждому соединению при открытии
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', int(os.environ.get('DB_CACHE_SIZE_KB', '-16000'))),
+    ('mmap_size', int(os.environ.get('DB_MMAP_SIZE', str(128 * 1024 * 1024)))),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 5000),
+)
+
+# ---------- Трассировка SQL ----------
+# Включается SQL_TRACE=1 или командой /sqltrace. Копит по каждому запросу число
+# вызовов, суммарное и максимальное время (execute + fetchall); запросы дольше
+# SQL_SLOW_MS пишутся в лог вместе с EXPLAIN QUERY PLAN.
+SQL_TRACE = os.environ.get('SQL_TRACE', '0') == '1'
+SQL_SLOW_MS = float(os.environ.get('SQL_SLOW_MS', '50'))
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+class SqlTracer:
+    def __init__(self, enabled=False, slow_ms=50.0):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._stats = {}  # sql -> [count, total, max]
+
+    def record(self, conn, sql, parameters, elapsed):
+        """Учитывает выполнение; возвращает метку для дозаписи времени fetchall."""
+        with self._lock:
+            entry = self._stats.get(sql)
+            if entry is None:
+                entry = self._stats[sql] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+        if elapsed * 1000 >= self.slow_ms:
+            self._log_slow(conn, sql, parameters, elapsed)
+        return conn, sql, parameters, elapsed
+
+    def record_fetch(self, mark, elapsed):
+        conn, sql, parameters, executed = mark
+        with self._lock:
+            entry = self._stats.get(sql)
+            if entry is not None:
+                entry[1] += elapsed
+                entry[2] = max(entry[2], executed + elapsed)
+        slow = self.slow_ms / 1000
+        if executed < slow <= executed + elapsed:
+            self._log_slow(conn, sql, parameters, executed + elapsed)
+
+    def _log_slow(self, conn, sql, parameters, elapsed):
+        statement = ' '.join(sql.split())
+        plan = ''
+        if statement.upper().startswith(EXPLAINABLE):
+            try:
+                # базовый курсор — сам EXPLAIN не трассируется
+                rows = sqlite3.Cursor(conn).execute(f'EXPLAIN QUERY PLAN {sql}', parameters or ()).fetchall()
+                plan = ''.join(f"\n    {detail}" for _, _, _, detail in rows)
+            except sqlite3.Error as e:
+                plan = f"\n    (план недоступен: {e})"
+        logger.warning("Медленный SQL %.1f мс: %s%s", elapsed * 1000, statement[:300], plan)
+
+    def top(self, limit=10):
+        """[(sql, count, total, max)] по убыванию суммарного времени."""
+        with self._lock:
+            rows = [(' '.join(sql.split()), *entry) for sql, entry in self._stats.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+sql_tracer = SqlTracer(SQL_TRACE, SQL_SLOW_MS)
+
+class TracingCursor(sqlite3.Cursor):
+    _trace_mark = None
+
+    def execute(self, sql, parameters=()):
+        if not sql_tracer.enabled:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        result = super().execute(sql, parameters)
+        self._trace_mark = sql_tracer.record(self.connection, sql, parameters, time.perf_counter() - start)
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        if not sql_tracer.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        # первый набор параметров нужен для EXPLAIN, если запрос окажется медленным
+        rows = iter(seq_of_parameters)
+        first = next(rows, None)
+        if first is not None:
+            rows = itertools.chain((first,), rows)
+        start = time.perf_counter()
+        result = super().executemany(sql, rows)
+        self._trace_mark = sql_tracer.record(self.connection, sql, first, time.perf_counter() - start)
+        return result
+
+    def fetchall(self):
+        mark, self._trace_mark = self._trace_mark, None
+        if mark is None:
+            return super().fetchall()
+        start = time.perf_counter()
+        rows = super().fetchall()
+        sql_tracer.record_fetch(mark, time.perf_counter() - start)
+        return rows
+
+class TracingConnection(sqlite3.Connection):
+    """Соединение, чьи курсоры (в том числе у conn.execute) проходят через sql_tracer."""
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ConnectionManager:
+    """Долгоживущие соединения с SQLite: одно пишущее и небольшой пул читающих.
+
+    Соединения открываются лениво и живут до close(). Все функции БД работают
+    через read()/write(), поэтому на каждый запрос не тратится connect/close.
+    """
+
+    def __init__(self, path, readers=DB_READ_POOL_SIZE):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._pool = queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._opened_readers = 0
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=TracingConnection)
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _acquire_reader(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._pool_lock:
+            if self._opened_readers < self.readers:
+                conn = self._open()
+                self._opened_readers += 1
+                return conn
+        return self._pool.get()
+
+    @contextmanager
+    def read(self):
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
+    @contextmanager
+    def write(self):
+        """Транзакция на пишущем соединении; вложенные вызовы входят во внешнюю транзакцию."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._open()
+            conn = self._writer
+            self._write_depth += 1
+            try:
+                yield conn
+                if self._write_depth == 1:
+                    conn.commit()
+            except BaseException:
+                if self._write_depth == 1:
+                    conn.rollback()
+                raise
+            finally:
+                self._write_depth -= 1
+
+    def close(self):
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._pool_lock:
+            while True:
+                try:
+                    self._pool.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._opened_readers = 0
+
+db = ConnectionManager(DB_PATH)
+
+# Все обращения к SQLite из async-кода идут через этот пул, чтобы не блокировать event loop
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='sqlite')
+
+def _timed_db_call(func, queued_at, args, kwargs):
+    start = time.perf_counter()
+    metrics.observe('clanbot_db_queue_seconds', start - queued_at)
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        metrics.inc('clanbot_db_errors_total', helper=func.__name__)
+        raise
+    finally:
+        metrics.observe('clanbot_db_seconds', time.perf_counter() - start, helper=func.__name__)
+
+async def run_db(func, *args, **kwargs):
+    """Awaitable-версия любой функции БД: выполняет её в потоке БД."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, _timed_db_call, func, time.perf_counter(), args, kwargs)
 
 def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
+    with db.write() as conn:
+        cur = conn.cursor()
 
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            nickname TEXT,
-            verified_at TEXT
-        )
-    ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                nickname TEXT,
+                verified_at TEXT
+            )
+        ''')
+        try:
+            cur.execute('ALTER TABLE users ADD COLUMN nickname TEXT')
+        except sqlite3.OperationalError:
+            pass
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS votes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                broadcast_id TEXT,
+                choice TEXT,
+                voted_at TEXT,
+                UNIQUE(user_id, broadcast_id)
+            )
+        ''')
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS stats_messages (
+                broadcast_id TEXT PRIMARY KEY,
+                admin_id INTEGER,
+                message_id INTEGER,
+                created_at TEXT
+            )
+        ''')
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_texts (
+                broadcast_id TEXT PRIMARY KEY,
+                text TEXT,
+                created_at TEXT
+            )
+        ''')
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS user_activity (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                broadcast_id TEXT,
+                attended INTEGER DEFAULT 0,
+                marked_at TEXT,
+                UNIQUE(user_id, broadcast_id)
+            )
+        ''')
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                total_events INTEGER DEFAULT 0,
+                attended_events INTEGER DEFAULT 0,
+                attendance_percent REAL DEFAULT 0,
+                last_active TEXT
+            )
+        ''')
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS user_nickname_changes (
+                user_id INTEGER PRIMARY KEY,
+                last_change TEXT
+            )
+        ''')
+
+        for col in [
+            ('cooldown_minutes', 'INTEGER DEFAULT 0'),
+            ('event_time', 'TEXT'),
+            ('reminder_sent', 'INTEGER DEFAULT 0'),
+            ('expired_notified', 'INTEGER DEFAULT 0')
+        ]:
+            try:
+                cur.execute(f'ALTER TABLE broadcast_texts ADD COLUMN {col[0]} {col[1]}')
+            except sqlite3.OperationalError:
+                pass
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS delivery_jobs (
+                job_id TEXT PRIMARY KEY,
+                broadcast_id TEXT,
+                kind TEXT,
+                text TEXT,
+                reply_markup TEXT,
+                admin_id INTEGER,
+                status TEXT DEFAULT 'pending',
+                created_at TEXT
+            )
+        ''')
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS delivery_queue (
+                job_id TEXT,
+                broadcast_id TEXT,
+                user_id INTEGER,
+                state TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                message_id INTEGER,
+                updated_at TEXT,
+                PRIMARY KEY (job_id, user_id)
+            )
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_delivery_queue_pending ON delivery_queue(job_id) WHERE state = 'pending'")
+
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_messages (
+                broadcast_id TEXT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                PRIMARY KEY (broadcast_id, user_id)
+            )
+        ''')
+
+        apply_migrations(conn)
+
+# ---------- Миграции схемы ----------
+# Версия схемы хранится в PRAGMA user_version; каждая миграция применяется один раз
+def _event_ts(event_time):
+    """Время события в секундах epoch (для индексируемых сравнений) или None."""
+    if not event_time:
+        return None
+    try:
+        return int(datetime.fromisoformat(event_time).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+def _migration_1_indexes(cur):
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_votes_broadcast_choice ON votes(broadcast_id, choice)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_activity_broadcast_attended ON user_activity(broadcast_id, attended)')
     try:
-        cur.execute('ALTER TABLE users ADD COLUMN nickname TEXT')
+        cur.execute('ALTER TABLE broadcast_texts ADD COLUMN event_ts INTEGER')
     except sqlite3.OperationalError:
         pass
-
+    cur.execute('SELECT broadcast_id, event_time FROM broadcast_texts WHERE event_time IS NOT NULL')
+    cur.executemany(
+        'UPDATE broadcast_texts SET event_ts = ? WHERE broadcast_id = ?',
+        [(_event_ts(event_time), bid) for bid, event_time in cur.fetchall()]
+    )
     cur.execute('''
-        CREATE TABLE IF NOT EXISTS votes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            broadcast_id TEXT,
-            choice TEXT,
-            voted_at TEXT,
-            UNIQUE(user_id, broadcast_id)
-        )
+        CREATE INDEX IF NOT EXISTS idx_broadcast_pending_reminder ON broadcast_texts(event_ts)
+        WHERE reminder_sent = 0 AND event_ts IS NOT NULL
     ''')
-
     cur.execute('''
-        CREATE TABLE IF NOT EXISTS stats_messages (
-            broadcast_id TEXT PRIMARY KEY,
-            admin_id INTEGER,
-            message_id INTEGER,
-            created_at TEXT
-        )
+        CREATE INDEX IF NOT EXISTS idx_broadcast_pending_expiry ON broadcast_texts(event_ts)
+        WHERE expired_notified = 0 AND event_ts IS NOT NULL
     ''')
 
+def _stats_upsert(user_id, d_total, d_attended, last_active):
+    """Тело триггера: прибавляет дельты к user_stats и пересчитывает процент."""
+    return f'''
+        INSERT INTO user_stats (user_id, total_events, attended_events, attendance_percent, last_active)
+        VALUES ({user_id}, MAX({d_total}, 0), MAX({d_attended}, 0),
+                CASE WHEN {d_total} > 0 THEN MAX({d_attended}, 0) * 100.0 / {d_total} ELSE 0 END,
+                {last_active})
+        ON CONFLICT(user_id) DO UPDATE SET
+            total_events = total_events + ({d_total}),
+            attended_events = attended_events + ({d_attended}),
+            attendance_percent = CASE WHEN total_events + ({d_total}) > 0
+                THEN (attended_events + ({d_attended})) * 100.0 / (total_events + ({d_total}))
+                ELSE 0 END,
+            last_active = COALESCE(excluded.last_active, last_active);
+    '''
+
+def _migration_2_stats_triggers(cur):
+    # Событие пользователя — рассылка, где у него есть голос или отметка (или оба)
+    no_activity = 'NOT EXISTS (SELECT 1 FROM user_activity a WHERE a.user_id = {0}.user_id AND a.broadcast_id = {0}.broadcast_id)'
+    no_vote = 'NOT EXISTS (SELECT 1 FROM votes v WHERE v.user_id = {0}.user_id AND v.broadcast_id = {0}.broadcast_id)'
+    triggers = {
+        'trg_votes_insert': ('AFTER INSERT ON votes',
+                             _stats_upsert('NEW.user_id', no_activity.format('NEW'), '0', 'NEW.voted_at')),
+        'trg_votes_update': ('AFTER UPDATE OF choice, voted_at ON votes',
+                             _stats_upsert('NEW.user_id', '0', '0', 'NEW.voted_at')),
+        'trg_votes_delete': ('AFTER DELETE ON votes',
+                             _stats_upsert('OLD.user_id', f"-({no_activity.format('OLD')})", '0', 'NULL')),
+        'trg_activity_insert': ('AFTER INSERT ON user_activity',
+                                _stats_upsert('NEW.user_id', no_vote.format('NEW'), 'NEW.attended', 'NEW.marked_at')),
+        'trg_activity_update': ('AFTER UPDATE OF attended, marked_at ON user_activity',
+                                _stats_upsert('NEW.user_id', '0', 'NEW.attended - OLD.attended', 'NEW.marked_at')),
+        'trg_activity_delete': ('AFTER DELETE ON user_activity',
+                                _stats_upsert('OLD.user_id', f"-({no_vote.format('OLD')})", '-OLD.attended', 'NULL')),
+    }
+    _create_triggers(cur, triggers)
+
+def _create_triggers(cur, triggers):
+    for name, (event, body) in triggers.items():
+        cur.execute(f'DROP TRIGGER IF EXISTS {name}')
+        cur.execute(f'CREATE TRIGGER {name} {event} BEGIN {body} END')
+
+def _migration_3_meta(cur):
     cur.execute('''
-        CREATE TABLE IF NOT EXISTS broadcast_texts (
-            broadcast_id TEXT PRIMARY KEY,
-            text TEXT,
-            created_at TEXT
+        CREATE TABLE IF NOT EXISTS bot_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
         )
     ''')
 
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS user_activity (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            broadcast_id TEXT,
-            attended INTEGER DEFAULT 0,
-            marked_at TEXT,
-            UNIQUE(user_id, broadcast_id)
-        )
+def _migration_4_page_keys(cur):
+    # ключи keyset-пагинации архива, «Моих рассылок» и списка пользователей
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_stats_messages_created ON stats_messages(created_at, broadcast_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_texts_created ON broadcast_texts(created_at, broadcast_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_users_verified ON users(verified_at, user_id)')
+
+# Счётчики голосов и отметок по рассылке; пересчитываются тем же запросом, что и в сверке
+BROADCAST_COUNTS_SQL = '''
+    SELECT b.broadcast_id,
+           (SELECT COUNT(*) FROM votes v WHERE v.broadcast_id = b.broadcast_id AND v.choice = 'going') AS going,
+           (SELECT COUNT(*) FROM votes v WHERE v.broadcast_id = b.broadcast_id AND v.choice = 'not_going') AS not_going,
+           (SELECT COALESCE(SUM(a.attended), 0) FROM user_activity a WHERE a.broadcast_id = b.broadcast_id) AS attended
+    FROM broadcast_texts b
+'''
+
+def _counts_update(broadcast_id, d_going, d_not_going, d_attended):
+    """Тело триггера: прибавляет дельты к счётчикам рассылки."""
+    return f'''
+        UPDATE broadcast_texts SET
+            going_count = going_count + ({d_going}),
+            not_going_count = not_going_count + ({d_not_going}),
+            attended_count = attended_count + ({d_attended})
+        WHERE broadcast_id = {broadcast_id};
+    '''
+
+def _migration_5_broadcast_counters(cur):
+    for column in ('going_count', 'not_going_count', 'attended_count'):
+        try:
+            cur.execute(f'ALTER TABLE broadcast_texts ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+        except sqlite3.OperationalError:
+            pass
+    is_going = "({0}.choice = 'going')"
+    is_not_going = "({0}.choice = 'not_going')"
+    _create_triggers(cur, {
+        'trg_votes_counts_insert': ('AFTER INSERT ON votes',
+                                    _counts_update('NEW.broadcast_id', is_going.format('NEW'), is_not_going.format('NEW'), '0')),
+        'trg_votes_counts_update': ('AFTER UPDATE OF choice, broadcast_id ON votes',
+                                    _counts_update('OLD.broadcast_id', f"-{is_going.format('OLD')}", f"-{is_not_going.format('OLD')}", '0')
+                                    + _counts_update('NEW.broadcast_id', is_going.format('NEW'), is_not_going.format('NEW'), '0')),
+        'trg_votes_counts_delete': ('AFTER DELETE ON votes',
+                                    _counts_update('OLD.broadcast_id', f"-{is_going.format('OLD')}", f"-{is_not_going.format('OLD')}", '0')),
+        'trg_activity_counts_insert': ('AFTER INSERT ON user_activity',
+                                       _counts_update('NEW.broadcast_id', '0', '0', 'NEW.attended')),
+        'trg_activity_counts_update': ('AFTER UPDATE OF attended, broadcast_id ON user_activity',
+                                       _counts_update('OLD.broadcast_id', '0', '0', '-OLD.attended')
+                                       + _counts_update('NEW.broadcast_id', '0', '0', 'NEW.attended')),
+        'trg_activity_counts_delete': ('AFTER DELETE ON user_activity',
+                                       _counts_update('OLD.broadcast_id', '0', '0', '-OLD.attended')),
+    })
+    cur.execute(f'''
+        UPDATE broadcast_texts SET going_count = c.going, not_going_count = c.not_going, attended_count = c.attended
+        FROM ({BROADCAST_COUNTS_SQL}) c
+        WHERE c.broadcast_id = broadcast_texts.broadcast_id
     ''')
 
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS user_stats (
-            user_id INTEGER PRIMARY KEY,
-            total_events INTEGER DEFAULT 0,
-            attended_events INTEGER DEFAULT 0,
-            attendance_percent REAL DEFAULT 0,
-            last_active TEXT
-        )
-    ''')
+MIGRATIONS = [
+    _migration_1_indexes,
+    _migration_2_stats_triggers,
+    _migration_3_meta,
+    _migration_4_page_keys,
+    _migration_5_broadcast_counters,
+]
 
+# Версия способа ведения user_stats; при её смене статистика сверяется заново
+STATS_VERSION = '2'
+
+def _set_meta(cur, key, value):
     cur.execute('''
-        CREATE TABLE IF NOT EXISTS user_nickname_changes (
-            user_id INTEGER PRIMARY KEY,
-            last_change TEXT
-        )
-    ''')
+        INSERT INTO bot_meta (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    ''', (key, str(value)))
 
-    for col in [
-        ('cooldown_minutes', 'INTEGER DEFAULT 0'),
-        ('event_time', 'TEXT'),
-        ('reminder_sent', 'INTEGER DEFAULT 0'),
-        ('expired_notified', 'INTEGER DEFAULT 0')
-    ]:
-        try:
-            cur.execute(f'ALTER TABLE broadcast_texts ADD COLUMN {col[0]} {col[1]}')
-        except sqlite3.OperationalError:
-            pass
+def get_meta(key):
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT value FROM bot_meta WHERE key = ?', (key,))
+        result = cur.fetchone()
+    return result[0] if result else None
+
+def stats_need_recalc():
+    return get_meta('stats_version') != STATS_VERSION
+
+def apply_migrations(conn):
+    cur = conn.cursor()
+    version = cur.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        migration(cur)
+        cur.execute(f'PRAGMA user_version = {number}')
+        logger.info("Применена миграция схемы %s: %s", number, migration.__name__)
+
+# ---------- Кэш пользователей и рассылок ----------
+# Состав клана и голоса/отметки по последним рассылкам держим в памяти, чтобы экраны
+# статистики не перечитывали всю таблицу users и все голоса на каждую отрисовку.
+# Кэш обновляется функциями записи после коммита; обновления идемпотентны.
+CACHE_MAX_BROADCASTS = int(os.environ.get('CACHE_MAX_BROADCASTS', '32'))
+
+class BroadcastTally:
+    def __init__(self):
+        self.votes = OrderedDict()  # user_id -> choice, в порядке voted_at
+        self.attended = {}          # user_id -> 0/1
+        self.counts = {'going': 0, 'not_going': 0}
+
+    def set_vote(self, user_id, choice):
+        previous = self.votes.pop(user_id, None)
+        if previous in self.counts:
+            self.counts[previous] -= 1
+        self.votes[user_id] = choice
+        if choice in self.counts:
+            self.counts[choice] += 1
+
+class Roster:
+    """Верифицированные пользователи — единственная копия таблицы users в памяти.
+
+    Хранит строки пользователей, компактный массив id для рассылок и проверку
+    членства. Словарь и массив при изменении заменяются целиком, поэтому выданные
+    наружу можно спокойно обходить. version растёт при каждом изменении (состав,
+    ник) — по нему зависимые кэши понимают, что пора пересчитаться.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = None  # user_id -> (username, first_name, nickname, verified_at)
+        self._ids = None
+        self.version = 0
+
+    def load(self):
+        with db.read() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT user_id, username, first_name, nickname, verified_at FROM users')
+            rows = {row[0]: row[1:] for row in cur.fetchall()}
+        with self._lock:
+            self._rows, self._ids = rows, array('q', rows)
+            self.version += 1
+
+    def _ensure(self):
+        if self._rows is None:
+            self.load()
+
+    def ids(self):
+        self._ensure()
+        return self._ids
+
+    def rows(self):
+        """(version, {user_id: (username, first_name, nickname, verified_at)}); словарь не менять."""
+        self._ensure()
+        with self._lock:
+            return self.version, self._rows
+
+    def __contains__(self, user_id):
+        self._ensure()
+        return user_id in self._rows
+
+    def __len__(self):
+        self._ensure()
+        return len(self._ids)
+
+    def added(self, user_id, username, first_name, nickname, verified_at):
+        with self._lock:
+            if self._rows is None or user_id in self._rows:
+                return
+            rows = dict(self._rows)
+            rows[user_id] = (username, first_name, nickname, verified_at)
+            ids = array('q', self._ids)
+            ids.append(user_id)
+            self._rows, self._ids = rows, ids
+            self.version += 1
+
+    def removed(self, user_id):
+        with self._lock:
+            if self._rows is None or user_id not in self._rows:
+                return
+            rows = dict(self._rows)
+            del rows[user_id]
+            self._rows, self._ids = rows, array('q', rows)
+            self.version += 1
+
+    def nickname_changed(self, user_id, nickname):
+        with self._lock:
+            if self._rows is None or user_id not in self._rows:
+                return
+            rows = dict(self._rows)
+            username, first_name, _, verified_at = rows[user_id]
+            rows[user_id] = (username, first_name, nickname, verified_at)
+            self._rows = rows
+            self.version += 1
+
+roster = Roster()
+
+class ClanCache:
+    def __init__(self, max_broadcasts):
+        self.max_broadcasts = max_broadcasts
+        self._lock = threading.RLock()
+        self._sorted = {}  # порядок -> (roster.version, список)
+        self._tallies = OrderedDict()
+
+    # --- пользователи (строки берутся из roster, здесь только отсортированные виды) ---
+    def users(self):
+        return roster.rows()[1]
+
+    def _ordered(self, order, key, reverse=False):
+        version, users = roster.rows()
+        with self._lock:
+            cached = self._sorted.get(order)
+            if cached is None or cached[0] != version:
+                ordered = sorted(users.items(), key=key, reverse=reverse)
+                cached = self._sorted[order] = (version, [(uid, u[0], u[1], u[2]) for uid, u in ordered])
+            return cached[1]
+
+    def users_by_recent(self):
+        """[(user_id, username, first_name, nickname)] по убыванию даты верификации."""
+        return self._ordered('recent', lambda item: item[1][3] or '', reverse=True)
+
+    def users_by_nickname(self):
+        """[(user_id, username, first_name, nickname)] по нику (без ника — первыми, как в SQLite)."""
+        return self._ordered('nickname', lambda item: (item[1][2] is not None, item[1][2] or ''))
+
+    # --- рассылки ---
+    def _tally(self, broadcast_id):
+        with self._lock:
+            tally = self._tallies.get(broadcast_id)
+            if tally is not None:
+                self._tallies.move_to_end(broadcast_id)
+                return tally
+            tally = BroadcastTally()
+            with db.read() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT user_id, choice FROM votes WHERE broadcast_id = ? ORDER BY voted_at', (broadcast_id,))
+                for uid, choice in cur.fetchall():
+                    tally.set_vote(uid, choice)
+                cur.execute('SELECT user_id, attended FROM user_activity WHERE broadcast_id = ?', (broadcast_id,))
+                tally.attended = dict(cur.fetchall())
+            self._tallies[broadcast_id] = tally
+            while len(self._tallies) > self.max_broadcasts:
+                self._tallies.popitem(last=False)
+            return tally
+
+    def snapshot(self, broadcast_id):
+        """Копия голосов [(user_id, choice)] в порядке голосования, отметок и счётчиков."""
+        with self._lock:
+            tally = self._tally(broadcast_id)
+            return list(tally.votes.items()), dict(tally.attended), dict(tally.counts)
+
+    def vote_written(self, broadcast_id, user_id, choice):
+        with self._lock:
+            tally = self._tallies.get(broadcast_id)
+            if tally is not None:
+                tally.set_vote(user_id, choice)
+
+    def attendance_written(self, broadcast_id, user_id, attended):
+        with self._lock:
+            tally = self._tallies.get(broadcast_id)
+            if tally is not None:
+                tally.attended[user_id] = 1 if attended else 0
+
+    def drop(self, broadcast_id=None):
+        with self._lock:
+            if broadcast_id is None:
+                self._tallies.clear()
+            else:
+                self._tallies.pop(broadcast_id, None)
+
+clan_cache = ClanCache(CACHE_MAX_BROADCASTS)
 
-    conn.commit()
-    conn.close()
 
 # ---------- Функции для работы с пользователями ----------
 def get_user_nickname(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT nickname FROM users WHERE user_id = ?', (user_id,))
-    result = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT nickname FROM users WHERE user_id = ?', (user_id,))
+        result = cur.fetchone()
     return result[0] if result else None
 
 def update_user_nickname(user_id, new_nickname):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('UPDATE users SET nickname = ? WHERE user_id = ?', (new_nickname, user_id))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        conn.execute('UPDATE users SET nickname = ? WHERE user_id = ?', (new_nickname, user_id))
+    roster.nickname_changed(user_id, new_nickname)
 
 def get_last_nickname_change(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT last_change FROM user_nickname_changes WHERE user_id = ?', (user_id,))
-    result = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT last_change FROM user_nickname_changes WHERE user_id = ?', (user_id,))
+        result = cur.fetchone()
     return result[0] if result else None
 
 def set_last_nickname_change(user_id, timestamp):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT OR REPLACE INTO user_nickname_changes (user_id, last_change)
-        VALUES (?, ?)
-    ''', (user_id, timestamp))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO user_nickname_changes (user_id, last_change)
+            VALUES (?, ?)
+        ''', (user_id, timestamp))
 
 def can_change_nickname(user_id):
     last = get_last_nickname_change(user_id)
@@ -190,185 +1043,152 @@ def can_change_nickname(user_id):
         return True, 0
 
 def get_user_attended_count(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT attended_events FROM user_stats WHERE user_id = ?', (user_id,))
-    result = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT attended_events FROM user_stats WHERE user_id = ?', (user_id,))
+        result = cur.fetchone()
     return result[0] if result else 0
 
-def get_user_broadcasts(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT DISTINCT v.broadcast_id
-        FROM votes v
-        WHERE v.user_id = ?
-        UNION
-        SELECT DISTINCT ua.broadcast_id
-        FROM user_activity ua
-        WHERE ua.user_id = ?
-        ORDER BY broadcast_id DESC
-    ''', (user_id, user_id))
-    rows = cur.fetchall()
-    conn.close()
-    return [row[0] for row in rows]
-
 def get_broadcast_info(broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT text, created_at, event_time FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
-    row = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT text, created_at, event_time, going_count, not_going_count, attended_count
+            FROM broadcast_texts WHERE broadcast_id = ?
+        ''', (broadcast_id,))
+        row = cur.fetchone()
     if row:
-        return {'text': row[0], 'created_at': row[1], 'event_time': row[2]}
+        return {'text': row[0], 'created_at': row[1], 'event_time': row[2],
+                'going': row[3], 'not_going': row[4], 'attended': row[5]}
     return None
 
 def get_user_choice_and_attendance(user_id, broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT choice FROM votes WHERE user_id = ? AND broadcast_id = ?', (user_id, broadcast_id))
-    vote = cur.fetchone()
-    choice = vote[0] if vote else None
-    cur.execute('SELECT attended FROM user_activity WHERE user_id = ? AND broadcast_id = ?', (user_id, broadcast_id))
-    att = cur.fetchone()
-    attended = att[0] if att else 0
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT choice FROM votes WHERE user_id = ? AND broadcast_id = ?', (user_id, broadcast_id))
+        vote = cur.fetchone()
+        choice = vote[0] if vote else None
+        cur.execute('SELECT attended FROM user_activity WHERE user_id = ? AND broadcast_id = ?', (user_id, broadcast_id))
+        att = cur.fetchone()
+        attended = att[0] if att else 0
     return choice, attended
 
 # ---------- Остальные функции базы данных ----------
-def save_vote(user_id, broadcast_id, choice):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT OR REPLACE INTO votes (user_id, broadcast_id, choice, voted_at)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, broadcast_id, choice, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-    # Пересчитываем статистику пользователя, так как изменилось общее количество событий
-    _update_user_stats(user_id)
-
 def save_broadcast_text(broadcast_id, text):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT OR REPLACE INTO broadcast_texts (broadcast_id, text, created_at)
-        VALUES (?, ?, ?)
-    ''', (broadcast_id, text, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-    logger.info(f"Текст рассылки {broadcast_id} сохранён в БД: {text}")
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT OR REPLACE INTO broadcast_texts (broadcast_id, text, created_at)
+            VALUES (?, ?, ?)
+        ''', (broadcast_id, text, datetime.now().isoformat()))
+    logger.info("Текст рассылки %s сохранён в БД (%d симв.)", broadcast_id, len(text))
 
 def get_broadcast_text(broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT text FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
-    result = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT text FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
+        result = cur.fetchone()
     return result[0] if result else None
 
-def update_user_attendance(user_id, broadcast_id, attended):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT OR REPLACE INTO user_activity (user_id, broadcast_id, attended, marked_at)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, broadcast_id, 1 if attended else 0, datetime.now().isoformat()))
-    conn.commit()
-    _update_user_stats(user_id)
-    conn.close()
-
-def _update_user_stats(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT DISTINCT broadcast_id FROM (
-            SELECT broadcast_id FROM votes WHERE user_id = ?
-            UNION
-            SELECT broadcast_id FROM user_activity WHERE user_id = ?
-        )
-    ''', (user_id, user_id))
-    total_events = len(cur.fetchall())
-    cur.execute('SELECT COUNT(*) FROM user_activity WHERE user_id = ? AND attended = 1', (user_id,))
-    attended_events = cur.fetchone()[0] or 0
-    attendance_percent = (attended_events / total_events * 100) if total_events > 0 else 0
-
-    cur.execute('''
-        INSERT OR REPLACE INTO user_stats (user_id, total_events, attended_events, attendance_percent, last_active)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, total_events, attended_events, attendance_percent, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+def set_attendance_bulk(broadcast_id, marks):
+    """Отмечает присутствие пачкой [(user_id, attended)] одной транзакцией.
+
+    user_stats обновляют триггеры в той же транзакции.
+    """
+    marks = [(user_id, 1 if attended else 0) for user_id, attended in marks]
+    marked_at = datetime.now().isoformat()
+    with db.write() as conn:
+        conn.executemany('''
+            INSERT INTO user_activity (user_id, broadcast_id, attended, marked_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, broadcast_id) DO UPDATE SET attended = excluded.attended, marked_at = excluded.marked_at
+        ''', [(user_id, broadcast_id, attended, marked_at) for user_id, attended in marks])
+    for user_id, attended in marks:
+        clan_cache.attendance_written(broadcast_id, user_id, attended)
+    return len(marks)
 
 def recalc_all_stats():
-    logger.info("Начинаю пересчёт статистики...")
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT DISTINCT user_id FROM (
-            SELECT user_id FROM votes
-            UNION
-            SELECT user_id FROM user_activity
-        )
-    ''')
-    users = cur.fetchall()
-    conn.close()
-    for (uid,) in users:
-        _update_user_stats(uid)
-    logger.info(f"Статистика пересчитана для {len(users)} пользователей")
-    return len(users)
-
-def get_user_vote(user_id, broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT choice FROM votes WHERE user_id = ? AND broadcast_id = ?', (user_id, broadcast_id))
-    result = cur.fetchone()
-    conn.close()
-    return result[0] if result else None
+    """Сверяет user_stats с голосами и отметками и исправляет расхождения.
 
-def get_vote_stats(broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT choice, COUNT(*) FROM votes WHERE broadcast_id = ? GROUP BY choice', (broadcast_id,))
-    results = cur.fetchall()
-    conn.close()
-    stats = {'going': 0, 'not_going': 0}
-    for choice, count in results:
-        if choice == 'going':
-            stats['going'] = count
-        elif choice == 'not_going':
-            stats['not_going'] = count
-    return stats
+    В обычной работе статистику ведут триггеры; это инструмент проверки и починки.
+    Пересчёт идёт одним запросом в одной транзакции. Возвращает число исправленных записей.
+    """
+    logger.info("Начинаю сверку статистики...")
+    with db.write() as conn:
+        cur = conn.cursor()
+        # rowcount у запросов с WITH не заполняется, поэтому считаем по total_changes
+        changes_before = conn.total_changes
+        cur.execute('''
+            WITH events AS (
+                SELECT user_id, broadcast_id, MAX(ts) AS ts FROM (
+                    SELECT user_id, broadcast_id, voted_at AS ts FROM votes
+                    UNION ALL
+                    SELECT user_id, broadcast_id, marked_at AS ts FROM user_activity
+                )
+                GROUP BY user_id, broadcast_id
+            ),
+            expected AS (
+                SELECT e.user_id,
+                       COUNT(*) AS total_events,
+                       COALESCE(SUM(a.attended), 0) AS attended_events,
+                       MAX(e.ts) AS last_active
+                FROM events e
+                LEFT JOIN user_activity a ON a.user_id = e.user_id AND a.broadcast_id = e.broadcast_id
+                GROUP BY e.user_id
+            )
+            INSERT INTO user_stats (user_id, total_events, attended_events, attendance_percent, last_active)
+            SELECT user_id, total_events, attended_events, attended_events * 100.0 / total_events, last_active
+            FROM expected WHERE true
+            ON CONFLICT(user_id) DO UPDATE SET
+                total_events = excluded.total_events,
+                attended_events = excluded.attended_events,
+                attendance_percent = excluded.attendance_percent,
+                last_active = COALESCE(user_stats.last_active, excluded.last_active)
+            WHERE user_stats.total_events IS NOT excluded.total_events
+               OR user_stats.attended_events IS NOT excluded.attended_events
+               OR ABS(COALESCE(user_stats.attendance_percent, 0) - excluded.attendance_percent) > 1e-9
+        ''')
+        # Пользователи, у которых не осталось ни голосов, ни отметок
+        cur.execute('''
+            UPDATE user_stats SET total_events = 0, attended_events = 0, attendance_percent = 0
+            WHERE (total_events != 0 OR attended_events != 0)
+            AND user_id NOT IN (SELECT user_id FROM votes UNION SELECT user_id FROM user_activity)
+        ''')
+        # Счётчики голосов и отметок рассылок
+        cur.execute(f'''
+            UPDATE broadcast_texts SET going_count = c.going, not_going_count = c.not_going, attended_count = c.attended
+            FROM ({BROADCAST_COUNTS_SQL}) c
+            WHERE c.broadcast_id = broadcast_texts.broadcast_id
+              AND (going_count != c.going OR not_going_count != c.not_going OR attended_count != c.attended)
+        ''')
+        fixed = conn.total_changes - changes_before
+        _set_meta(cur, 'stats_version', STATS_VERSION)
+    if fixed:
+        logger.warning("Исправлено записей статистики: %s", fixed)
+    else:
+        logger.info("Статистика сверена, расхождений нет")
+    return fixed
 
 def get_formatted_stats(broadcast_id):
     """Возвращает HTML-текст статистики (parse_mode='HTML')."""
-    conn = get_connection()
-    cur = conn.cursor()
+    with db.read() as conn:
+        cur = conn.cursor()
 
-    cur.execute('SELECT cooldown_minutes, event_time FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
-    binfo = cur.fetchone()
-    cooldown = binfo[0] if binfo else 0
-    event_time = binfo[1] if binfo else None
+        cur.execute('SELECT cooldown_minutes, event_time FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
+        binfo = cur.fetchone()
+        cooldown = binfo[0] if binfo else 0
+        event_time = binfo[1] if binfo else None
 
-    cur.execute('''
-        SELECT v.user_id, v.choice, u.username, u.first_name, u.nickname
-        FROM votes v
-        LEFT JOIN users u ON v.user_id = u.user_id
-        WHERE v.broadcast_id = ?
-        ORDER BY v.voted_at DESC
-    ''', (broadcast_id,))
-    votes = cur.fetchall()
-
-    cur.execute('SELECT user_id, username, first_name, nickname FROM users ORDER BY verified_at DESC')
-    all_users = cur.fetchall()
-    conn.close()
+    votes, _, _ = clan_cache.snapshot(broadcast_id)
+    users = clan_cache.users()
 
     voted_user_ids = set()
     going_list = []
     not_going_list = []
 
-    for uid, choice, username, first_name, nickname in votes:
+    # Свежие голоса — сверху
+    for uid, choice in reversed(votes):
+        username, first_name, nickname, _ = users.get(uid, (None, None, None, None))
         voted_user_ids.add(uid)
         display_name = nickname or first_name or "Unknown"
         safe_name = html.escape(display_name)
@@ -379,14 +1199,8 @@ def get_formatted_stats(broadcast_id):
         else:
             not_going_list.append(display)
 
-    ignored_list = []
-    for uid, username, first_name, nickname in all_users:
-        if uid not in voted_user_ids:
-            display_name = nickname or first_name or "Unknown"
-            safe_name = html.escape(display_name)
-            safe_username = html.escape(username) if username else ""
-            display = f"👤 {safe_name}" + (f" (@{safe_username})" if safe_username else "")
-            ignored_list.append(display)
+    # Голоса вышедших из клана не уменьшают число игнорирующих
+    voted_in_clan = sum(1 for uid in voted_user_ids if uid in users)
 
     safe_bid = html.escape(broadcast_id)
     text = f"<b>📊 Статистика голосования</b>\n"
@@ -415,12 +1229,11 @@ def get_formatted_stats(broadcast_id):
     else:
         text += "— пока никого —\n"
 
-    total_users = len(all_users)
-    voted_count = len(voted_user_ids)
-    ignored_count = total_users - voted_count
+    total_users = len(users)
+    ignored_count = total_users - voted_in_clan
 
     text += f"\n⚠️ Проигнорировали: {ignored_count} из {total_users}\n"
-    if ignored_list:
+    if ignored_count:
         text += "Список слишком длинный, используйте /ignored ID_рассылки для просмотра"
     else:
         text += "— все проголосовали —"
@@ -428,101 +1241,51 @@ def get_formatted_stats(broadcast_id):
     return text
 
 def add_user(user_id, username, first_name, nickname):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO users (user_id, username, first_name, nickname, verified_at) VALUES (?, ?, ?, ?, ?)",
-        (user_id, username, first_name, nickname, datetime.now().isoformat())
-    )
-    conn.commit()
-    conn.close()
+    verified_at = datetime.now().isoformat()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, nickname, verified_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, username, first_name, nickname, verified_at)
+        )
+    roster.added(user_id, username, first_name, nickname, verified_at)
 
 def remove_user(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+    roster.removed(user_id)
 
 def get_all_users():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users")
-    users = cur.fetchall()
-    conn.close()
-    return [uid for (uid,) in users]
+    """id всех верифицированных (из памяти, без запроса к БД)."""
+    return roster.ids()
 
 def is_user_verified(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-    result = cur.fetchone()
-    conn.close()
-    return result is not None
+    return user_id in roster
 
 def save_broadcast_with_params(broadcast_id, text, cooldown_minutes, event_time):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT OR REPLACE INTO broadcast_texts
-        (broadcast_id, text, created_at, cooldown_minutes, event_time, reminder_sent, expired_notified)
-        VALUES (?, ?, ?, ?, ?, 0, 0)
-    ''', (broadcast_id, text, datetime.now().isoformat(), cooldown_minutes, event_time))
-    conn.commit()
-    conn.close()
-    logger.info(f"Текст рассылки {broadcast_id} сохранён с параметрами: cooldown={cooldown_minutes}, event_time={event_time}")
-
-def get_broadcast_cooldown(broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT cooldown_minutes FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
-    result = cur.fetchone()
-    conn.close()
-    return result[0] if result else 0
-
-def get_broadcast_event_time(broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT event_time FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
-    result = cur.fetchone()
-    conn.close()
-    return result[0] if result else None
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT OR REPLACE INTO broadcast_texts
+            (broadcast_id, text, created_at, cooldown_minutes, event_time, event_ts, reminder_sent, expired_notified)
+            VALUES (?, ?, ?, ?, ?, ?, 0, 0)
+        ''', (broadcast_id, text, datetime.now().isoformat(), cooldown_minutes, event_time, _event_ts(event_time)))
+    logger.info("Текст рассылки %s сохранён с параметрами: cooldown=%s, event_time=%s", broadcast_id, cooldown_minutes, event_time)
 
 def mark_reminder_sent(broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('UPDATE broadcast_texts SET reminder_sent = 1 WHERE broadcast_id = ?', (broadcast_id,))
-    conn.commit()
-    conn.close()
-
-def can_change_vote(user_id, broadcast_id, cooldown_minutes):
-    if cooldown_minutes == 0:
-        return True, 0
-
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT voted_at FROM votes
-        WHERE user_id = ? AND broadcast_id = ?
-        ORDER BY voted_at DESC LIMIT 1
-    ''', (user_id, broadcast_id))
-    result = cur.fetchone()
-    conn.close()
-
-    if not result:
-        return True, 0
+    """Забирает напоминание в работу. False — его уже отправил кто-то другой (или рассылка удалена)."""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('UPDATE broadcast_texts SET reminder_sent = 1 WHERE broadcast_id = ? AND reminder_sent = 0', (broadcast_id,))
+        return cur.rowcount == 1
 
-    try:
-        last_vote_time = datetime.fromisoformat(result[0])
-        now = datetime.now()
-        minutes_passed = (now - last_vote_time).total_seconds() / 60
-        if minutes_passed >= cooldown_minutes:
-            return True, 0
-        else:
-            remaining = cooldown_minutes - minutes_passed
-            return False, round(remaining, 1)
-    except (ValueError, TypeError):
-        return True, 0
+def mark_expired_notified(broadcast_id):
+    """Забирает уведомление о начале события в работу; False — уже отправлено."""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('UPDATE broadcast_texts SET expired_notified = 1 WHERE broadcast_id = ? AND expired_notified = 0', (broadcast_id,))
+        return cur.rowcount == 1
 
 def parse_event_time(time_input):
     time_input = time_input.strip()
@@ -559,25 +1322,567 @@ def parse_event_time(time_input):
             return False
 
 def save_stats_message(broadcast_id, admin_id, message_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT OR REPLACE INTO stats_messages (broadcast_id, admin_id, message_id, created_at)
-        VALUES (?, ?, ?, ?)
-    ''', (broadcast_id, admin_id, message_id, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-    logger.info(f"Saved stats message {message_id} for broadcast {broadcast_id} in DB")
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT OR REPLACE INTO stats_messages (broadcast_id, admin_id, message_id, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', (broadcast_id, admin_id, message_id, datetime.now().isoformat()))
+    logger.debug("Saved stats message %s for broadcast %s in DB", message_id, broadcast_id)
 
 def get_stats_message(broadcast_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT message_id FROM stats_messages WHERE broadcast_id = ?', (broadcast_id,))
-    result = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT message_id FROM stats_messages WHERE broadcast_id = ?', (broadcast_id,))
+        result = cur.fetchone()
     return result[0] if result else None
 
+# ---------- Голосование ----------
+@dataclass
+class VoteContext:
+    """Всё, что нужно для решения по голосу, одной выборкой."""
+    text: str
+    cooldown: int
+    event_time: str
+    previous: str
+    voted_at: str
+    stats_message_id: int
+
+@dataclass
+class VoteResult:
+    status: str  # 'ok', 'deleted', 'expired', 'cooldown'
+    context: VoteContext = None
+    remaining: float = 0
+
+def _load_vote_context(cur, user_id, broadcast_id):
+    cur.execute('''
+        SELECT b.text, b.cooldown_minutes, b.event_time, v.choice, v.voted_at, s.message_id
+        FROM broadcast_texts b
+        LEFT JOIN votes v ON v.broadcast_id = b.broadcast_id AND v.user_id = ?
+        LEFT JOIN stats_messages s ON s.broadcast_id = b.broadcast_id
+        WHERE b.broadcast_id = ?
+    ''', (user_id, broadcast_id))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    text, cooldown, event_time, previous, voted_at, stats_message_id = row
+    return VoteContext(text, cooldown or 0, event_time, previous, voted_at, stats_message_id)
+
+def evaluate_vote(ctx, action, now):
+    """Проверяет правила голосования без обращения к БД."""
+    if ctx is None:
+        return VoteResult('deleted')
+    if ctx.event_time:
+        try:
+            if datetime.fromisoformat(ctx.event_time) <= now:
+                return VoteResult('expired', ctx)
+        except (ValueError, TypeError):
+            pass
+    if ctx.previous and ctx.previous != action and ctx.cooldown and ctx.voted_at:
+        try:
+            minutes_passed = (now - datetime.fromisoformat(ctx.voted_at)).total_seconds() / 60
+            if minutes_passed < ctx.cooldown:
+                return VoteResult('cooldown', ctx, round(ctx.cooldown - minutes_passed, 1))
+        except (ValueError, TypeError):
+            pass
+    return VoteResult('ok', ctx)
+
+def _write_vote(cur, user_id, broadcast_id, choice, voted_at):
+    cur.execute('''
+        INSERT INTO votes (user_id, broadcast_id, choice, voted_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, broadcast_id) DO UPDATE SET choice = excluded.choice, voted_at = excluded.voted_at
+    ''', (user_id, broadcast_id, choice, voted_at))
+
+def load_vote_context(user_id, broadcast_id):
+    with db.read() as conn:
+        return _load_vote_context(conn.cursor(), user_id, broadcast_id)
+
+def write_votes(votes):
+    """Пишет пачку голосов (user_id, broadcast_id, choice, voted_at) одной транзакцией.
+
+    Голоса за рассылки, удалённые пока голос ждал в буфере, отбрасываются.
+    Возвращает множество рассылок, голоса за которые записаны.
+    """
+    broadcast_ids = list({broadcast_id for _, broadcast_id, _, _ in votes})
+    if not broadcast_ids:
+        return set()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f'SELECT broadcast_id FROM broadcast_texts WHERE broadcast_id IN ({",".join("?" * len(broadcast_ids))})',
+            broadcast_ids
+        )
+        written = {broadcast_id for (broadcast_id,) in cur.fetchall()}
+        votes = [vote for vote in votes if vote[1] in written]
+        cur.executemany('''
+            INSERT INTO votes (user_id, broadcast_id, choice, voted_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, broadcast_id) DO UPDATE SET choice = excluded.choice, voted_at = excluded.voted_at
+        ''', votes)
+    for user_id, broadcast_id, choice, _ in votes:
+        clan_cache.vote_written(broadcast_id, user_id, choice)
+    return written
+
+def cast_vote(user_id, broadcast_id, action):
+    """Голос одной транзакцией: чтение рассылки и прошлого голоса, проверка правил, запись.
+
+    Статистику пользователя в той же транзакции обновляют триггеры.
+    """
+    now = datetime.now()
+    with db.write() as conn:
+        cur = conn.cursor()
+        result = evaluate_vote(_load_vote_context(cur, user_id, broadcast_id), action, now)
+        if result.status == 'ok':
+            _write_vote(cur, user_id, broadcast_id, action, now.isoformat())
+    if result.status == 'ok':
+        clan_cache.vote_written(broadcast_id, user_id, action)
+    return result
+
+# ---------- Очередь доставки ----------
+DELIVERY_RETENTION_DAYS = 14
+
+def enqueue_delivery(broadcast_id, kind, text, reply_markup, admin_id, user_ids):
+    """Сохраняет задание рассылки и по строке очереди на каждого получателя. Возвращает job_id."""
+    job_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    markup_json = reply_markup.to_json() if reply_markup else None
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO delivery_jobs (job_id, broadcast_id, kind, text, reply_markup, admin_id, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)
+        ''', (job_id, broadcast_id, kind, text, markup_json, admin_id, now))
+        cur.executemany('''
+            INSERT OR IGNORE INTO delivery_queue (job_id, broadcast_id, user_id, state, attempts, updated_at)
+            VALUES (?, ?, ?, 'pending', 0, ?)
+        ''', [(job_id, broadcast_id, uid, now) for uid in user_ids])
+    return job_id
+
+def enqueue_edit_delivery(broadcast_id, text, admin_id=None):
+    """Задание на правку исходных сообщений рассылки по журналу broadcast_messages.
+
+    Возвращает job_id или None, если по рассылке нет записанных сообщений.
+    """
+    job_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO delivery_queue (job_id, broadcast_id, user_id, state, attempts, message_id, updated_at)
+            SELECT ?, broadcast_id, chat_id, 'pending', 0, message_id, ?
+            FROM broadcast_messages WHERE broadcast_id = ?
+        ''', (job_id, now, broadcast_id))
+        if cur.rowcount == 0:
+            return None
+        cur.execute('''
+            INSERT INTO delivery_jobs (job_id, broadcast_id, kind, text, reply_markup, admin_id, status, created_at)
+            VALUES (?, ?, 'edit', ?, NULL, ?, 'pending', ?)
+        ''', (job_id, broadcast_id, text, admin_id, now))
+    return job_id
+
+def get_delivery_job(job_id):
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT job_id, broadcast_id, kind, text, reply_markup, admin_id, status
+            FROM delivery_jobs WHERE job_id = ?
+        ''', (job_id,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    keys = ('job_id', 'broadcast_id', 'kind', 'text', 'reply_markup', 'admin_id', 'status')
+    return dict(zip(keys, row))
+
+def get_unfinished_delivery_jobs():
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT job_id FROM delivery_jobs WHERE status = 'pending' ORDER BY created_at")
+        return [row[0] for row in cur.fetchall()]
+
+def get_pending_deliveries(job_id):
+    """Получатели, которым ещё нужно доставить сообщение: {user_id: message_id}."""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, message_id FROM delivery_queue WHERE job_id = ? AND state = 'pending'", (job_id,))
+        return dict(cur.fetchall())
+
+def record_delivery(job_id, user_id, state, message_id=None, error=None, ledger_broadcast_id=None):
+    """Фиксирует результат доставки; для рассылок с кнопками пишет message_id в журнал."""
+    with db.write() as conn:
+        conn.execute('''
+            UPDATE delivery_queue
+            SET state = ?, attempts = attempts + 1, last_error = ?, message_id = COALESCE(?, message_id), updated_at = ?
+            WHERE job_id = ? AND user_id = ?
+        ''', (state, error, message_id, datetime.now().isoformat(), job_id, user_id))
+        if ledger_broadcast_id and state == 'sent':
+            conn.execute('''
+                INSERT OR REPLACE INTO broadcast_messages (broadcast_id, user_id, chat_id, message_id)
+                VALUES (?, ?, ?, ?)
+            ''', (ledger_broadcast_id, user_id, user_id, message_id))
+
+def finish_delivery_job(job_id):
+    """Закрывает задание; оставшиеся pending считаются неудачными. Возвращает (всего, доставлено, ошибок)."""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE delivery_queue SET state = 'failed', updated_at = ?
+            WHERE job_id = ? AND state = 'pending'
+        ''', (datetime.now().isoformat(), job_id))
+        cur.execute("UPDATE delivery_jobs SET status = 'done' WHERE job_id = ?", (job_id,))
+        cur.execute('''
+            SELECT COUNT(*), COALESCE(SUM(state = 'sent'), 0), COALESCE(SUM(state = 'failed'), 0)
+            FROM delivery_queue WHERE job_id = ?
+        ''', (job_id,))
+        return cur.fetchone()
+
+def purge_delivery_queue(days=DELIVERY_RETENTION_DAYS):
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            DELETE FROM delivery_queue WHERE job_id IN (
+                SELECT job_id FROM delivery_jobs WHERE status = 'done' AND created_at < ?
+            )
+        ''', (cutoff,))
+        cur.execute("DELETE FROM delivery_jobs WHERE status = 'done' AND created_at < ?", (cutoff,))
+
+# ---------- Запросы для обработчиков ----------
+def get_vote_roster(broadcast_id):
+    """Проголосовавшие по рассылке и все пользователи (для списков игнора)."""
+    votes, _, _ = clan_cache.snapshot(broadcast_id)
+    return {uid for uid, _ in votes}, clan_cache.users_by_recent()
+
+# Keyset-пагинация: страница выбирается по ключу крайней строки соседней
+# страницы (anchor), а не через OFFSET, поэтому глубокие страницы не дороже
+# первой. before=True — страница перед anchor (кнопка «назад»).
+def _keyset(key, anchor_sql, anchor, before):
+    """(условие, ORDER BY, параметры) для страницы после/до anchor по ключу key."""
+    op, order = ('>', 'ASC') if before else ('<', 'DESC')
+    order_by = ', '.join(f'{column} {order}' for column in key.split(', '))
+    if anchor is None:
+        return '1', order_by, ()
+    return f'({key}) {op} ({anchor_sql})', order_by, (anchor,)
+
+def _fetch_page(cur, per_page, before):
+    """Строки страницы от новых к старым и флаг «есть ещё» в направлении листания."""
+    rows = cur.fetchmany(per_page + 1)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+    return rows, has_more
+
+def get_broadcasts_page(per_page, anchor=None, before=False):
+    """Архив рассылок: (total, [(broadcast_id, created_at, text, votes)], has_more)."""
+    where, order_by, params = _keyset(
+        's.created_at, s.broadcast_id',
+        'SELECT created_at, broadcast_id FROM stats_messages WHERE broadcast_id = ?',
+        anchor, before
+    )
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM stats_messages')
+        total = cur.fetchone()[0]
+        cur.execute(f'''
+            SELECT s.broadcast_id, s.created_at, b.text,
+                   COALESCE(b.going_count + b.not_going_count, 0)
+            FROM stats_messages s
+            LEFT JOIN broadcast_texts b ON s.broadcast_id = b.broadcast_id
+            WHERE {where}
+            ORDER BY {order_by}
+            LIMIT ?
+        ''', (*params, per_page + 1))
+        broadcasts, has_more = _fetch_page(cur, per_page, before)
+    return total, broadcasts, has_more
+
+def get_user_broadcasts_page(user_id, per_page, anchor=None, before=False):
+    """Рассылки, где пользователь голосовал или отмечен: (total, [(broadcast_id, text, created_at)], has_more)."""
+    where, order_by, params = _keyset(
+        'b.created_at, b.broadcast_id',
+        'SELECT created_at, broadcast_id FROM broadcast_texts WHERE broadcast_id = ?',
+        anchor, before
+    )
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT COUNT(*) FROM (
+                SELECT broadcast_id FROM votes WHERE user_id = ?
+                UNION
+                SELECT broadcast_id FROM user_activity WHERE user_id = ?
+            ) u JOIN broadcast_texts b ON b.broadcast_id = u.broadcast_id
+        ''', (user_id, user_id))
+        total = cur.fetchone()[0]
+        cur.execute(f'''
+            SELECT b.broadcast_id, b.text, b.created_at
+            FROM broadcast_texts b
+            WHERE (EXISTS (SELECT 1 FROM votes v WHERE v.user_id = ? AND v.broadcast_id = b.broadcast_id)
+                   OR EXISTS (SELECT 1 FROM user_activity ua WHERE ua.user_id = ? AND ua.broadcast_id = b.broadcast_id))
+              AND {where}
+            ORDER BY {order_by}
+            LIMIT ?
+        ''', (user_id, user_id, *params, per_page + 1))
+        broadcasts, has_more = _fetch_page(cur, per_page, before)
+    return total, broadcasts, has_more
+
+def get_broadcast_detail(broadcast_id):
+    """Текст, дата, голоса и все пользователи с отметками присутствия."""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT text FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
+        text_result = cur.fetchone()
+        broadcast_text = text_result[0] if text_result else None
+
+        cur.execute('SELECT created_at FROM stats_messages WHERE broadcast_id = ?', (broadcast_id,))
+        date_result = cur.fetchone()
+        created_at = date_result[0] if date_result else None
+
+    vote_rows, attended, _ = clan_cache.snapshot(broadcast_id)
+    users = clan_cache.users()
+    votes = []
+    for uid, choice in vote_rows:
+        username, _, nickname, _ = users.get(uid, (None, None, None, None))
+        votes.append((uid, choice, nickname, username, attended.get(uid, 0)))
+    votes.sort(key=lambda row: (row[1], row[2] is not None, row[2] or ''))
+    all_users = [(uid, nickname, username, attended.get(uid, 0))
+                 for uid, username, _, nickname in clan_cache.users_by_nickname()]
+    return broadcast_text, created_at, votes, all_users
+
+def get_attendance_roster(broadcast_id):
+    """Все пользователи с выбором и отметкой, в порядке нумерации для отметки присутствия."""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT u.user_id, u.nickname, u.username,
+                   COALESCE(v.choice, 'ignored') as choice,
+                   COALESCE(ua.attended, 0) as attended
+            FROM users u
+            LEFT JOIN votes v ON u.user_id = v.user_id AND v.broadcast_id = ?
+            LEFT JOIN user_activity ua ON u.user_id = ua.user_id AND ua.broadcast_id = ?
+            ORDER BY
+                CASE
+                    WHEN v.choice = 'going' THEN 1
+                    WHEN v.choice = 'not_going' THEN 2
+                    ELSE 3
+                END,
+                u.nickname
+        ''', (broadcast_id, broadcast_id))
+        return cur.fetchall()
+
+def set_attendance_for_all(broadcast_id, attended):
+    return set_attendance_bulk(broadcast_id, ((uid, attended) for uid in get_all_users()))
+
+def get_rating(limit=20):
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT u.user_id, u.nickname, u.username, s.attended_events
+            FROM user_stats s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE s.attended_events > 0
+            ORDER BY s.attended_events DESC
+            LIMIT ?
+        ''', (limit,))
+        return cur.fetchall()
+
+def delete_broadcast_data(broadcast_id):
+    """Удаляет голоса, сообщение статистики и текст рассылки. Возвращает число удалённых голосов."""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM votes WHERE broadcast_id = ?', (broadcast_id,))
+        votes_deleted = cur.rowcount
+        cur.execute('DELETE FROM stats_messages WHERE broadcast_id = ?', (broadcast_id,))
+        cur.execute('DELETE FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
+        cur.execute('DELETE FROM broadcast_messages WHERE broadcast_id = ?', (broadcast_id,))
+    clan_cache.drop(broadcast_id)
+    return votes_deleted
+
+def delete_all_broadcasts_data():
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM votes')
+        cur.execute('DELETE FROM stats_messages')
+        cur.execute('DELETE FROM broadcast_texts')
+        cur.execute('DELETE FROM broadcast_messages')
+    clan_cache.drop()
+
+def reset_all_stats():
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM user_activity')
+        cur.execute('DELETE FROM votes')
+        cur.execute('DELETE FROM stats_messages')
+        cur.execute('DELETE FROM broadcast_texts')
+        cur.execute('DELETE FROM broadcast_messages')
+        # После триггеров удаления votes/user_activity остаются нулевые строки — убираем их
+        cur.execute('DELETE FROM user_stats')
+    clan_cache.drop()
+
+def get_active_broadcasts():
+    """Рассылки, по которым голосование ещё открыто."""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT broadcast_id, text FROM broadcast_texts WHERE expired_notified = 0')
+        return cur.fetchall()
+
+def count_broadcasts():
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM stats_messages")
+        return cur.fetchone()[0]
+
+def get_users_page(per_page, anchor=None, before=False):
+    """Пользователи от новых к старым: (total, [(user_id, first_name, username, nickname, verified_at)], has_more)."""
+    where, order_by, params = _keyset(
+        'verified_at, user_id',
+        'SELECT verified_at, user_id FROM users WHERE user_id = ?',
+        anchor, before
+    )
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM users")
+        total = cur.fetchone()[0]
+        cur.execute(f"""
+            SELECT user_id, first_name, username, nickname, verified_at
+            FROM users
+            WHERE {where}
+            ORDER BY {order_by}
+            LIMIT ?
+        """, (*params, per_page + 1))
+        users, has_more = _fetch_page(cur, per_page, before)
+    return total, users, has_more
+
+def get_due_reminders(start, end):
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT broadcast_id, text, event_time FROM broadcast_texts
+            WHERE reminder_sent = 0 AND event_ts IS NOT NULL
+            AND event_ts BETWEEN ? AND ?
+        ''', (int(start.timestamp()), int(end.timestamp())))
+        return cur.fetchall()
+
+def get_scheduled_events(now):
+    """Будущие события, по которым ещё есть что отправить (для планирования при запуске)."""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT broadcast_id, event_time, reminder_sent FROM broadcast_texts
+            WHERE expired_notified = 0 AND event_ts IS NOT NULL
+            AND event_ts >= ?
+        ''', (int(now.timestamp()),))
+        return cur.fetchall()
+
+def get_expired_events(now):
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT broadcast_id, text FROM broadcast_texts
+            WHERE expired_notified = 0 AND event_ts IS NOT NULL
+            AND event_ts < ?
+        ''', (int(now.timestamp()),))
+        return cur.fetchall()
+
 # ========================== КЛАВИАТУРЫ ==========================
+
+# ---------- Формат callback_data ----------
+# v1: '1' + код операции (1 символ) + аргумент. Идентификатор рассылки (hex)
+# упаковывается в base64url без '=' (полный uuid4 — 22 символа), номер страницы
+# пишется как есть. Кнопки старого вида '<namespace>_<arg>' разбирает роутер.
+# Коды операций нельзя менять: они живут в уже отправленных сообщениях.
+CALLBACK_VERSION = '1'
+CALLBACK_OPS = {
+    # namespace: (код, аргумент — id рассылки); листание несёт page_cursor
+    'going': ('g', True),
+    'not_going': ('n', True),
+    'refresh_stats': ('r', True),
+    'copy_id': ('c', True),
+    'ignored_list': ('i', True),
+    'download_ignored': ('f', True),
+    'back_to_stats': ('s', True),
+    'delete_broadcast': ('x', True),
+    'confirm_delete': ('X', True),
+    'select_broadcast': ('b', True),
+    'broadcast_detail': ('d', True),
+    'mark_attendance': ('m', True),
+    'attend_all': ('A', True),
+    'unattend_all': ('U', True),
+    'enter_numbers': ('e', True),
+    'my_broadcast_detail': ('D', True),
+    'my_broadcasts_page': ('P', False),
+    'broadcasts_page': ('p', False),
+    'admin_users': ('u', False),
+}
+
+# Длины упакованного id: полный uuid4 (16 байт) и id старых рассылок (8 hex-символов,
+# 4 байта); обоим для base64 не хватает '=='. Другие длины не выдаются.
+_PACKED_ID_LENGTHS = frozenset((22, 6))
+_B64URL_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+_B64URL_TO_STD = bytes.maketrans(b'-_', b'+/')
+
+def pack_id(broadcast_id):
+    return base64.urlsafe_b64encode(bytes.fromhex(broadcast_id)).rstrip(b'=').decode('ascii')
+
+@functools.lru_cache(maxsize=1024)
+def unpack_id(packed):
+    """hex-id из base64url; ValueError для неверной длины и символов вне алфавита.
+
+    Голоса идут по нескольким свежим рассылкам, поэтому разобранные id кэшируются.
+    """
+    if len(packed) not in _PACKED_ID_LENGTHS:
+        raise ValueError(f"bad packed id length {len(packed)}")
+    raw = packed.encode('ascii')
+    if raw.translate(None, _B64URL_ALPHABET):
+        raise ValueError("bad packed id")
+    return binascii.a2b_base64(raw.translate(_B64URL_TO_STD) + b'==').hex()
+
+def page_cursor(page, key, before=False):
+    """Аргумент кнопки листания: номер страницы, направление и ключ крайней строки."""
+    return f"{page}{'<' if before else '>'}{key}"
+
+def parse_page_cursor(arg, unpack=str):
+    """(page, anchor, before) из аргумента кнопки листания.
+
+    Старые кнопки несут только номер страницы — для них открывается первая страница.
+    """
+    sep = arg.find('>') if arg else -1
+    before = sep < 0
+    if before:
+        sep = arg.find('<') if arg else -1
+    if sep <= 0 or not arg[:sep].isdigit():
+        return 1, None, False
+    try:
+        return int(arg[:sep]), unpack(arg[sep + 1:]), before
+    except ValueError:
+        return 1, None, False
+
+def page_flags(anchor, before, has_more):
+    """(has_prev, has_next) для страницы, полученной по anchor."""
+    if anchor is None:
+        return False, has_more
+    if before:
+        return has_more, True
+    return True, has_more
+
+def get_page_nav(namespace, page, first_key, last_key, has_prev, has_next):
+    """Кнопки ◀️/▶️ keyset-пагинации (пустой список, если листать некуда)."""
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀️", callback_data=pack_callback(namespace, page_cursor(page - 1, first_key, before=True))))
+    if has_next:
+        nav.append(InlineKeyboardButton("▶️", callback_data=pack_callback(namespace, page_cursor(page + 1, last_key))))
+    return nav
+
+def pack_callback(namespace, arg):
+    """callback_data для кнопки с аргументом."""
+    op, is_id = CALLBACK_OPS[namespace]
+    if is_id:
+        try:
+            arg = pack_id(arg)
+        except ValueError:
+            # не hex (не должно встречаться) — старый формат
+            return f'{namespace}_{arg}'
+    return f'{CALLBACK_VERSION}{op}{arg}'
+
 def get_verify_keyboard():
     keyboard = [[InlineKeyboardButton("✅ Верифицироваться", callback_data='start_verify')]]
     return InlineKeyboardMarkup(keyboard)
@@ -601,15 +1906,14 @@ def get_admin_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 def get_stats_keyboard(broadcast_id):
-    logger.info(f"Функция get_stats_keyboard вызвана для {broadcast_id}")
     keyboard = [
         [
-            InlineKeyboardButton("📊 Обновить", callback_data=f'refresh_stats_{broadcast_id}'),
-            InlineKeyboardButton("📋 Копировать ID", callback_data=f'copy_id_{broadcast_id}')
+            InlineKeyboardButton("📊 Обновить", callback_data=pack_callback('refresh_stats', broadcast_id)),
+            InlineKeyboardButton("📋 Копировать ID", callback_data=pack_callback('copy_id', broadcast_id))
         ],
         [
-            InlineKeyboardButton("👥 Игнорируют", callback_data=f'ignored_list_{broadcast_id}'),
-            InlineKeyboardButton("🗑 Удалить рассылку", callback_data=f'delete_broadcast_{broadcast_id}')
+            InlineKeyboardButton("👥 Игнорируют", callback_data=pack_callback('ignored_list', broadcast_id)),
+            InlineKeyboardButton("🗑 Удалить рассылку", callback_data=pack_callback('delete_broadcast', broadcast_id))
         ],
         [
             InlineKeyboardButton("❌ Закрыть", callback_data='close_stats')
@@ -630,36 +1934,498 @@ def get_me_keyboard(user_id):
     buttons.append([InlineKeyboardButton("📋 Мои рассылки", callback_data='my_broadcasts')])
     return InlineKeyboardMarkup(buttons)
 
-def get_my_broadcasts_keyboard(broadcasts, page, total_pages):
+def get_my_broadcasts_keyboard(broadcasts, start, nav):
     keyboard = []
-    per_page = 5
-    start = (page - 1) * per_page
-    for i, bid in enumerate(broadcasts[start:start+per_page], start=start+1):
+    for i, (bid, _, _) in enumerate(broadcasts, start=start):
         short = bid[:6] + "..." if len(bid) > 6 else bid
-        keyboard.append([InlineKeyboardButton(f"{i}. {short}", callback_data=f'my_broadcast_detail_{bid}')])
+        keyboard.append([InlineKeyboardButton(f"{i}. {short}", callback_data=pack_callback('my_broadcast_detail', bid))])
 
-    nav = []
-    if page > 1:
-        nav.append(InlineKeyboardButton("◀️", callback_data=f'my_broadcasts_page_{page-1}'))
-    if page < total_pages:
-        nav.append(InlineKeyboardButton("▶️", callback_data=f'my_broadcasts_page_{page+1}'))
     if nav:
         keyboard.append(nav)
 
     keyboard.append([InlineKeyboardButton("◀️ Назад в профиль", callback_data='back_to_me')])
     return InlineKeyboardMarkup(keyboard)
 
+# ========================== МАССОВАЯ РАССЫЛКА ==========================
+FANOUT_RATE = float(os.environ.get('FANOUT_RATE', '28'))  # сообщений в секунду на весь бот (лимит Telegram ~30)
+FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', '16'))
+FANOUT_PER_CHAT_INTERVAL = 1.0  # секунд между сообщениями в один чат
+FANOUT_MAX_RETRIES = 3
+FANOUT_PROGRESS_INTERVAL = 5  # секунд между обновлениями прогресса
+
+class TokenBucket:
+    """Token bucket для глобального лимита запросов к Bot API."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов (после RetryAfter от Telegram)."""
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+@dataclass
+class FanOutResult:
+    total: int = 0
+    delivered: int = 0
+    failed: int = 0
+
+class FanOut:
+    """Общий движок массовой отправки: ограниченная параллельность, глобальный и
+    початовый лимиты, повтор после RetryAfter, отчёт о прогрессе."""
+
+    def __init__(self, rate=FANOUT_RATE, concurrency=FANOUT_CONCURRENCY,
+                 per_chat_interval=FANOUT_PER_CHAT_INTERVAL, max_retries=FANOUT_MAX_RETRIES):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._chat_next = {}
+
+    async def _wait_chat(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        ready_at = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, ready_at) + self.per_chat_interval
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+        if len(self._chat_next) > 10000:
+            self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+
+    async def call(self, chat_id, send):
+        """Один запрос к чату с учётом лимитов; send — функция без аргументов, возвращающая awaitable."""
+        for attempt in range(self.max_retries + 1):
+            await self._wait_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                return await send()
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("RetryAfter %ss while sending to %s", e.retry_after, chat_id, extra={'sample': 'retry_after'})
+                self.bucket.pause(e.retry_after)
+
+    async def run(self, chat_ids, send, on_progress=None, on_result=None):
+        """Отправляет send(chat_id) каждому получателю и возвращает FanOutResult.
+
+        on_result(chat_id, message, error) вызывается после каждой попытки,
+        on_progress(result) — не чаще раза в FANOUT_PROGRESS_INTERVAL секунд.
+        """
+        chat_ids = list(chat_ids)
+        result = FanOutResult(total=len(chat_ids))
+        pending = iter(chat_ids)
+        loop = asyncio.get_running_loop()
+        last_progress = loop.time()
+
+        async def worker():
+            nonlocal last_progress
+            for chat_id in pending:
+                message, error = None, None
+                try:
+                    message = await self.call(chat_id, lambda: send(chat_id))
+                    result.delivered += 1
+                except Exception as e:
+                    error = e
+                    result.failed += 1
+                    logger.error("Failed to send to %s: %s", chat_id, e, extra={'sample': 'send_failed'})
+                if on_result:
+                    await on_result(chat_id, message, error)
+                if on_progress and loop.time() - last_progress >= FANOUT_PROGRESS_INTERVAL:
+                    last_progress = loop.time()
+                    await on_progress(result)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(chat_ids)) or 1)))
+        if on_progress:
+            await on_progress(result)
+        return result
+
+fanout = FanOut()
+
+def text_sender(bot, text, reply_markup=None, parse_mode='HTML'):
+    """Функция отправки одного и того же сообщения для FanOut.run."""
+    async def send(chat_id):
+        return await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+    return send
+
+def edit_sender(bot, text, message_ids):
+    """Правит ранее отправленное сообщение и убирает с него кнопки.
+
+    Если править нечего или Telegram не даёт, отправляет текст новым сообщением.
+    """
+    async def send(chat_id):
+        message_id = message_ids.get(chat_id)
+        if message_id:
+            try:
+                return await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode='HTML')
+            except BadRequest as e:
+                if "Message is not modified" in str(e):
+                    return None
+                logger.warning("Cannot edit message %s in %s, sending new one: %s", message_id, chat_id, e)
+        return await bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
+    return send
+
+def progress_editor(message, title):
+    """Обновляет служебное сообщение админа ходом рассылки."""
+    async def report(result):
+        try:
+            await message.edit_text(
+                f"{title}\n📤 Отправлено: {result.delivered + result.failed}/{result.total}, ошибок: {result.failed}"
+            )
+        except Exception as e:
+            if "Message is not modified" not in str(e):
+                logger.error("Error updating broadcast progress: %s", e)
+    return report
+
+DELIVERY_MAX_ATTEMPTS = 3
+
+def _is_transient(error):
+    """Сетевые сбои и таймауты имеет смысл повторить, отказы Telegram (403/400) — нет."""
+    return isinstance(error, (TimedOut, NetworkError)) and not isinstance(error, BadRequest)
+
+_draining_jobs = {}  # job_id -> задача, которая сейчас доотправляет задание
+
+def drain_delivery_job(bot, job_id, on_progress=None):
+    """Доотправляет все pending-строки задания через FanOut, фиксируя результат каждой в БД.
+
+    Если задание уже доотправляется, второй вызов ждёт ту же задачу и получает её итог
+    (его on_progress при этом не вызывается). Отмена ожидающего не прерывает отправку.
+    """
+    task = _draining_jobs.get(job_id)
+    if task is None:
+        task = asyncio.ensure_future(_drain_delivery_job(bot, job_id, on_progress))
+        _draining_jobs[job_id] = task
+        task.add_done_callback(lambda _: _draining_jobs.pop(job_id, None))
+    return asyncio.shield(task)
+
+async def _drain_delivery_job(bot, job_id, on_progress):
+    job = await run_db(get_delivery_job, job_id)
+    reply_markup = None
+    if job['reply_markup']:
+        reply_markup = InlineKeyboardMarkup.de_json(json.loads(job['reply_markup']), bot)
+    ledger_broadcast_id = job['broadcast_id'] if job['kind'] == 'broadcast' else None
+    pending = {}
+    if job['kind'] == 'edit':
+        send = edit_sender(bot, job['text'], pending)
+    else:
+        send = text_sender(bot, job['text'], reply_markup)
+
+    async def on_result(chat_id, message, error):
+        if error is None:
+            message_id = getattr(message, 'message_id', None)
+            await run_db(record_delivery, job_id, chat_id, 'sent', message_id=message_id,
+                         ledger_broadcast_id=ledger_broadcast_id)
+        else:
+            state = 'pending' if _is_transient(error) else 'failed'
+            await run_db(record_delivery, job_id, chat_id, state, error=str(error))
+
+    for _ in range(DELIVERY_MAX_ATTEMPTS):
+        pending.clear()
+        pending.update(await run_db(get_pending_deliveries, job_id))
+        if not pending:
+            break
+        await fanout.run(list(pending), send, on_progress=on_progress, on_result=on_result)
+    total, delivered, failed = await run_db(finish_delivery_job, job_id)
+    return FanOutResult(total=total, delivered=delivered, failed=failed)
+
+async def enqueue_notice(text, broadcast_id=None, admin_id=None):
+    """Ставит служебное уведомление всем верифицированным в очередь доставки. Возвращает job_id."""
+    return await run_db(enqueue_delivery, broadcast_id, 'notice', text, None, admin_id, get_all_users())
+
+async def notify_users(bot, text, broadcast_id=None):
+    """Служебное уведомление всем верифицированным пользователям через очередь доставки."""
+    return await drain_delivery_job(bot, await enqueue_notice(text, broadcast_id))
+
+async def report_deliveries(bot, job_ids, admin_id, title):
+    """Доотправляет поставленные задания и присылает админу итог.
+
+    Запускается через application.create_task, чтобы обработчик админа не ждал
+    рассылку по всему клану. Задания уже в БД — после перезапуска их доотправит
+    resume_deliveries.
+    """
+    delivered = failed = 0
+    for job_id in job_ids:
+        result = await drain_delivery_job(bot, job_id)
+        delivered += result.delivered
+        failed += result.failed
+    try:
+        await bot.send_message(chat_id=admin_id, text=f"{title}\nУведомлено: {delivered}, ошибок: {failed}")
+    except Exception as e:
+        logger.error("Failed to report deliveries to %s: %s", admin_id, e)
+
+async def close_broadcast_messages(bot, broadcast_id, text):
+    """Заменяет текст разосланных сообщений и снимает кнопки голосования.
+
+    Для рассылок без журнала сообщений (отправленных до его появления) шлёт обычное уведомление.
+    """
+    job_id = await run_db(enqueue_edit_delivery, broadcast_id, text)
+    if job_id is None:
+        return await notify_users(bot, text, broadcast_id)
+    return await drain_delivery_job(bot, job_id)
+
+@timed('job')
+async def resume_deliveries(context: ContextTypes.DEFAULT_TYPE):
+    """Доотправляет задания, прерванные перезапуском бота."""
+    await run_db(purge_delivery_queue)
+    for job_id in await run_db(get_unfinished_delivery_jobs):
+        job = await run_db(get_delivery_job, job_id)
+        if job_id in _draining_jobs:
+            continue  # задание только что поставлено и уже отправляется
+        logger.info("Resuming delivery job %s (%s, broadcast %s)", job_id, job['kind'], job['broadcast_id'])
+        result = await drain_delivery_job(context.bot, job_id)
+        if result and job['admin_id']:
+            try:
+                await context.bot.send_message(
+                    chat_id=job['admin_id'],
+                    text=f"♻️ Рассылка {job['broadcast_id']} продолжена после перезапуска.\n"
+                         f"Успешно: {result.delivered}, Ошибок: {result.failed}"
+                )
+            except Exception as e:
+                logger.error("Failed to report resumed delivery %s: %s", job_id, e)
+
+@timed('job')
+async def recalc_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая сверка статистики после запуска, если её версия устарела."""
+    fixed = await run_db(recalc_all_stats)
+    logger.info("Background stats recalculation finished, fixed %s rows", fixed)
+
+async def send_broadcast(context: ContextTypes.DEFAULT_TYPE, admin_id, broadcast_id, text, reply_markup, users,
+                         status_message, done_markup=None):
+    """Рассылает сообщение с кнопками голосования и присылает админу статистику и итог.
+
+    Сообщение со статистикой создаётся до отправки, чтобы голоса, пришедшие во время
+    рассылки, обновляли его, а не создавали новое.
+    """
+    stats_text = await run_db(get_formatted_stats, broadcast_id)
+    stats_message = await context.bot.send_message(
+        chat_id=admin_id,
+        text=stats_text,
+        reply_markup=get_stats_keyboard(broadcast_id),
+        parse_mode='HTML'
+    )
+    await run_db(save_stats_message, broadcast_id, admin_id, stats_message.message_id)
+    job_id = await run_db(enqueue_delivery, broadcast_id, 'broadcast', text, reply_markup, admin_id, users)
+    result = await drain_delivery_job(
+        context.bot, job_id,
+        on_progress=progress_editor(status_message, f"📢 Рассылка для {len(users)} пользователей")
+    )
+    done_text = f"✅ Рассылка завершена. Успешно: {result.delivered}, Ошибок: {result.failed}"
+    if done_markup:
+        done_text += "\n\n👑 Админ-панель:"
+    await context.bot.send_message(chat_id=admin_id, text=done_text, reply_markup=done_markup)
+    return result
+
+# ========================== БУФЕР ГОЛОСОВ ==========================
+# Отложенная запись: голос подтверждается сразу, а в БД попадает пачкой раз в VOTE_BUFFER_MS
+# или при накоплении VOTE_BUFFER_MAX голосов. 0 — буфер выключен, каждый голос пишется сразу.
+VOTE_BUFFER_MS = int(os.environ.get('VOTE_BUFFER_MS', '0'))
+VOTE_BUFFER_MAX = int(os.environ.get('VOTE_BUFFER_MAX', '200'))
+
+class VoteBuffer:
+    def __init__(self, interval_ms, max_size):
+        self.interval = interval_ms / 1000
+        self.max_size = max_size
+        self.pending = {}  # (user_id, broadcast_id) -> (choice, voted_at), последний голос побеждает
+        self.on_flush = None
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._kicks = set()
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def overlay(self, ctx, user_id, broadcast_id):
+        """Подставляет ещё не записанный голос пользователя вместо прочитанного из БД."""
+        buffered = self.pending.get((user_id, broadcast_id))
+        if ctx is not None and buffered:
+            ctx.previous, ctx.voted_at = buffered
+
+    def add(self, user_id, broadcast_id, choice, voted_at):
+        self.pending[(user_id, broadcast_id)] = (choice, voted_at)
+        if len(self.pending) >= self.max_size:
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self._kicks.add(task)
+            task.add_done_callback(self._kicks.discard)
+
+    @timed('job', 'vote_buffer_flush')
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            try:
+                written = await run_db(write_votes, [(uid, bid, choice, voted_at)
+                                                     for (uid, bid), (choice, voted_at) in batch.items()])
+            except Exception as e:
+                logger.error("Vote buffer flush failed, keeping %s votes: %s", len(batch), e)
+                # Более свежие голоса, пришедшие во время записи, не затираем
+                for key, value in batch.items():
+                    self.pending.setdefault(key, value)
+                return
+            logger.debug("Flushed %d buffered votes", len(batch))
+        if self.on_flush and written:
+            await self.on_flush(written)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Vote buffer error: %s", e)
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+vote_buffer = VoteBuffer(VOTE_BUFFER_MS, VOTE_BUFFER_MAX)
+
+async def submit_vote(user_id, broadcast_id, action):
+    """Голосование через буфер, если он включён, иначе одной транзакцией в БД."""
+    if not vote_buffer.enabled:
+        return await run_db(cast_vote, user_id, broadcast_id, action)
+    now = datetime.now()
+    ctx = await run_db(load_vote_context, user_id, broadcast_id)
+    vote_buffer.overlay(ctx, user_id, broadcast_id)
+    vote = evaluate_vote(ctx, action, now)
+    if vote.status == 'ok':
+        vote_buffer.add(user_id, broadcast_id, action, now.isoformat())
+    return vote
+
+# ========================== ЖИВАЯ СТАТИСТИКА ==========================
+# Сообщение со статистикой у админов правится не чаще раза в STATS_REFRESH_INTERVAL секунд
+# на рассылку; голоса внутри интервала сливаются в одну правку, после последнего голоса
+# всегда приходит завершающая правка.
+STATS_REFRESH_INTERVAL = float(os.environ.get('STATS_REFRESH_INTERVAL', '3'))
+
+def _stats_digest(text):
+    """Хеш текста статистики без строки с временем обновления."""
+    body = "\n".join(line for line in text.split("\n") if not line.startswith("🕒 Обновлено:"))
+    return hashlib.sha1(body.encode()).hexdigest()
+
+class StatsRefresher:
+    def __init__(self, interval):
+        self.interval = interval
+        self.bot = None
+        self._dirty = set()
+        self._tasks = {}
+        self._last_edit = {}
+        self._digests = {}
+
+    def mark(self, broadcast_id):
+        """Отмечает, что статистика рассылки изменилась."""
+        self._dirty.add(broadcast_id)
+        if broadcast_id not in self._tasks and self.bot is not None:
+            task = asyncio.get_running_loop().create_task(self._refresh_loop(broadcast_id))
+            self._tasks[broadcast_id] = task
+
+    async def _refresh_loop(self, broadcast_id):
+        try:
+            while broadcast_id in self._dirty:
+                loop = asyncio.get_running_loop()
+                delay = self._last_edit.get(broadcast_id, 0) + self.interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._dirty.discard(broadcast_id)
+                self._last_edit[broadcast_id] = loop.time()
+                retry_after = await self._render(broadcast_id)
+                if retry_after:
+                    self._dirty.add(broadcast_id)
+                    self._last_edit[broadcast_id] = loop.time() + retry_after
+        finally:
+            if self._tasks.get(broadcast_id) is asyncio.current_task():
+                del self._tasks[broadcast_id]
+
+    @timed('job', 'stats_refresh')
+    async def _render(self, broadcast_id):
+        if await run_db(get_broadcast_info, broadcast_id) is None:
+            return None  # рассылку удалили — новое сообщение статистики не заводим
+        stats_msg_id = await run_db(get_stats_message, broadcast_id)
+        new_stats_text = await run_db(get_formatted_stats, broadcast_id)
+        digest = _stats_digest(new_stats_text)
+        if stats_msg_id and self._digests.get(broadcast_id) == digest:
+            return None
+        for admin in ADMIN_IDS:
+            try:
+                if stats_msg_id:
+                    await self.bot.edit_message_text(
+                        chat_id=admin,
+                        message_id=stats_msg_id,
+                        text=new_stats_text,
+                        reply_markup=get_stats_keyboard(broadcast_id),
+                        parse_mode='HTML'
+                    )
+                    logger.debug("Stats updated for broadcast %s", broadcast_id)
+                else:
+                    stats_message = await self.bot.send_message(
+                        chat_id=admin,
+                        text=new_stats_text,
+                        parse_mode='HTML'
+                    )
+                    await run_db(save_stats_message, broadcast_id, admin, stats_message.message_id)
+            except RetryAfter as e:
+                return e.retry_after
+            except Exception as e:
+                if "Message is not modified" not in str(e):
+                    logger.error("Error updating stats: %s", e)
+        self._digests[broadcast_id] = digest
+        return None
+
+    def forget(self, broadcast_id=None):
+        """Сбрасывает состояние по удалённой рассылке (или по всем) и отменяет отложенные обновления."""
+        if broadcast_id is None:
+            self._dirty.clear()
+            self._digests.clear()
+            self._last_edit.clear()
+            tasks, self._tasks = list(self._tasks.values()), {}
+        else:
+            self._dirty.discard(broadcast_id)
+            self._digests.pop(broadcast_id, None)
+            self._last_edit.pop(broadcast_id, None)
+            task = self._tasks.pop(broadcast_id, None)
+            tasks = [task] if task else []
+        for task in tasks:
+            task.cancel()
+
+stats_refresher = StatsRefresher(STATS_REFRESH_INTERVAL)
+
 # ========================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ-ОБРАБОТЧИКИ ==========================
 async def show_ignored_list(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id):
     """Показывает список проигнорировавших рассылку."""
     query = update.callback_query
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT user_id FROM votes WHERE broadcast_id = ?', (broadcast_id,))
-    voted_users = {row[0] for row in cur.fetchall()}
-    cur.execute('SELECT user_id, username, first_name, nickname FROM users ORDER BY verified_at DESC')
-    all_users = cur.fetchall()
-    conn.close()
+    voted_users, all_users = await run_db(get_vote_roster, broadcast_id)
 
     if not all_users:
         await query.answer("📭 В базе нет пользователей", show_alert=True)
@@ -689,7 +2455,7 @@ async def show_ignored_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
         for user in ignored_list:
             text += f"{user}\n"
         markup = InlineKeyboardMarkup([[
-            InlineKeyboardButton("◀️ Назад к статистике", callback_data=f'back_to_stats_{broadcast_id}')
+            InlineKeyboardButton("◀️ Назад к статистике", callback_data=pack_callback('back_to_stats', broadcast_id))
         ]])
         await query.edit_message_text(text, reply_markup=markup, parse_mode='HTML')
     else:
@@ -697,8 +2463,8 @@ async def show_ignored_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
             text += f"{user}\n"
         text += f"\n... и еще {ignored - 10} пользователей"
         keyboard = [
-            [InlineKeyboardButton("📥 Скачать полный список", callback_data=f'download_ignored_{broadcast_id}')],
-            [InlineKeyboardButton("◀️ Назад к статистике", callback_data=f'back_to_stats_{broadcast_id}')]
+            [InlineKeyboardButton("📥 Скачать полный список", callback_data=pack_callback('download_ignored', broadcast_id))],
+            [InlineKeyboardButton("◀️ Назад к статистике", callback_data=pack_callback('back_to_stats', broadcast_id))]
         ]
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
     await query.answer()
@@ -711,13 +2477,7 @@ async def download_ignored_list(update: Update, context: ContextTypes.DEFAULT_TY
         await query.answer("❌ Нет доступа", show_alert=True)
         return
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT user_id FROM votes WHERE broadcast_id = ?', (broadcast_id,))
-    voted_users = {row[0] for row in cur.fetchall()}
-    cur.execute('SELECT user_id, username, first_name, nickname FROM users ORDER BY verified_at DESC')
-    all_users = cur.fetchall()
-    conn.close()
+    voted_users, all_users = await run_db(get_vote_roster, broadcast_id)
 
     if not all_users:
         await query.answer("📭 В базе нет пользователей", show_alert=True)
@@ -746,40 +2506,26 @@ async def download_ignored_list(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
     await context.bot.send_document(chat_id=user_id, document=file, caption=f"📥 Полный список игнорирующих ({ignored} чел.)")
 
-async def show_broadcasts_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_broadcasts_list(update: Update, context: ContextTypes.DEFAULT_TYPE, cursor=None):
     """Показывает список всех рассылок с пагинацией (админский)."""
     query = update.callback_query
-    parts = query.data.split('_')
-    if len(parts) > 2 and parts[-2] == 'page':
-        page = int(parts[-1])
-    else:
-        page = 1
 
     per_page = 5
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT COUNT(*) FROM stats_messages')
-    total = cur.fetchone()[0]
-    cur.execute('''
-        SELECT s.broadcast_id, s.created_at, b.text, COUNT(v.id) as votes_count
-        FROM stats_messages s
-        LEFT JOIN broadcast_texts b ON s.broadcast_id = b.broadcast_id
-        LEFT JOIN votes v ON s.broadcast_id = v.broadcast_id
-        GROUP BY s.broadcast_id
-        ORDER BY s.created_at DESC
-        LIMIT ? OFFSET ?
-    ''', (per_page, (page - 1) * per_page))
-    broadcasts = cur.fetchall()
-    conn.close()
+    page, anchor, before = parse_page_cursor(cursor, unpack_id)
+    total, broadcasts, has_more = await run_db(get_broadcasts_page, per_page, anchor, before)
+    if not broadcasts and anchor is not None:
+        # крайняя рассылка соседней страницы удалена — начинаем сначала
+        page, anchor, before = 1, None, False
+        total, broadcasts, has_more = await run_db(get_broadcasts_page, per_page)
 
     if not broadcasts:
-        if page == 1:
-            await query.answer("📭 Нет отправленных рассылок", show_alert=True)
-        else:
-            await query.answer("📭 Страница пуста", show_alert=True)
+        await query.answer("📭 Нет отправленных рассылок", show_alert=True)
         return
 
-    total_pages = (total - 1) // per_page + 1
+    has_prev, has_next = page_flags(anchor, before, has_more)
+    if not has_prev:
+        page = 1
+    total_pages = max((total - 1) // per_page + 1, page)
     text = f"<b>📋 Архив рассылок</b> (стр. {page}/{total_pages})\n\n"
 
     for i, (bid, created_at, preview, votes_cnt) in enumerate(broadcasts, 1):
@@ -794,13 +2540,9 @@ async def show_broadcasts_list(update: Update, context: ContextTypes.DEFAULT_TYP
     keyboard = []
     for i, (bid, _, _, _) in enumerate(broadcasts, 1):
         short_id = bid[:6] + "..." if len(bid) > 6 else bid
-        keyboard.append([InlineKeyboardButton(f"{i}. {short_id}", callback_data=f'select_broadcast_{bid}')])
+        keyboard.append([InlineKeyboardButton(f"{i}. {short_id}", callback_data=pack_callback('select_broadcast', bid))])
 
-    nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton("◀️", callback_data=f'broadcasts_page_{page - 1}'))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton("▶️", callback_data=f'broadcasts_page_{page + 1}'))
+    nav_buttons = get_page_nav('broadcasts_page', page, pack_id(broadcasts[0][0]), pack_id(broadcasts[-1][0]), has_prev, has_next)
     if nav_buttons:
         keyboard.append(nav_buttons)
 
@@ -814,37 +2556,11 @@ async def show_broadcasts_list(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def show_broadcast_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id):
     query = update.callback_query
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT text FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
-    text_result = cur.fetchone()
-    broadcast_text = text_result[0] if text_result else "Текст не найден"
-    safe_broadcast = html.escape(broadcast_text)
-
-    cur.execute('SELECT created_at FROM stats_messages WHERE broadcast_id = ?', (broadcast_id,))
-    date_result = cur.fetchone()
-    created_at = date_result[0][:16] if date_result else "неизвестно"
+    broadcast_text, created_at, votes, all_users = await run_db(get_broadcast_detail, broadcast_id)
+    safe_broadcast = html.escape(broadcast_text or "Текст не найден")
+    created_at = created_at[:16] if created_at else "неизвестно"
     safe_bid = html.escape(broadcast_id)
 
-    cur.execute('''
-        SELECT v.user_id, v.choice, u.nickname, u.username, COALESCE(ua.attended, 0) as attended
-        FROM votes v
-        LEFT JOIN users u ON v.user_id = u.user_id
-        LEFT JOIN user_activity ua ON v.user_id = ua.user_id AND ua.broadcast_id = ?
-        WHERE v.broadcast_id = ?
-        ORDER BY v.choice, u.nickname
-    ''', (broadcast_id, broadcast_id))
-    votes = cur.fetchall()
-
-    cur.execute('''
-        SELECT u.user_id, u.nickname, u.username, COALESCE(ua.attended, 0) as attended
-        FROM users u
-        LEFT JOIN user_activity ua ON u.user_id = ua.user_id AND ua.broadcast_id = ?
-        ORDER BY u.nickname
-    ''', (broadcast_id,))
-    all_users = cur.fetchall()
-    conn.close()
-
     voted_ids = set()
     going = []
     not_going = []
@@ -885,35 +2601,61 @@ async def show_broadcast_detail(update: Update, context: ContextTypes.DEFAULT_TY
         text += f"{i}. {user}\n"
 
     keyboard = [
-        [InlineKeyboardButton("✅ Отметить присутствие", callback_data=f'mark_attendance_{broadcast_id}'),
-         InlineKeyboardButton("🗑 Удалить", callback_data=f'delete_broadcast_{broadcast_id}')],
+        [InlineKeyboardButton("✅ Отметить присутствие", callback_data=pack_callback('mark_attendance', broadcast_id)),
+         InlineKeyboardButton("🗑 Удалить", callback_data=pack_callback('delete_broadcast', broadcast_id))],
         [InlineKeyboardButton("◀️ Назад к списку", callback_data='admin_broadcasts_list'),
          InlineKeyboardButton("❌ Закрыть", callback_data='close_stats')]
     ]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
     await query.answer()
 
+# Нумерация для отметки присутствия фиксируется один раз на сессию отметки
+# (экран отметки -> ввод номеров -> обработка номеров), чтобы номера не съезжали,
+# если кто-то проголосует в процессе.
+ATTENDANCE_SNAPSHOT_TTL = 600
+
+async def get_attendance_snapshot(context: ContextTypes.DEFAULT_TYPE, broadcast_id, fresh=False):
+    """Нумерованный список [(user_id, nick, username, choice)] для сессии отметки.
+
+    Сохранённый снимок переиспользуется, пока совпадает рассылка, состав клана
+    не менялся и не истёк ATTENDANCE_SNAPSHOT_TTL.
+    """
+    snapshot = context.user_data.get('attendance_snapshot')
+    if (not fresh and snapshot and snapshot['broadcast_id'] == broadcast_id
+            and snapshot['version'] == roster.version
+            and time.monotonic() - snapshot['created'] < ATTENDANCE_SNAPSHOT_TTL):
+        return snapshot['users']
+    rows = await run_db(get_attendance_roster, broadcast_id)
+    users = [(uid, nick, username, choice) for uid, nick, username, choice, _ in rows]
+    context.user_data['attendance_snapshot'] = {
+        'broadcast_id': broadcast_id,
+        'version': roster.version,
+        'created': time.monotonic(),
+        'users': users,
+    }
+    return users
+
+def drop_attendance_snapshot(context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop('attendance_snapshot', None)
+
+def format_attendance_list(broadcast_id, users):
+    """Нумерованный список по группам ✅/❌/игнор с текущими отметками присутствия."""
+    _, attended, _ = clan_cache.snapshot(broadcast_id)
+    groups = {'going': [], 'not_going': [], 'ignored': []}
+    for num, (uid, nick, username, choice) in enumerate(users, 1):
+        status = "✅" if attended.get(uid) else "⬜"
+        name = html.escape(nick or username or f"ID {uid}")
+        groups.get(choice, groups['ignored']).append(f"{num}. {status} {name}")
+
+    text = ""
+    for key, title in (('going', "✅"), ('not_going', "❌"), ('ignored', "⚠️ Проигнорировали")):
+        if groups[key]:
+            text += f"{title} ({len(groups[key])}):\n" + "\n".join(groups[key]) + "\n\n"
+    return text
+
 async def mark_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id):
     query = update.callback_query
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT u.user_id, u.nickname, u.username,
-               COALESCE(v.choice, 'ignored') as choice,
-               COALESCE(ua.attended, 0) as attended
-        FROM users u
-        LEFT JOIN votes v ON u.user_id = v.user_id AND v.broadcast_id = ?
-        LEFT JOIN user_activity ua ON u.user_id = ua.user_id AND ua.broadcast_id = ?
-        ORDER BY
-            CASE
-                WHEN v.choice = 'going' THEN 1
-                WHEN v.choice = 'not_going' THEN 2
-                ELSE 3
-            END,
-            u.nickname
-    ''', (broadcast_id, broadcast_id))
-    all_users = cur.fetchall()
-    conn.close()
+    all_users = await get_attendance_snapshot(context, broadcast_id, fresh=True)
 
     if not all_users:
         await query.answer("❌ В базе нет пользователей", show_alert=True)
@@ -921,119 +2663,30 @@ async def mark_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE, br
 
     safe_bid = html.escape(broadcast_id)
     text = f"<b>📝 Отметка присутствия</b>\nРассылка: <code>{safe_bid}</code>\n\n"
-    going, not_going, ignored = [], [], []
-
-    for uid, nick, username, choice, attended in all_users:
-        status = "✅" if attended else "⬜"
-        name = html.escape(nick or username or f"ID {uid}")
-        display = f"{status} {name}"
-        if choice == 'going':
-            going.append(display)
-        elif choice == 'not_going':
-            not_going.append(display)
-        else:
-            ignored.append(display)
-
-    counter = 1
-    user_map = {}
-
-    if going:
-        text += f"✅ ({len(going)}):\n"
-        for display in going:
-            text += f"{counter}. {display}\n"
-            user_map[str(counter)] = all_users[counter - 1][0]
-            counter += 1
-        text += "\n"
-    if not_going:
-        text += f"❌ ({len(not_going)}):\n"
-        for display in not_going:
-            text += f"{counter}. {display}\n"
-            user_map[str(counter)] = all_users[counter - 1][0]
-            counter += 1
-        text += "\n"
-    if ignored:
-        text += f"⚠️ Проигнорировали ({len(ignored)}):\n"
-        for display in ignored:
-            text += f"{counter}. {display}\n"
-            user_map[str(counter)] = all_users[counter - 1][0]
-            counter += 1
-
-    context.user_data['attendance_map'] = user_map
-    context.user_data['attendance_broadcast'] = broadcast_id
-    context.user_data['attendance_total'] = len(all_users)
+    text += await run_db(format_attendance_list, broadcast_id, all_users)
 
     keyboard = [
-        [InlineKeyboardButton("✅ Отметить всех", callback_data=f'attend_all_{broadcast_id}'),
-         InlineKeyboardButton("❌ Сбросить всех", callback_data=f'unattend_all_{broadcast_id}')],
-        [InlineKeyboardButton("🔢 Ввести номера", callback_data=f'enter_numbers_{broadcast_id}'),
-         InlineKeyboardButton("◀️ Назад", callback_data=f'broadcast_detail_{broadcast_id}')]
+        [InlineKeyboardButton("✅ Отметить всех", callback_data=pack_callback('attend_all', broadcast_id)),
+         InlineKeyboardButton("❌ Сбросить всех", callback_data=pack_callback('unattend_all', broadcast_id))],
+        [InlineKeyboardButton("🔢 Ввести номера", callback_data=pack_callback('enter_numbers', broadcast_id)),
+         InlineKeyboardButton("◀️ Назад", callback_data=pack_callback('broadcast_detail', broadcast_id))]
     ]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
     await query.answer()
 
 async def enter_attendance_numbers(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id):
     query = update.callback_query
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT u.user_id, u.nickname, u.username,
-               COALESCE(v.choice, 'ignored') as choice,
-               COALESCE(ua.attended, 0) as attended
-        FROM users u
-        LEFT JOIN votes v ON u.user_id = v.user_id AND v.broadcast_id = ?
-        LEFT JOIN user_activity ua ON u.user_id = ua.user_id AND ua.broadcast_id = ?
-        ORDER BY
-            CASE
-                WHEN v.choice = 'going' THEN 1
-                WHEN v.choice = 'not_going' THEN 2
-                ELSE 3
-            END,
-            u.nickname
-    ''', (broadcast_id, broadcast_id))
-    all_users = cur.fetchall()
-    conn.close()
+    all_users = await get_attendance_snapshot(context, broadcast_id)
 
     safe_bid = html.escape(broadcast_id)
     text = f"<b>📝 Отметка присутствия</b>\nРассылка: <code>{safe_bid}</code>\n\n<b>Список пользователей:</b>\n\n"
-    going, not_going, ignored = [], [], []
-
-    for uid, nick, username, choice, attended in all_users:
-        status = "✅" if attended else "⬜"
-        name = html.escape(nick or username or f"ID {uid}")
-        display = f"{status} {name}"
-        if choice == 'going':
-            going.append(display)
-        elif choice == 'not_going':
-            not_going.append(display)
-        else:
-            ignored.append(display)
-
-    counter = 1
-    if going:
-        text += f"✅ ({len(going)}):\n"
-        for display in going:
-            text += f"{counter}. {display}\n"
-            counter += 1
-        text += "\n"
-    if not_going:
-        text += f"❌ ({len(not_going)}):\n"
-        for display in not_going:
-            text += f"{counter}. {display}\n"
-            counter += 1
-        text += "\n"
-    if ignored:
-        text += f"⚠️ Проигнорировали ({len(ignored)}):\n"
-        for display in ignored:
-            text += f"{counter}. {display}\n"
-            counter += 1
-            counter += 1
-        text += "\n"
+    text += await run_db(format_attendance_list, broadcast_id, all_users)
 
     text += f"<b>Всего пользователей:</b> {len(all_users)}\n\n"
     text += "Введи номера присутствовавших в формате:\n<code>1-5-8-3-9-13</code>\n\n"
 
     keyboard = [
-        [InlineKeyboardButton("◀️ Назад к рассылке", callback_data=f'broadcast_detail_{broadcast_id}')],
+        [InlineKeyboardButton("◀️ Назад к рассылке", callback_data=pack_callback('broadcast_detail', broadcast_id))],
         [InlineKeyboardButton("❌ Закрыть", callback_data='close_stats')]
     ]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
@@ -1041,19 +2694,19 @@ async def enter_attendance_numbers(update: Update, context: ContextTypes.DEFAULT
     await query.answer()
 
 async def handle_attendance_numbers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("=== HANDLE ATTENDANCE NUMBERS ===")
     user = update.effective_user
     if user.id not in ADMIN_IDS:
-        logger.info("User not admin, skipping")
+        logger.debug("User not admin, skipping attendance numbers")
         return False
     broadcast_id = context.user_data.get('awaiting_attendance_numbers')
     if not broadcast_id:
-        logger.info("Not awaiting attendance numbers, skipping")
+        logger.debug("Not awaiting attendance numbers, skipping")
         return False
 
     numbers_text = update.message.text.strip()
     if numbers_text.lower() == '/cancel':
         context.user_data.pop('awaiting_attendance_numbers', None)
+        drop_attendance_snapshot(context)
         keyboard = [
             [InlineKeyboardButton("◀️ Назад к списку", callback_data='admin_broadcasts_list'),
              InlineKeyboardButton("❌ Закрыть", callback_data='close_stats')]
@@ -1073,22 +2726,12 @@ async def handle_attendance_numbers(update: Update, context: ContextTypes.DEFAUL
         )
         return True
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT u.user_id, u.nickname, u.username, COALESCE(v.choice, 'ignored') as choice
-        FROM users u
-        LEFT JOIN votes v ON u.user_id = v.user_id AND v.broadcast_id = ?
-        ORDER BY
-            CASE
-                WHEN v.choice = 'going' THEN 1
-                WHEN v.choice = 'not_going' THEN 2
-                ELSE 3
-            END,
-            u.nickname
-    ''', (broadcast_id,))
-    all_users = cur.fetchall()
-    conn.close()
+    # Номера — из того же снимка, что был показан админу
+    snapshot = context.user_data.get('attendance_snapshot')
+    if snapshot and snapshot['broadcast_id'] == broadcast_id:
+        all_users = snapshot['users']
+    else:
+        all_users = await get_attendance_snapshot(context, broadcast_id)
 
     if not all_users:
         await update.message.reply_text("❌ В базе нет пользователей")
@@ -1098,22 +2741,28 @@ async def handle_attendance_numbers(update: Update, context: ContextTypes.DEFAUL
     errors = 0
     marked_list = []
     not_found = []
+    to_mark = []
     for num in numbers:
         if 1 <= num <= len(all_users):
             uid, nick, username, choice = all_users[num - 1]
-            try:
-                update_user_attendance(uid, broadcast_id, True)
-                marked += 1
-                name = nick or username or f"ID {uid}"
-                safe_name = html.escape(name)
-                marked_list.append(f"  {num}. {safe_name}")
-            except Exception as e:
-                logger.error(f"Error marking attendance for user {uid}: {e}")
-                errors += 1
+            to_mark.append(uid)
+            name = nick or username or f"ID {uid}"
+            safe_name = html.escape(name)
+            marked_list.append(f"  {num}. {safe_name}")
         else:
             not_found.append(str(num))
 
+    if to_mark:
+        try:
+            await run_db(set_attendance_bulk, broadcast_id, [(uid, True) for uid in to_mark])
+            marked = len(to_mark)
+        except Exception as e:
+            logger.error("Error marking attendance for %s: %s", broadcast_id, e)
+            errors = len(to_mark)
+            marked_list = []
+
     context.user_data.pop('awaiting_attendance_numbers', None)
+    drop_attendance_snapshot(context)
     safe_bid = html.escape(broadcast_id)
     result_text = f"<b>📊 Результат отметки</b>\nРассылка: <code>{safe_bid}</code>\n\n✅ Успешно отмечено: {marked}\n"
     if marked_list:
@@ -1124,7 +2773,7 @@ async def handle_attendance_numbers(update: Update, context: ContextTypes.DEFAUL
         result_text += f"⚠️ Ошибок при отметке: {errors}\n"
 
     keyboard = [
-        [InlineKeyboardButton("◀️ К рассылке", callback_data=f'broadcast_detail_{broadcast_id}'),
+        [InlineKeyboardButton("◀️ К рассылке", callback_data=pack_callback('broadcast_detail', broadcast_id)),
          InlineKeyboardButton("📋 К списку", callback_data='admin_broadcasts_list')]
     ]
     await update.message.reply_text(result_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
@@ -1132,18 +2781,7 @@ async def handle_attendance_numbers(update: Update, context: ContextTypes.DEFAUL
 
 async def show_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT u.user_id, u.nickname, u.username, s.attended_events
-        FROM user_stats s
-        JOIN users u ON s.user_id = u.user_id
-        WHERE s.attended_events > 0
-        ORDER BY s.attended_events DESC
-        LIMIT 20
-    ''')
-    stats = cur.fetchall()
-    conn.close()
+    stats = await run_db(get_rating)
 
     if not stats:
         await query.answer("📊 Статистика пока пуста", show_alert=True)
@@ -1183,29 +2821,36 @@ async def delete_all_broadcasts(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def confirm_delete_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    admin_id = query.from_user.id
+
+    # Задания на правку сообщений создаются до удаления журнала сообщений
+    job_ids = []
+    for bid, text in await run_db(get_active_broadcasts):
+        safe_text = html.escape(text or "Без текста")
+        job_id = await run_db(
+            enqueue_edit_delivery, bid,
+            f"❌ <b>ВСЕ РАССЫЛКИ ОТМЕНЕНЫ</b>\n\n"
+            f"Событие:\n{safe_text}\n\n"
+            f"Администратор отменил все активные события.",
+            admin_id
+        )
+        if job_id:
+            job_ids.append(job_id)
+
+    await run_db(delete_all_broadcasts_data)
+    stats_refresher.forget()
+    cancel_event_jobs(context.job_queue)
+
+    if not job_ids:
+        job_ids.append(await enqueue_notice(
+            "❌ <b>ВСЕ РАССЫЛКИ ОТМЕНЕНЫ</b>\n\nАдминистратор отменил все активные события.",
+            admin_id=admin_id
+        ))
+    context.application.create_task(report_deliveries(
+        context.bot, job_ids, admin_id, "📨 Уведомления об отмене всех рассылок отправлены."
+    ))
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT text FROM broadcast_texts')
-    broadcasts = cur.fetchall()
-    cur.execute('DELETE FROM votes')
-    cur.execute('DELETE FROM stats_messages')
-    cur.execute('DELETE FROM broadcast_texts')
-    conn.commit()
-    conn.close()
-
-    users = get_all_users()
-    for uid in users:
-        try:
-            await context.bot.send_message(
-                chat_id=uid,
-                text="❌ <b>ВСЕ РАССЫЛКИ ОТМЕНЕНЫ</b>\n\nАдминистратор отменил все активные события.",
-                parse_mode='HTML'
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify {uid} about cancelled broadcasts: {e}")
-
-    await query.answer(f"✅ Все рассылки удалены, уведомлено {len(users)} пользователей", show_alert=True)
+    await query.answer("✅ Все рассылки удалены, уведомления отправляются", show_alert=True)
     keyboard = get_admin_keyboard()
     await query.edit_message_text(
         "<b>👑 Админ-панель</b>\n\nВыберите действие:",
@@ -1216,8 +2861,8 @@ async def confirm_delete_all(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def delete_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id):
     query = update.callback_query
     keyboard = [
-        [InlineKeyboardButton("✅ Да, удалить", callback_data=f'confirm_delete_{broadcast_id}'),
-         InlineKeyboardButton("❌ Нет, отмена", callback_data=f'back_to_stats_{broadcast_id}')]
+        [InlineKeyboardButton("✅ Да, удалить", callback_data=pack_callback('confirm_delete', broadcast_id)),
+         InlineKeyboardButton("❌ Нет, отмена", callback_data=pack_callback('back_to_stats', broadcast_id))]
     ]
     await query.edit_message_text(
         f"🗑 <b>Удаление рассылки</b>\n\n"
@@ -1232,30 +2877,25 @@ async def confirm_delete_broadcast(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     user_id = query.from_user.id
     try:
-        broadcast_text = get_broadcast_text(broadcast_id) or "Без текста"
+        broadcast_text = await run_db(get_broadcast_text, broadcast_id) or "Без текста"
         safe_text = html.escape(broadcast_text)
 
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute('DELETE FROM votes WHERE broadcast_id = ?', (broadcast_id,))
-        votes_deleted = cur.rowcount
-        cur.execute('DELETE FROM stats_messages WHERE broadcast_id = ?', (broadcast_id,))
-        cur.execute('DELETE FROM broadcast_texts WHERE broadcast_id = ?', (broadcast_id,))
-        conn.commit()
-        conn.close()
+        cancel_text = (
+            f"❌ <b>РАССЫЛКА ОТМЕНЕНА</b>\n\n"
+            f"Событие:\n{safe_text}\n\n"
+            f"Администратор отменил это событие."
+        )
+        job_id = await run_db(enqueue_edit_delivery, broadcast_id, cancel_text, user_id)
 
-        users = get_all_users()
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=f"❌ <b>РАССЫЛКА ОТМЕНЕНА</b>\n\n"
-                         f"Событие:\n{safe_text}\n\n"
-                         f"Администратор отменил это событие.",
-                    parse_mode='HTML'
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify {uid} about cancelled broadcast: {e}")
+        votes_deleted = await run_db(delete_broadcast_data, broadcast_id)
+        stats_refresher.forget(broadcast_id)
+        cancel_event_jobs(context.job_queue, broadcast_id)
+
+        if not job_id:
+            job_id = await enqueue_notice(cancel_text, broadcast_id, user_id)
+        context.application.create_task(report_deliveries(
+            context.bot, [job_id], user_id, f"📨 Уведомления об отмене рассылки {broadcast_id} отправлены."
+        ))
 
         try:
             await query.delete_message()
@@ -1268,18 +2908,17 @@ async def confirm_delete_broadcast(update: Update, context: ContextTypes.DEFAULT
             chat_id=user_id,
             text=f"✅ Рассылка <code>{safe_bid}</code> успешно удалена!\n"
                  f"Удалено голосов: {votes_deleted}\n"
-                 f"Уведомлено пользователей: {len(users)}",
+                 f"Уведомления отправляются, итог придёт отдельным сообщением.",
             reply_markup=keyboard,
             parse_mode='HTML'
         )
         await query.answer()
     except Exception as e:
-        logger.error(f"Error deleting broadcast {broadcast_id}: {e}")
+        logger.error("Error deleting broadcast %s: %s", broadcast_id, e)
         await query.answer("❌ Ошибка при удалении", show_alert=True)
 
 # ========================== ФОНОВЫЕ ЗАДАЧИ ==========================
 async def send_reminder(context: ContextTypes.DEFAULT_TYPE, broadcast_id, text, event_time):
-    users = get_all_users()
     try:
         dt = datetime.fromisoformat(event_time)
         time_str = dt.strftime("%d.%m.%Y в %H:%M")
@@ -1289,78 +2928,115 @@ async def send_reminder(context: ContextTypes.DEFAULT_TYPE, broadcast_id, text,
     safe_text = html.escape(text)
     safe_time = html.escape(time_str)
 
-    for uid in users:
-        try:
-            await context.bot.send_message(
-                chat_id=uid,
-                text=f"⏰ <b>НАПОМИНАНИЕ</b>\n\n"
-                     f"Через 30 минут начинается событие:\n"
-                     f"📢 {safe_text}\n\n"
-                     f"🕒 Время начала: {safe_time}\n\n"
-                     f"Если ты ещё не выбрал вариант — самое время!",
-                parse_mode='HTML'
-            )
-        except Exception as e:
-            logger.error(f"Failed to send reminder to {uid}: {e}")
+    result = await notify_users(
+        context.bot,
+        f"⏰ <b>НАПОМИНАНИЕ</b>\n\n"
+        f"Через 30 минут начинается событие:\n"
+        f"📢 {safe_text}\n\n"
+        f"🕒 Время начала: {safe_time}\n\n"
+        f"Если ты ещё не выбрал вариант — самое время!",
+        broadcast_id
+    )
 
     for admin in ADMIN_IDS:
         try:
             await context.bot.send_message(
                 chat_id=admin,
-                text=f"✅ Напоминание о событии `{broadcast_id}` отправлено {len(users)} пользователям!"
+                text=f"✅ Напоминание о событии `{broadcast_id}` отправлено {result.delivered} пользователям!"
             )
         except Exception:
             pass
 
+# Напоминание и закрытие голосования планируются точными разовыми задачами при создании
+# рассылки; редкий обход по БД страхует от пропусков (перезапуск, опоздавшая задача).
+REMINDER_LEAD = timedelta(minutes=30)
+REMINDER_GRACE = timedelta(minutes=10)
+EVENT_SWEEP_INTERVAL = int(os.environ.get('EVENT_SWEEP_INTERVAL', '300'))
+
+def schedule_event_jobs(job_queue, broadcast_id, event_time, reminder_sent=False):
+    """Ставит задачи reminder_<id> и expiry_<id> на время события."""
+    if job_queue is None or not event_time:
+        return
+    try:
+        event_dt = datetime.fromisoformat(event_time)
+    except (ValueError, TypeError):
+        return
+    cancel_event_jobs(job_queue, broadcast_id)
+    now = datetime.now()
+    if not reminder_sent and event_dt - REMINDER_LEAD > now:
+        job_queue.run_once(reminder_job, when=event_dt - REMINDER_LEAD - now,
+                           data=broadcast_id, name=f'reminder_{broadcast_id}')
+    job_queue.run_once(expiry_job, when=max(event_dt - now, timedelta(0)),
+                       data=broadcast_id, name=f'expiry_{broadcast_id}')
+
+def cancel_event_jobs(job_queue, broadcast_id=None):
+    """Снимает задачи по рассылке (или по всем рассылкам)."""
+    if job_queue is None:
+        return
+    for job in job_queue.jobs():
+        name = job.name or ''
+        if broadcast_id is None:
+            if name.startswith(('reminder_', 'expiry_')):
+                job.schedule_removal()
+        elif name in (f'reminder_{broadcast_id}', f'expiry_{broadcast_id}'):
+            job.schedule_removal()
+
+@timed('job')
+async def schedule_pending_events(context: ContextTypes.DEFAULT_TYPE):
+    """Восстанавливает задачи по событиям из БД после перезапуска."""
+    events = await run_db(get_scheduled_events, datetime.now())
+    for bid, event_time, reminder_sent in events:
+        schedule_event_jobs(context.job_queue, bid, event_time, reminder_sent)
+    logger.info("Scheduled reminder/expiry jobs for %s events", len(events))
+
+@timed('job')
+async def reminder_job(context: ContextTypes.DEFAULT_TYPE):
+    bid = context.job.data
+    # Отмечаем до отправки: недоставленное после перезапуска доотправит очередь доставки
+    if not await run_db(mark_reminder_sent, bid):
+        return
+    info = await run_db(get_broadcast_info, bid)
+    if info:
+        await send_reminder(context, bid, info['text'], info['event_time'])
+
+@timed('job')
+async def expiry_job(context: ContextTypes.DEFAULT_TYPE):
+    bid = context.job.data
+    if not await run_db(mark_expired_notified, bid):
+        return
+    info = await run_db(get_broadcast_info, bid)
+    if info:
+        await notify_event_started(context, bid, info['text'])
+
+async def notify_event_started(context: ContextTypes.DEFAULT_TYPE, broadcast_id, text):
+    safe_text = html.escape(text)
+    await close_broadcast_messages(
+        context.bot, broadcast_id,
+        f"⏰ <b>СОБЫТИЕ НАЧАЛОСЬ</b>\n\n"
+        f"📢 {safe_text}\n\n"
+        f"Голосование закрыто!"
+    )
+    logger.info("Event %s has started, notifications sent", broadcast_id)
+
+@timed('job')
 async def check_reminders(context: ContextTypes.DEFAULT_TYPE):
-    conn = get_connection()
-    cur = conn.cursor()
+    """Страховочный обход: напоминания, чьё время уже наступило, но задача не отработала."""
     now = datetime.now()
-    reminder_time = now + timedelta(minutes=30)
-    reminder_end = reminder_time + timedelta(minutes=1)
-    cur.execute('''
-        SELECT broadcast_id, text, event_time FROM broadcast_texts
-        WHERE event_time IS NOT NULL
-        AND reminder_sent = 0
-        AND datetime(event_time) BETWEEN datetime(?) AND datetime(?)
-    ''', (reminder_time.isoformat(), reminder_end.isoformat()))
-    events = cur.fetchall()
-    conn.close()
+    events = await run_db(get_due_reminders, now + REMINDER_LEAD - REMINDER_GRACE, now + REMINDER_LEAD)
     for bid, text, etime in events:
-        await send_reminder(context, bid, text, etime)
-        mark_reminder_sent(bid)
+        if await run_db(mark_reminder_sent, bid):
+            await send_reminder(context, bid, text, etime)
 
+@timed('job')
 async def check_expired_events(context: ContextTypes.DEFAULT_TYPE):
-    conn = get_connection()
-    cur = conn.cursor()
-    now = datetime.now()
-    cur.execute('''
-        SELECT broadcast_id, text FROM broadcast_texts
-        WHERE event_time IS NOT NULL
-        AND expired_notified = 0
-        AND datetime(event_time) < datetime(?)
-    ''', (now.isoformat(),))
-    expired = cur.fetchall()
+    """Страховочный обход: начавшиеся события, по которым не закрыто голосование."""
+    expired = await run_db(get_expired_events, datetime.now())
     for bid, text in expired:
-        users = get_all_users()
-        safe_text = html.escape(text)
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=f"⏰ <b>СОБЫТИЕ НАЧАЛОСЬ</b>\n\n"
-                         f"📢 {safe_text}\n\n"
-                         f"Голосование закрыто!",
-                    parse_mode='HTML'
-                )
-            except Exception:
-                pass
-        cur.execute('UPDATE broadcast_texts SET expired_notified = 1 WHERE broadcast_id = ?', (bid,))
-        conn.commit()
-        logger.info(f"Event {bid} has started, notifications sent")
-    conn.close()
+        if await run_db(mark_expired_notified, bid):
+            await notify_event_started(context, bid, text)
 
 # ========================== ОБРАБОТЧИКИ КОМАНД ==========================
+@timed('command')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = get_verify_keyboard()
     await update.message.reply_text(
@@ -1369,6 +3045,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=keyboard
     )
 
+@timed('command')
 async def verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "<b>📱 Верификация теперь происходит по-новому!</b>\n\n"
@@ -1377,6 +3054,7 @@ async def verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
 
+@timed('command')
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in ADMIN_IDS:
@@ -1389,8 +3067,63 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
 
+@timed('command')
+async def recalc_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У тебя нет доступа к этой команде.")
+        return
+    await update.message.reply_text("🔄 Сверяю статистику...")
+    fixed = await run_db(recalc_all_stats)
+    if fixed:
+        await update.message.reply_text(f"✅ Исправлено записей статистики: {fixed}.")
+    else:
+        await update.message.reply_text("✅ Статистика в порядке, расхождений нет.")
+
+@timed('command')
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У тебя нет доступа к этой команде.")
+        return
+    await update.message.reply_text(format_metrics_summary(), parse_mode='HTML')
+
+@timed('command')
+async def sqltrace_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/sqltrace [on [мс] | off | reset] — трассировка SQL и самые затратные запросы."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У тебя нет доступа к этой команде.")
+        return
+    args = context.args or []
+    action = args[0].lower() if args else ''
+    if action == 'on':
+        if len(args) > 1:
+            try:
+                sql_tracer.slow_ms = float(args[1])
+            except ValueError:
+                await update.message.reply_text("❌ Порог задаётся в миллисекундах: /sqltrace on 50")
+                return
+        sql_tracer.enabled = True
+    elif action == 'off':
+        sql_tracer.enabled = False
+    elif action == 'reset':
+        sql_tracer.reset()
+    elif action:
+        await update.message.reply_text("Использование: /sqltrace [on [мс] | off | reset]")
+        return
+
+    state = "включена" if sql_tracer.enabled else "выключена"
+    text = f"<b>🔍 Трассировка SQL {state}</b>, порог медленных запросов {sql_tracer.slow_ms:g} мс\n\n"
+    top = sql_tracer.top()
+    if top:
+        lines = []
+        for sql, count, total, longest in top:
+            lines.append(f"{count:>6} × сумма {total * 1000:.1f} мс, макс {longest * 1000:.1f} мс\n  {sql[:150]}")
+        text += "<pre>" + html.escape("\n".join(lines)) + "</pre>"
+    else:
+        text += "<i>Запросов пока нет</i>"
+    await update.message.reply_text(text, parse_mode='HTML')
+
+@timed('command')
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("=== НАЧАЛО ФУНКЦИИ BROADCAST ===")
     user_id = update.effective_user.id
     if user_id not in ADMIN_IDS:
         await update.message.reply_text("У тебя нет прав на рассылку.")
@@ -1399,44 +3132,27 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Использование: /broadcast <текст сообщения>")
         return
     broadcast_text = " ".join(context.args)
-    broadcast_id = str(uuid.uuid4())[:8]
+    broadcast_id = uuid.uuid4().hex
     context.user_data['current_broadcast_id'] = broadcast_id
     keyboard = [
-        [InlineKeyboardButton("✅", callback_data=f'going_{broadcast_id}'),
-         InlineKeyboardButton("❌", callback_data=f'not_going_{broadcast_id}')]
+        [InlineKeyboardButton("✅", callback_data=pack_callback('going', broadcast_id)),
+         InlineKeyboardButton("❌", callback_data=pack_callback('not_going', broadcast_id))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     users = get_all_users()
     if not users:
         await update.message.reply_text("В базе нет верифицированных пользователей.")
         return
-    await update.message.reply_text(f"📢 Начинаю рассылку для {len(users)} пользователей...")
-    successful = 0
-    failed = 0
+    await run_db(save_broadcast_text, broadcast_id, broadcast_text)
+    status_message = await update.message.reply_text(f"📢 Начинаю рассылку для {len(users)} пользователей...")
     safe_text = html.escape(broadcast_text)
-    for uid in users:
-        try:
-            await context.bot.send_message(
-                chat_id=uid,
-                text=f"📢 <b>РАССЫЛКА КЛАНА:</b>\n\n{safe_text}\n\nВыбери свой вариант:",
-                reply_markup=reply_markup,
-                parse_mode='HTML'
-            )
-            successful += 1
-        except Exception as e:
-            logger.error(f"Failed to send to {uid}: {e}")
-            failed += 1
-    stats_text = get_formatted_stats(broadcast_id)
-    stats_message = await context.bot.send_message(
-        chat_id=user_id,
-        text=stats_text,
-        reply_markup=get_stats_keyboard(broadcast_id),
-        parse_mode='HTML'
-    )
-    save_stats_message(broadcast_id, user_id, stats_message.message_id)
-    await update.message.reply_text(f"✅ Рассылка завершена. Успешно: {successful}, Ошибок: {failed}")
-    logger.info("=== КОНЕЦ ФУНКЦИИ BROADCAST ===")
+    context.application.create_task(send_broadcast(
+        context, user_id, broadcast_id,
+        f"📢 <b>РАССЫЛКА КЛАНА:</b>\n\n{safe_text}\n\nВыбери свой вариант:",
+        reply_markup, users, status_message
+    ), update=update)
 
+@timed('message')
 async def track_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != CLAN_CHAT_ID:
         return
@@ -1444,8 +3160,8 @@ async def track_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE)
         left_user = update.message.left_chat_member
         user_id = left_user.id
         if is_user_verified(user_id):
-            remove_user(user_id)
-            logger.info(f"User {user_id} left clan chat. Removed from broadcast list.")
+            await run_db(remove_user, user_id)
+            logger.info("User %s left clan chat. Removed from broadcast list.", user_id)
             for admin in ADMIN_IDS:
                 try:
                     await context.bot.send_message(
@@ -1455,476 +3171,475 @@ async def track_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 except Exception:
                     pass
 
+@timed('command')
 async def me_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not is_user_verified(user.id):
         await update.message.reply_text("❌ Ты ещё не верифицирован. Используй /start для верификации.")
         return
 
-    nickname = get_user_nickname(user.id) or "Не указан"
+    nickname = await run_db(get_user_nickname, user.id) or "Не указан"
     safe_nickname = html.escape(nickname)
-    attended = get_user_attended_count(user.id)
+    attended = await run_db(get_user_attended_count, user.id)
     text = "<b>👤 Твой профиль</b>\n\n"
     text += f"🎮 Ник в игре: <b>{safe_nickname}</b>\n"
     text += f"📊 Посещено мероприятий: <b>{attended}</b>\n"
 
-    await update.message.reply_text(text, reply_markup=get_me_keyboard(user.id), parse_mode='HTML')
+    await update.message.reply_text(text, reply_markup=await run_db(get_me_keyboard, user.id), parse_mode='HTML')
 
 # ========================== ОСНОВНОЙ CALLBACK-ОБРАБОТЧИК ==========================
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user = query.from_user
-    callback_data = query.data
-
-    logger.info(f"Callback received: {callback_data} from user {user.id}")
-    logger.info(f"Current user_data keys: {list(context.user_data.keys())}")
-
-    # -------------------- КНОПКИ ПРОФИЛЯ --------------------
-    if callback_data == 'change_nickname':
-        await change_nickname_start(update, context)
-        return
-    if callback_data == 'nickname_cooldown':
-        can, remaining = can_change_nickname(user.id)
-        hours = remaining // 3600
-        minutes = (remaining % 3600) // 60
-        time_str = f"{hours}ч {minutes}м" if hours else f"{minutes}м"
-        await query.answer(f"⏳ Сменить ник можно будет через {time_str}.", show_alert=True)
-        return
-    if callback_data == 'my_broadcasts':
-        await my_broadcasts_list(update, context)
-        return
-    if callback_data.startswith('my_broadcasts_page_'):
-        page = int(callback_data.split('_')[-1])
-        await my_broadcasts_list(update, context, page)
-        return
-    if callback_data.startswith('my_broadcast_detail_'):
-        bid = callback_data.replace('my_broadcast_detail_', '')
-        await my_broadcast_detail(update, context, bid)
-        return
-    if callback_data == 'back_to_me':
-        nickname = get_user_nickname(user.id) or "Не указан"
-        safe_nickname = html.escape(nickname)
-        attended = get_user_attended_count(user.id)
-        text = "<b>👤 Твой профиль</b>\n\n"
-        text += f"🎮 Ник в игре: <b>{safe_nickname}</b>\n"
-        text += f"📊 Посещено мероприятий: <b>{attended}</b>\n"
-        await query.edit_message_text(text, reply_markup=get_me_keyboard(user.id), parse_mode='HTML')
-        await query.answer()
-        return
+class CallbackRouter:
+    """Маршрутизация callback_data: точное совпадение, затем пространство имён.
+
+    Данные v1 ('1' + код операции + аргумент) ищутся по коду операции, старые
+    данные вида '<namespace>_<arg>' — по namespace = data.rpartition('_')[0].
+    Все поиски по словарю, O(1).
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._prefix = {}
+        self._ops = {}
+        self.fallback = None
+
+    def exact(self, data, admin_only=False):
+        def decorator(handler):
+            self._exact[data] = (handler, admin_only)
+            return handler
+        return decorator
+
+    def prefix(self, namespace, admin_only=False):
+        def decorator(handler):
+            self._prefix[namespace] = (handler, admin_only)
+            if namespace in CALLBACK_OPS:
+                op, is_id = CALLBACK_OPS[namespace]
+                self._ops[op] = (handler, admin_only, is_id)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        """(handler, admin_only, arg) или None."""
+        if data[:1] == CALLBACK_VERSION:
+            route = self._ops.get(data[1:2])
+            if route is None:
+                return None
+            handler, admin_only, is_id = route
+            arg = data[2:]
+            if not arg:
+                return None
+            if is_id:
+                try:
+                    arg = unpack_id(arg)
+                except ValueError:
+                    return None
+            return handler, admin_only, arg
+        route = self._exact.get(data)
+        if route is not None:
+            return route[0], route[1], None
+        namespace, _, arg = data.rpartition('_')
+        route = self._prefix.get(namespace)
+        if route is not None:
+            return route[0], route[1], arg
+        return None
 
-    # -------------------- АДМИНСКИЕ КНОПКИ --------------------
-    if user.id in ADMIN_IDS:
-        if callback_data == 'admin_broadcast':
-            await query.answer()
-            await query.edit_message_text(
-                "<b>📝 Создание рассылки</b>\n\n"
-                "Отправь мне текст, который хочешь разослать всем верифицированным пользователям.\n\n"
-                "❌ Для отмены отправь /cancel",
-                parse_mode='HTML'
-            )
-            context.user_data['awaiting_broadcast'] = True
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        data = query.data or ''
+        logger.debug("Callback %s from user %s", data, query.from_user.id)
+        route = self.resolve(data)
+        if route is None:
+            metrics.inc('clanbot_callback_unknown_total')
+            await self.fallback(update, context, data)
             return
-
-        if callback_data == 'admin_broadcast_event':
-            await query.answer()
-            await query.edit_message_text(
-                "<b>📅 Создание рассылки с событием</b>\n\n"
-                "Шаг 1/3: Отправь текст рассылки:\n\n"
-                "❌ /cancel — отмена",
-                parse_mode='HTML'
-            )
-            context.user_data['broadcast_step'] = 1
+        handler, admin_only, arg = route
+        if admin_only and query.from_user.id not in ADMIN_IDS:
+            await query.answer("❌ Нет доступа!", show_alert=True)
             return
+        start = time.perf_counter()
+        try:
+            await handler(update, context, arg)
+        except Exception:
+            metrics.inc('clanbot_handler_errors_total', kind='callback', name=handler.__name__)
+            raise
+        finally:
+            metrics.observe('clanbot_handler_seconds', time.perf_counter() - start, kind='callback', name=handler.__name__)
 
-        if callback_data == 'admin_stats':
-            await query.answer()
-            users_count = len(get_all_users())
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT COUNT(*) FROM stats_messages")
-            broadcasts_count = cur.fetchone()[0]
-            conn.close()
-            await query.edit_message_text(
-                f"<b>📊 Статистика бота</b>\n\n"
-                f"👥 Верифицированных пользователей: {users_count}\n"
-                f"📢 Всего рассылок: {broadcasts_count}",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='admin_back')]]),
-                parse_mode='HTML'
-            )
-            return
+callbacks = CallbackRouter()
 
-        if callback_data == 'admin_users' or callback_data.startswith('admin_users_'):
-            await query.answer()
-            page = 1
-            if callback_data.startswith('admin_users_'):
-                try:
-                    page = int(callback_data.split('_')[-1])
-                except (ValueError, IndexError):
-                    page = 1
-            per_page = 15
-            offset = (page - 1) * per_page
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT COUNT(*) FROM users")
-            total = cur.fetchone()[0]
-            cur.execute("""
-                SELECT first_name, username, nickname, verified_at
-                FROM users
-                ORDER BY verified_at DESC
-                LIMIT ? OFFSET ?
-            """, (per_page, offset))
-            users = cur.fetchall()
-            conn.close()
-            if not users:
-                text = "📭 Нет верифицированных пользователей" if page == 1 else "📭 Страница пуста"
-            else:
-                text = f"<b>👥 Пользователи ({total})</b> - Страница {page}\n\n"
-                for i, (first_name, username, nickname, verified_at) in enumerate(users, offset + 1):
-                    name = nickname or first_name or "Unknown"
-                    safe_name = html.escape(name)
-                    safe_username = html.escape(username) if username else None
-                    line = f"{i}. 👤 {safe_name}"
-                    if safe_username:
-                        line += f" (@{safe_username})"
-                    if verified_at:
-                        line += f" (с {verified_at[:10]})"
-                    text += line + "\n"
-            keyboard = []
-            nav = []
-            if page > 1:
-                nav.append(InlineKeyboardButton("◀️", callback_data=f'admin_users_{page - 1}'))
-            if offset + per_page < total:
-                nav.append(InlineKeyboardButton("▶️", callback_data=f'admin_users_{page + 1}'))
-            if nav:
-                keyboard.append(nav)
-            keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data='admin_back')])
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
-            return
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await callbacks.dispatch(update, context)
 
-        if callback_data == 'admin_back':
-            await query.answer()
-            await query.edit_message_text(
-                "<b>👑 Админ-панель</b>\n\nВыберите действие:",
-                reply_markup=get_admin_keyboard(),
-                parse_mode='HTML'
-            )
-            return
+# -------------------- КНОПКИ ПРОФИЛЯ --------------------
+@callbacks.exact('change_nickname')
+async def cb_change_nickname(update, context, _):
+    await change_nickname_start(update, context)
 
-        if callback_data == 'admin_close':
-            await query.answer()
-            await query.delete_message()
-            return
+@callbacks.exact('nickname_cooldown')
+async def cb_nickname_cooldown(update, context, _):
+    query = update.callback_query
+    can, remaining = await run_db(can_change_nickname, query.from_user.id)
+    hours = remaining // 3600
+    minutes = (remaining % 3600) // 60
+    time_str = f"{hours}ч {minutes}м" if hours else f"{minutes}м"
+    await query.answer(f"⏳ Сменить ник можно будет через {time_str}.", show_alert=True)
+
+@callbacks.exact('my_broadcasts')
+async def cb_my_broadcasts(update, context, _):
+    await my_broadcasts_list(update, context)
+
+@callbacks.prefix('my_broadcasts_page')
+async def cb_my_broadcasts_page(update, context, cursor):
+    await my_broadcasts_list(update, context, cursor)
+
+@callbacks.prefix('my_broadcast_detail')
+async def cb_my_broadcast_detail(update, context, bid):
+    await my_broadcast_detail(update, context, bid)
+
+@callbacks.exact('back_to_me')
+async def cb_back_to_me(update, context, _):
+    query = update.callback_query
+    user = query.from_user
+    nickname = await run_db(get_user_nickname, user.id) or "Не указан"
+    safe_nickname = html.escape(nickname)
+    attended = await run_db(get_user_attended_count, user.id)
+    text = "<b>👤 Твой профиль</b>\n\n"
+    text += f"🎮 Ник в игре: <b>{safe_nickname}</b>\n"
+    text += f"📊 Посещено мероприятий: <b>{attended}</b>\n"
+    await query.edit_message_text(text, reply_markup=await run_db(get_me_keyboard, user.id), parse_mode='HTML')
+    await query.answer()
 
-        if callback_data == 'admin_broadcasts_list':
-            await query.answer()
-            await show_broadcasts_list(update, context)
-            return
+# -------------------- АДМИНСКИЕ КНОПКИ --------------------
+@callbacks.exact('admin_broadcast', admin_only=True)
+async def cb_admin_broadcast(update, context, _):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(
+        "<b>📝 Создание рассылки</b>\n\n"
+        "Отправь мне текст, который хочешь разослать всем верифицированным пользователям.\n\n"
+        "❌ Для отмены отправь /cancel",
+        parse_mode='HTML'
+    )
+    context.user_data['awaiting_broadcast'] = True
 
-        if callback_data == 'admin_rating':
-            await query.answer()
-            await show_rating(update, context)
-            return
+@callbacks.exact('admin_broadcast_event', admin_only=True)
+async def cb_admin_broadcast_event(update, context, _):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(
+        "<b>📅 Создание рассылки с событием</b>\n\n"
+        "Шаг 1/3: Отправь текст рассылки:\n\n"
+        "❌ /cancel — отмена",
+        parse_mode='HTML'
+    )
+    context.user_data['broadcast_step'] = 1
 
-        if callback_data == 'admin_reset_stats':
-            await query.answer()
-            keyboard = [
-                [InlineKeyboardButton("✅ Да, сбросить всё", callback_data='confirm_reset_stats'),
-                 InlineKeyboardButton("❌ Нет", callback_data='admin_back')]
-            ]
-            await query.edit_message_text(
-                "<b>⚠️ Сброс статистики</b>\n\n"
-                "Это удалит ВСЮ историю активности и рейтинги.\n"
-                "Пользователи останутся в базе.\n\n"
-                "Точно продолжить?",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='HTML'
-            )
-            return
+@callbacks.exact('admin_stats', admin_only=True)
+async def cb_admin_stats(update, context, _):
+    query = update.callback_query
+    await query.answer()
+    users_count = len(get_all_users())
+    broadcasts_count = await run_db(count_broadcasts)
+    await query.edit_message_text(
+        f"<b>📊 Статистика бота</b>\n\n"
+        f"👥 Верифицированных пользователей: {users_count}\n"
+        f"📢 Всего рассылок: {broadcasts_count}",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='admin_back')]]),
+        parse_mode='HTML'
+    )
 
-        if callback_data == 'confirm_reset_stats':
-            await query.answer()
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute('DELETE FROM user_activity')
-            cur.execute('DELETE FROM user_stats')
-            cur.execute('DELETE FROM votes')
-            cur.execute('DELETE FROM stats_messages')
-            cur.execute('DELETE FROM broadcast_texts')
-            conn.commit()
-            conn.close()
-            users = get_all_users()
-            for uid in users:
-                try:
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text="❌ <b>СТАТИСТИКА СБРОШЕНА</b>\n\nАдминистратор сбросил всю статистику. Все активные рассылки отменены.",
-                        parse_mode='HTML'
-                    )
-                except Exception:
-                    pass
-            await query.answer(f"✅ Статистика полностью сброшена, уведомлено {len(users)} пользователей", show_alert=True)
-            await query.edit_message_text(
-                "<b>👑 Админ-панель</b>\n\nСтатистика сброшена!",
-                reply_markup=get_admin_keyboard(),
-                parse_mode='HTML'
-            )
-            return
+@callbacks.exact('admin_users', admin_only=True)
+@callbacks.prefix('admin_users', admin_only=True)
+async def cb_admin_users(update, context, cursor):
+    query = update.callback_query
+    await query.answer()
+    per_page = 15
+    page, anchor, before = parse_page_cursor(cursor, int)
+    total, users, has_more = await run_db(get_users_page, per_page, anchor, before)
+    if not users and anchor is not None:
+        page, anchor, before = 1, None, False
+        total, users, has_more = await run_db(get_users_page, per_page)
+    has_prev, has_next = page_flags(anchor, before, has_more)
+    if not has_prev:
+        page = 1
+    offset = (page - 1) * per_page
+    if not users:
+        text = "📭 Нет верифицированных пользователей"
+    else:
+        text = f"<b>👥 Пользователи ({total})</b> - Страница {page}\n\n"
+        for i, (_, first_name, username, nickname, verified_at) in enumerate(users, offset + 1):
+            name = nickname or first_name or "Unknown"
+            safe_name = html.escape(name)
+            safe_username = html.escape(username) if username else None
+            line = f"{i}. 👤 {safe_name}"
+            if safe_username:
+                line += f" (@{safe_username})"
+            if verified_at:
+                line += f" (с {verified_at[:10]})"
+            text += line + "\n"
+    keyboard = []
+    nav = get_page_nav('admin_users', page, users[0][0], users[-1][0], has_prev, has_next) if users else []
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data='admin_back')])
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
 
-        if callback_data.startswith('broadcasts_page_'):
-            await query.answer()
-            await show_broadcasts_list(update, context)
-            return
+@callbacks.exact('admin_back', admin_only=True)
+async def cb_admin_back(update, context, _):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(
+        "<b>👑 Админ-панель</b>\n\nВыберите действие:",
+        reply_markup=get_admin_keyboard(),
+        parse_mode='HTML'
+    )
 
-        if callback_data.startswith('select_broadcast_'):
-            await query.answer()
-            broadcast_id = callback_data.replace('select_broadcast_', '')
-            await show_broadcast_detail(update, context, broadcast_id)
-            return
+@callbacks.exact('admin_close', admin_only=True)
+@callbacks.exact('close_stats', admin_only=True)
+async def cb_close(update, context, _):
+    query = update.callback_query
+    await query.answer()
+    await query.delete_message()
 
-        if callback_data.startswith('broadcast_detail_'):
-            await query.answer()
-            broadcast_id = callback_data.replace('broadcast_detail_', '')
-            await show_broadcast_detail(update, context, broadcast_id)
-            return
+@callbacks.exact('admin_broadcasts_list', admin_only=True)
+@callbacks.prefix('broadcasts_page', admin_only=True)
+async def cb_broadcasts_list(update, context, cursor):
+    await update.callback_query.answer()
+    await show_broadcasts_list(update, context, cursor)
 
-        if callback_data.startswith('mark_attendance_'):
-            await query.answer()
-            broadcast_id = callback_data.replace('mark_attendance_', '')
-            await mark_attendance(update, context, broadcast_id)
-            return
+@callbacks.exact('admin_rating', admin_only=True)
+async def cb_admin_rating(update, context, _):
+    await update.callback_query.answer()
+    await show_rating(update, context)
 
-        if callback_data.startswith('attend_all_'):
-            await query.answer()
-            broadcast_id = callback_data.replace('attend_all_', '')
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute('SELECT user_id FROM users')
-            users = cur.fetchall()
-            conn.close()
-            for (uid,) in users:
-                update_user_attendance(uid, broadcast_id, True)
-            await query.answer("✅ Все отмечены присутствующими", show_alert=True)
-            await show_broadcast_detail(update, context, broadcast_id)
-            return
+@callbacks.exact('admin_reset_stats', admin_only=True)
+async def cb_admin_reset_stats(update, context, _):
+    query = update.callback_query
+    await query.answer()
+    keyboard = [
+        [InlineKeyboardButton("✅ Да, сбросить всё", callback_data='confirm_reset_stats'),
+         InlineKeyboardButton("❌ Нет", callback_data='admin_back')]
+    ]
+    await query.edit_message_text(
+        "<b>⚠️ Сброс статистики</b>\n\n"
+        "Это удалит ВСЮ историю активности и рейтинги.\n"
+        "Пользователи останутся в базе.\n\n"
+        "Точно продолжить?",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='HTML'
+    )
 
-        if callback_data.startswith('unattend_all_'):
-            await query.answer()
-            broadcast_id = callback_data.replace('unattend_all_', '')
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute('SELECT user_id FROM users')
-            users = cur.fetchall()
-            conn.close()
-            for (uid,) in users:
-                update_user_attendance(uid, broadcast_id, False)
-            await query.answer("✅ Отметки сброшены у всех", show_alert=True)
-            await show_broadcast_detail(update, context, broadcast_id)
-            return
+@callbacks.exact('confirm_reset_stats', admin_only=True)
+async def cb_confirm_reset_stats(update, context, _):
+    query = update.callback_query
+    admin_id = query.from_user.id
+    await run_db(reset_all_stats)
+    stats_refresher.forget()
+    cancel_event_jobs(context.job_queue)
+    job_id = await enqueue_notice(
+        "❌ <b>СТАТИСТИКА СБРОШЕНА</b>\n\nАдминистратор сбросил всю статистику. Все активные рассылки отменены.",
+        admin_id=admin_id
+    )
+    context.application.create_task(report_deliveries(
+        context.bot, [job_id], admin_id, "📨 Уведомления о сбросе статистики отправлены."
+    ))
+    await query.answer("✅ Статистика полностью сброшена, уведомления отправляются", show_alert=True)
+    await query.edit_message_text(
+        "<b>👑 Админ-панель</b>\n\nСтатистика сброшена!",
+        reply_markup=get_admin_keyboard(),
+        parse_mode='HTML'
+    )
 
-        if callback_data.startswith('enter_numbers_'):
-            await query.answer()
-            broadcast_id = callback_data.replace('enter_numbers_', '')
-            await enter_attendance_numbers(update, context, broadcast_id)
-            return
+@callbacks.prefix('select_broadcast', admin_only=True)
+@callbacks.prefix('broadcast_detail', admin_only=True)
+async def cb_broadcast_detail(update, context, broadcast_id):
+    await update.callback_query.answer()
+    await show_broadcast_detail(update, context, broadcast_id)
 
-        if callback_data == 'delete_all_broadcasts':
-            await query.answer()
-            await delete_all_broadcasts(update, context)
-            return
+@callbacks.prefix('mark_attendance', admin_only=True)
+async def cb_mark_attendance(update, context, broadcast_id):
+    await update.callback_query.answer()
+    await mark_attendance(update, context, broadcast_id)
 
-        if callback_data == 'confirm_delete_all':
-            await query.answer()
-            await confirm_delete_all(update, context)
-            return
+@callbacks.prefix('attend_all', admin_only=True)
+async def cb_attend_all(update, context, broadcast_id):
+    query = update.callback_query
+    await query.answer()
+    await run_db(set_attendance_for_all, broadcast_id, True)
+    drop_attendance_snapshot(context)
+    await query.answer("✅ Все отмечены присутствующими", show_alert=True)
+    await show_broadcast_detail(update, context, broadcast_id)
 
-    # -------------------- КНОПКИ СТАТИСТИКИ (доступны админам) --------------------
-    if callback_data.startswith('refresh_stats_'):
-        await query.answer()
-        broadcast_id = callback_data.replace('refresh_stats_', '')
-        stats_text = get_formatted_stats(broadcast_id)
-        try:
-            await query.edit_message_text(stats_text, reply_markup=get_stats_keyboard(broadcast_id), parse_mode='HTML')
-            await query.answer("✅ Статистика обновлена!")
-        except Exception as e:
-            if "Message is not modified" in str(e):
-                await query.answer("📊 Статистика актуальна")
-            else:
-                logger.error(f"Error refreshing stats: {e}")
-        return
+@callbacks.prefix('unattend_all', admin_only=True)
+async def cb_unattend_all(update, context, broadcast_id):
+    query = update.callback_query
+    await query.answer()
+    await run_db(set_attendance_for_all, broadcast_id, False)
+    drop_attendance_snapshot(context)
+    await query.answer("✅ Отметки сброшены у всех", show_alert=True)
+    await show_broadcast_detail(update, context, broadcast_id)
+
+@callbacks.prefix('enter_numbers', admin_only=True)
+async def cb_enter_numbers(update, context, broadcast_id):
+    await update.callback_query.answer()
+    await enter_attendance_numbers(update, context, broadcast_id)
+
+@callbacks.exact('delete_all_broadcasts', admin_only=True)
+async def cb_delete_all_broadcasts(update, context, _):
+    await update.callback_query.answer()
+    await delete_all_broadcasts(update, context)
+
+@callbacks.exact('confirm_delete_all', admin_only=True)
+async def cb_confirm_delete_all(update, context, _):
+    await update.callback_query.answer()
+    await confirm_delete_all(update, context)
+
+# -------------------- КНОПКИ СТАТИСТИКИ (доступны админам) --------------------
+@callbacks.prefix('refresh_stats', admin_only=True)
+async def cb_refresh_stats(update, context, broadcast_id):
+    query = update.callback_query
+    await query.answer()
+    stats_text = await run_db(get_formatted_stats, broadcast_id)
+    try:
+        await query.edit_message_text(stats_text, reply_markup=get_stats_keyboard(broadcast_id), parse_mode='HTML')
+        await query.answer("✅ Статистика обновлена!")
+    except Exception as e:
+        if "Message is not modified" in str(e):
+            await query.answer("📊 Статистика актуальна")
+        else:
+            logger.error("Error refreshing stats: %s", e)
 
-    if callback_data.startswith('copy_id_'):
-        broadcast_id = callback_data.replace('copy_id_', '')
-        await query.answer(f"ID скопирован: {broadcast_id}", show_alert=True)
-        return
+@callbacks.prefix('copy_id', admin_only=True)
+async def cb_copy_id(update, context, broadcast_id):
+    await update.callback_query.answer(f"ID скопирован: {broadcast_id}", show_alert=True)
 
-    if callback_data.startswith('ignored_list_'):
-        await query.answer()
-        broadcast_id = callback_data.replace('ignored_list_', '')
-        await show_ignored_list(update, context, broadcast_id)
-        return
+@callbacks.prefix('ignored_list', admin_only=True)
+async def cb_ignored_list(update, context, broadcast_id):
+    await update.callback_query.answer()
+    await show_ignored_list(update, context, broadcast_id)
 
-    if callback_data.startswith('download_ignored_'):
-        broadcast_id = callback_data.replace('download_ignored_', '')
-        await download_ignored_list(update, context, broadcast_id)
-        return
+@callbacks.prefix('download_ignored', admin_only=True)
+async def cb_download_ignored(update, context, broadcast_id):
+    await download_ignored_list(update, context, broadcast_id)
 
-    if callback_data.startswith('back_to_stats_'):
-        await query.answer()
-        broadcast_id = callback_data.replace('back_to_stats_', '')
-        stats_text = get_formatted_stats(broadcast_id)
-        await query.edit_message_text(stats_text, reply_markup=get_stats_keyboard(broadcast_id), parse_mode='HTML')
+@callbacks.prefix('back_to_stats', admin_only=True)
+async def cb_back_to_stats(update, context, broadcast_id):
+    query = update.callback_query
+    await query.answer()
+    stats_text = await run_db(get_formatted_stats, broadcast_id)
+    await query.edit_message_text(stats_text, reply_markup=get_stats_keyboard(broadcast_id), parse_mode='HTML')
+
+@callbacks.prefix('delete_broadcast', admin_only=True)
+async def cb_delete_broadcast(update, context, broadcast_id):
+    await update.callback_query.answer()
+    await delete_broadcast(update, context, broadcast_id)
+
+@callbacks.prefix('confirm_delete', admin_only=True)
+async def cb_confirm_delete(update, context, broadcast_id):
+    await update.callback_query.answer()
+    await confirm_delete_broadcast(update, context, broadcast_id)
+
+# -------------------- ПОДТВЕРЖДЕНИЕ РАССЫЛКИ (старый метод) --------------------
+@callbacks.exact('confirm_broadcast', admin_only=True)
+async def cb_confirm_broadcast(update, context, _):
+    query = update.callback_query
+    user = query.from_user
+    await query.answer()
+    broadcast_text = context.user_data.get('broadcast_text')
+    if not broadcast_text:
+        await query.edit_message_text("❌ Ошибка: текст не найден")
         return
-
-    if callback_data.startswith('delete_broadcast_'):
-        await query.answer()
-        broadcast_id = callback_data.replace('delete_broadcast_', '')
-        await delete_broadcast(update, context, broadcast_id)
+    broadcast_id = uuid.uuid4().hex
+    keyboard = [
+        [InlineKeyboardButton("✅", callback_data=pack_callback('going', broadcast_id)),
+         InlineKeyboardButton("❌", callback_data=pack_callback('not_going', broadcast_id))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    users = get_all_users()
+    if not users:
+        await query.edit_message_text("❌ В базе нет верифицированных пользователей.")
         return
+    status_message = await query.edit_message_text(f"📢 Начинаю рассылку для {len(users)} пользователей...")
+    await run_db(save_broadcast_text, broadcast_id, broadcast_text)
+    context.user_data.pop('broadcast_text', None)
+    safe_text = html.escape(broadcast_text)
+    context.application.create_task(send_broadcast(
+        context, user.id, broadcast_id,
+        f"📢 <b>НОВАЯ РАССЫЛКА КЛАНА</b>\n\n{safe_text}\n\nВыбери свой вариант:",
+        reply_markup, users, status_message, done_markup=get_admin_keyboard()
+    ), update=update)
+
+@callbacks.exact('cancel_broadcast', admin_only=True)
+async def cb_cancel_broadcast(update, context, _):
+    query = update.callback_query
+    await query.answer()
+    context.user_data.pop('broadcast_text', None)
+    await query.edit_message_text(
+        "❌ Рассылка отменена.\n\n👑 Админ-панель:",
+        reply_markup=get_admin_keyboard()
+    )
 
-    if callback_data.startswith('confirm_delete_'):
-        await query.answer()
-        broadcast_id = callback_data.replace('confirm_delete_', '')
-        await confirm_delete_broadcast(update, context, broadcast_id)
+# -------------------- ВЕРИФИКАЦИЯ --------------------
+@callbacks.exact('start_verify')
+async def cb_start_verify(update, context, _):
+    query = update.callback_query
+    user = query.from_user
+    if update.effective_chat.type != "private":
+        await query.answer("Эту команду нужно использовать в личных сообщениях со мной!", show_alert=True)
         return
-
-    if callback_data == 'close_stats':
+    if is_user_verified(user.id):
         await query.answer()
-        await query.delete_message()
+        await query.edit_message_text("✅ Ты уже верифицирован!")
         return
-
-    # -------------------- ПОДТВЕРЖДЕНИЕ РАССЫЛКИ (старый метод) --------------------
-    if callback_data == 'confirm_broadcast':
-        if user.id not in ADMIN_IDS:
-            await query.answer("❌ Нет доступа!", show_alert=True)
+    try:
+        member = await context.bot.get_chat_member(chat_id=CLAN_CHAT_ID, user_id=user.id)
+        if member.status not in (ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER):
+            await query.answer()
+            await query.edit_message_text("❌ Ты не состоишь в чате клана!")
             return
+    except Exception as e:
+        logger.error("Error checking chat membership: %s", e)
         await query.answer()
-        broadcast_text = context.user_data.get('broadcast_text')
-        if not broadcast_text:
-            await query.edit_message_text("❌ Ошибка: текст не найден")
-            return
-        broadcast_id = str(uuid.uuid4())[:8]
-        keyboard = [
-            [InlineKeyboardButton("✅", callback_data=f'going_{broadcast_id}'),
-             InlineKeyboardButton("❌", callback_data=f'not_going_{broadcast_id}')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        users = get_all_users()
-        if not users:
-            await query.edit_message_text("❌ В базе нет верифицированных пользователей.")
-            return
-        await query.edit_message_text(f"📢 Начинаю рассылку для {len(users)} пользователей...")
-        successful = 0
-        failed = 0
-        safe_text = html.escape(broadcast_text)
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=f"📢 <b>НОВАЯ РАССЫЛКА КЛАНА</b>\n\n{safe_text}\n\nВыбери свой вариант:",
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-                successful += 1
-            except Exception as e:
-                logger.error(f"Failed to send to {uid}: {e}")
-                failed += 1
-        save_broadcast_text(broadcast_id, broadcast_text)
-        stats_text = get_formatted_stats(broadcast_id)
-        stats_message = await context.bot.send_message(
-            chat_id=user.id,
-            text=stats_text,
-            reply_markup=get_stats_keyboard(broadcast_id),
-            parse_mode='HTML'
-        )
-        save_stats_message(broadcast_id, user.id, stats_message.message_id)
-        context.user_data.pop('broadcast_text', None)
-        await context.bot.send_message(
-            chat_id=user.id,
-            text=f"✅ Рассылка завершена. Успешно: {successful}, Ошибок: {failed}\n\n👑 Админ-панель:",
-            reply_markup=get_admin_keyboard()
-        )
+        await query.edit_message_text("❌ Ошибка проверки. Попробуй позже.")
         return
+    await query.answer()
+    await query.edit_message_text(
+        "🎮 Отлично! Ты в клане.\n\n"
+        "Напиши свой <b>ник в игре</b> (как тебя зовут в клане):",
+        parse_mode='HTML'
+    )
+    context.user_data['awaiting_nickname'] = True
 
-    if callback_data == 'cancel_broadcast':
-        if user.id not in ADMIN_IDS:
-            await query.answer("❌ Нет доступа!", show_alert=True)
-            return
-        await query.answer()
-        context.user_data.pop('broadcast_text', None)
-        await query.edit_message_text(
-            "❌ Рассылка отменена.\n\n👑 Админ-панель:",
-            reply_markup=get_admin_keyboard()
-        )
-        return
+# -------------------- ГОЛОСОВАНИЕ --------------------
+async def cb_unknown(update, context, data):
+    """Кнопки старых версий бота и неизвестные действия."""
+    query = update.callback_query
+    await query.answer()
+    if '_' not in data:
+        text = "❌ Это сообщение устарело. Пожалуйста, дождись новой рассылки."
+    else:
+        logger.warning("Unknown callback %r from user %s", data, query.from_user.id, extra={'sample': 'unknown_callback'})
+        text = "❌ Неизвестное действие"
+    try:
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([]))
+    except Exception:
+        pass
 
-    # -------------------- ВЕРИФИКАЦИЯ --------------------
-    if callback_data == 'start_verify':
-        if update.effective_chat.type != "private":
-            await query.answer("Эту команду нужно использовать в личных сообщениях со мной!", show_alert=True)
-            return
-        if is_user_verified(user.id):
-            await query.answer()
-            await query.edit_message_text("✅ Ты уже верифицирован!")
-            return
-        try:
-            member = await context.bot.get_chat_member(chat_id=CLAN_CHAT_ID, user_id=user.id)
-            if member.status not in (ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER):
-                await query.answer()
-                await query.edit_message_text("❌ Ты не состоишь в чате клана!")
-                return
-        except Exception as e:
-            logger.error(f"Error checking chat membership: {e}")
-            await query.answer()
-            await query.edit_message_text("❌ Ошибка проверки. Попробуй позже.")
-            return
-        await query.answer()
-        await query.edit_message_text(
-            "🎮 Отлично! Ты в клане.\n\n"
-            "Напиши свой <b>ник в игре</b> (как тебя зовут в клане):",
-            parse_mode='HTML'
-        )
-        context.user_data['awaiting_nickname'] = True
-        return
+callbacks.fallback = cb_unknown
 
-    # -------------------- ГОЛОСОВАНИЕ --------------------
-    if '_' not in callback_data:
-        await query.answer()
-        try:
-            await query.edit_message_text(
-                "❌ Это сообщение устарело. Пожалуйста, дождись новой рассылки.",
-                reply_markup=InlineKeyboardMarkup([])
-            )
-        except Exception:
-            pass
-        return
+@callbacks.prefix('going')
+async def cb_vote_going(update, context, broadcast_id):
+    await handle_vote(update, context, 'going', broadcast_id)
 
-    try:
-        last_underscore = callback_data.rfind('_')
-        if last_underscore == -1:
-            raise ValueError("No underscore found")
-        action = callback_data[:last_underscore]
-        broadcast_id = callback_data[last_underscore + 1:]
-    except Exception as e:
-        logger.error(f"Error parsing callback data {callback_data}: {e}")
-        await query.answer()
-        try:
-            await query.edit_message_text("❌ Ошибка обработки кнопки.", reply_markup=InlineKeyboardMarkup([]))
-        except Exception:
-            pass
-        return
+@callbacks.prefix('not_going')
+async def cb_vote_not_going(update, context, broadcast_id):
+    await handle_vote(update, context, 'not_going', broadcast_id)
 
-    action = action.strip()
-    if action not in ['going', 'not_going']:
-        logger.warning(f"Unknown action: '{action}' from user {user.id}")
-        await query.answer()
-        try:
-            await query.edit_message_text("❌ Неизвестное действие", reply_markup=InlineKeyboardMarkup([]))
-        except Exception:
-            pass
-        return
+async def handle_vote(update: Update, context: ContextTypes.DEFAULT_TYPE, action, broadcast_id):
+    query = update.callback_query
+    user = query.from_user
 
-    broadcast_text = get_broadcast_text(broadcast_id)
-    if broadcast_text is None:
+    vote = await submit_vote(user.id, broadcast_id, action)
+    if vote.status == 'deleted':
         await query.answer(
             text="❌ Эта рассылка была удалена администратором.",
             show_alert=True
@@ -1936,44 +3651,35 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    event_time = get_broadcast_event_time(broadcast_id)
-    if event_time:
-        try:
-            event_dt = datetime.fromisoformat(event_time)
-            if event_dt <= datetime.now():
-                await query.answer(
-                    text="❌ Время события уже истекло! Голосование закрыто.",
-                    show_alert=True
-                )
-                await query.edit_message_text(
-                    text=f"📢 {broadcast_text}\n\n⏰ Время события истекло!\nГолосование закрыто.",
-                    reply_markup=InlineKeyboardMarkup([])
-                )
-                return
-        except (ValueError, TypeError):
-            pass
-
-    previous_vote = get_user_vote(user.id, broadcast_id)
-    cooldown = get_broadcast_cooldown(broadcast_id)
-
-    if previous_vote and previous_vote != action:
-        can_change, remaining = can_change_vote(user.id, broadcast_id, cooldown)
-        if not can_change:
-            if remaining % 10 == 1 and remaining % 100 != 11:
-                minutes_text = "минуту"
-            elif 2 <= remaining % 10 <= 4 and not (12 <= remaining % 100 <= 14):
-                minutes_text = "минуты"
-            else:
-                minutes_text = "минут"
-            await query.answer(
-                text=f"⏳ Подожди ещё {remaining} {minutes_text} перед сменой голоса",
-                show_alert=True
-            )
-            return
+    broadcast_text = vote.context.text
+    event_time = vote.context.event_time
+    previous_vote = vote.context.previous
+    cooldown = vote.context.cooldown
 
-    save_vote(user.id, broadcast_id, action)
+    if vote.status == 'expired':
+        await query.answer(
+            text="❌ Время события уже истекло! Голосование закрыто.",
+            show_alert=True
+        )
+        await query.edit_message_text(
+            text=f"📢 {broadcast_text}\n\n⏰ Время события истекло!\nГолосование закрыто.",
+            reply_markup=InlineKeyboardMarkup([])
+        )
+        return
 
-    new_stats = get_vote_stats(broadcast_id)
+    if vote.status == 'cooldown':
+        remaining = vote.remaining
+        if remaining % 10 == 1 and remaining % 100 != 11:
+            minutes_text = "минуту"
+        elif 2 <= remaining % 10 <= 4 and not (12 <= remaining % 100 <= 14):
+            minutes_text = "минуты"
+        else:
+            minutes_text = "минут"
+        await query.answer(
+            text=f"⏳ Подожди ещё {remaining} {minutes_text} перед сменой голоса",
+            show_alert=True
+        )
+        return
 
     choice_text = "✅" if action == 'going' else "❌"
     if previous_vote:
@@ -1990,9 +3696,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             event_dt = datetime.fromisoformat(event_time)
             if event_dt > datetime.now():
                 if action == 'going':
-                    kb = [[InlineKeyboardButton("❌", callback_data=f'not_going_{broadcast_id}')]]
+                    kb = [[InlineKeyboardButton("❌", callback_data=pack_callback('not_going', broadcast_id))]]
                 else:
-                    kb = [[InlineKeyboardButton("✅", callback_data=f'going_{broadcast_id}')]]
+                    kb = [[InlineKeyboardButton("✅", callback_data=pack_callback('going', broadcast_id))]]
                 reply_markup = InlineKeyboardMarkup(kb)
                 user_text += "\n\n🔄 Нажми на другую кнопку, чтобы изменить решение."
             else:
@@ -2001,9 +3707,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup = InlineKeyboardMarkup([])
     else:
         if action == 'going':
-            kb = [[InlineKeyboardButton("❌", callback_data=f'not_going_{broadcast_id}')]]
+            kb = [[InlineKeyboardButton("❌", callback_data=pack_callback('not_going', broadcast_id))]]
         else:
-            kb = [[InlineKeyboardButton("✅", callback_data=f'going_{broadcast_id}')]]
+            kb = [[InlineKeyboardButton("✅", callback_data=pack_callback('going', broadcast_id))]]
         reply_markup = InlineKeyboardMarkup(kb)
         user_text += "\n\n🔄 Нажми на другую кнопку, чтобы изменить решение."
 
@@ -2014,35 +3720,15 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
     except Exception as e:
         if "Message is not modified" in str(e):
-            logger.info(f"Message not modified for user {user.id}")
+            logger.debug("Message not modified for user %s", user.id)
         else:
-            logger.error(f"Error editing message: {e}")
+            logger.error("Error editing message: %s", e)
 
-    logger.info(f"✅ Статистика изменилась! Новые значения: {new_stats}")
-    for admin in ADMIN_IDS:
-        try:
-            stats_msg_id = get_stats_message(broadcast_id)
-            if stats_msg_id:
-                new_stats_text = get_formatted_stats(broadcast_id)
-                await context.bot.edit_message_text(
-                    chat_id=admin,
-                    message_id=stats_msg_id,
-                    text=new_stats_text,
-                    reply_markup=get_stats_keyboard(broadcast_id),
-                    parse_mode='HTML'
-                )
-                logger.info(f"Stats updated for broadcast {broadcast_id}")
-            else:
-                new_stats_text = get_formatted_stats(broadcast_id)
-                stats_message = await context.bot.send_message(
-                    chat_id=admin,
-                    text=new_stats_text,
-                    parse_mode='HTML'
-                )
-                save_stats_message(broadcast_id, admin, stats_message.message_id)
-        except Exception as e:
-            if "Message is not modified" not in str(e):
-                logger.error(f"Error updating stats: {e}")
+    logger.info("✅ Голос %s за %s: %s", user.id, broadcast_id, action,
+                extra={'sample': 'vote', 'user_id': user.id, 'broadcast_id': broadcast_id, 'action': action})
+    if not vote_buffer.enabled:
+        # В режиме буфера статистику отметит сброс буфера
+        stats_refresher.mark(broadcast_id)
 
 # ========================== ОБРАБОТЧИКИ ТЕКСТОВЫХ СООБЩЕНИЙ ==========================
 async def handle_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2060,11 +3746,11 @@ async def handle_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['awaiting_nickname'] = False
             return True
     except Exception as e:
-        logger.error(f"Error checking chat membership: {e}")
+        logger.error("Error checking chat membership: %s", e)
         await update.message.reply_text("❌ Ошибка проверки. Попробуй позже.")
         context.user_data['awaiting_nickname'] = False
         return True
-    add_user(user.id, user.username, user.first_name, nickname)
+    await run_db(add_user, user.id, user.username, user.first_name, nickname)
     context.user_data['awaiting_nickname'] = False
     safe_nick = html.escape(nickname)
     await update.message.reply_text(
@@ -2086,7 +3772,6 @@ async def handle_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return True
 
 async def handle_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("=== HANDLE BROADCAST TEXT ===")
     user = update.effective_user
 
     # Удаляем неиспользуемую ветку awaiting_broadcast_fast
@@ -2119,9 +3804,9 @@ async def handle_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TY
 
     return False
 
+@timed('message')
 async def handle_all_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("=== HANDLE ALL TEXT ===")
-    logger.info(f"User data keys: {list(context.user_data.keys())}")
+    logger.debug("Text from %s, user_data keys: %s", update.effective_user.id, list(context.user_data))
 
     user = update.effective_user
 
@@ -2199,12 +3884,13 @@ async def handle_all_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             broadcast_text = context.user_data['broadcast_text']
             event_time = context.user_data['event_time']
-            broadcast_id = str(uuid.uuid4())[:8]
+            broadcast_id = uuid.uuid4().hex
 
-            save_broadcast_with_params(broadcast_id, broadcast_text, cooldown, event_time)
+            await run_db(save_broadcast_with_params, broadcast_id, broadcast_text, cooldown, event_time)
+            schedule_event_jobs(context.job_queue, broadcast_id, event_time)
 
-            kb = [[InlineKeyboardButton("✅", callback_data=f'going_{broadcast_id}'),
-                   InlineKeyboardButton("❌", callback_data=f'not_going_{broadcast_id}')]]
+            kb = [[InlineKeyboardButton("✅", callback_data=pack_callback('going', broadcast_id)),
+                   InlineKeyboardButton("❌", callback_data=pack_callback('not_going', broadcast_id))]]
             markup = InlineKeyboardMarkup(kb)
 
             users = get_all_users()
@@ -2212,92 +3898,71 @@ async def handle_all_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ В базе нет верифицированных пользователей.")
                 return
 
-            await update.message.reply_text(f"📢 Начинаю рассылку для {len(users)} пользователей...")
+            status_message = await update.message.reply_text(f"📢 Начинаю рассылку для {len(users)} пользователей...")
 
-            successful = 0
-            failed = 0
             safe_text = html.escape(broadcast_text)
-            for uid in users:
+            event_text = ""
+            if event_time:
                 try:
-                    event_text = ""
-                    if event_time:
-                        try:
-                            dt = datetime.fromisoformat(event_time)
-                            event_text = f"\n🕒 Время события: {dt.strftime('%d.%m.%Y %H:%M')}"
-                        except (ValueError, TypeError):
-                            pass
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text=f"📢 <b>НОВАЯ РАССЫЛКА КЛАНА</b>{event_text}\n\n{safe_text}\n\nВыбери свой вариант:",
-                        reply_markup=markup,
-                        parse_mode='HTML'
-                    )
-                    successful += 1
-                except Exception as e:
-                    logger.error(f"Failed to send to {uid}: {e}")
-                    failed += 1
-
-            stats_text = get_formatted_stats(broadcast_id)
-            stats_msg = await context.bot.send_message(
-                chat_id=user.id,
-                text=stats_text,
-                reply_markup=get_stats_keyboard(broadcast_id),
-                parse_mode='HTML'
-            )
-            save_stats_message(broadcast_id, user.id, stats_msg.message_id)
+                    dt = datetime.fromisoformat(event_time)
+                    event_text = f"\n🕒 Время события: {dt.strftime('%d.%m.%Y %H:%M')}"
+                except (ValueError, TypeError):
+                    pass
 
             context.user_data.pop('broadcast_step', None)
             context.user_data.pop('broadcast_text', None)
             context.user_data.pop('event_time', None)
 
-            await update.message.reply_text(
-                f"✅ Рассылка завершена. Успешно: {successful}, Ошибок: {failed}",
-                reply_markup=get_admin_keyboard()
-            )
+            context.application.create_task(send_broadcast(
+                context, user.id, broadcast_id,
+                f"📢 <b>НОВАЯ РАССЫЛКА КЛАНА</b>{event_text}\n\n{safe_text}\n\nВыбери свой вариант:",
+                markup, users, status_message, done_markup=get_admin_keyboard()
+            ), update=update)
             return
 
     if await handle_attendance_numbers(update, context):
-        logger.info("Handled by attendance_numbers")
+        logger.debug("Handled by attendance_numbers")
         return
     if await handle_nickname(update, context):
-        logger.info("Handled by nickname")
+        logger.debug("Handled by nickname")
         return
     if await handle_broadcast_text(update, context):
-        logger.info("Handled by broadcast_text")
+        logger.debug("Handled by broadcast_text")
         return
 
-    logger.info("No handler processed the message")
+    logger.debug("No handler processed the message")
 
 # ---------- НОВЫЕ ФУНКЦИИ ДЛЯ ПРОФИЛЯ ----------
-async def my_broadcasts_list(update: Update, context: ContextTypes.DEFAULT_TYPE, page=1):
+async def my_broadcasts_list(update: Update, context: ContextTypes.DEFAULT_TYPE, cursor=None):
     query = update.callback_query
     user_id = query.from_user.id
 
-    broadcasts = get_user_broadcasts(user_id)
+    per_page = 5
+    page, anchor, before = parse_page_cursor(cursor, unpack_id)
+    total, broadcasts, has_more = await run_db(get_user_broadcasts_page, user_id, per_page, anchor, before)
+    if not broadcasts and anchor is not None:
+        page, anchor, before = 1, None, False
+        total, broadcasts, has_more = await run_db(get_user_broadcasts_page, user_id, per_page)
     if not broadcasts:
         await query.answer("📭 Ты ещё не участвовал ни в одной рассылке.", show_alert=True)
         return
 
-    per_page = 5
-    total = len(broadcasts)
-    total_pages = (total - 1) // per_page + 1
-    if page < 1 or page > total_pages:
+    has_prev, has_next = page_flags(anchor, before, has_more)
+    if not has_prev:
         page = 1
+    total_pages = max((total - 1) // per_page + 1, page)
 
     text = f"<b>📋 Мои рассылки</b> (стр. {page}/{total_pages})\n\n"
-    start = (page - 1) * per_page
-    for i, bid in enumerate(broadcasts[start:start+per_page], start=start+1):
-        info = get_broadcast_info(bid)
+    start = (page - 1) * per_page + 1
+    for i, (bid, broadcast_text, created_at) in enumerate(broadcasts, start=start):
         safe_bid = html.escape(bid)
-        if info:
-            preview = info['text'][:30] + "..." if info['text'] and len(info['text']) > 30 else (info['text'] or "Нет текста")
-            preview = html.escape(preview)
-            date_str = info['created_at'][:16] if info['created_at'] else "неизвестно"
-            text += f"{i}. <code>{safe_bid}</code>\n   📅 {date_str}\n   📝 {preview}\n\n"
-        else:
-            text += f"{i}. <code>{safe_bid}</code>\n   (информация недоступна)\n\n"
+        preview = broadcast_text[:30] + "..." if broadcast_text and len(broadcast_text) > 30 else (broadcast_text or "Нет текста")
+        preview = html.escape(preview)
+        date_str = created_at[:16] if created_at else "неизвестно"
+        text += f"{i}. <code>{safe_bid}</code>\n   📅 {date_str}\n   📝 {preview}\n\n"
 
-    keyboard = get_my_broadcasts_keyboard(broadcasts, page, total_pages)
+    nav = get_page_nav('my_broadcasts_page', page, pack_id(broadcasts[0][0]), pack_id(broadcasts[-1][0]), has_prev, has_next)
+    keyboard = get_my_broadcasts_keyboard(broadcasts, start, nav)
     await query.edit_message_text(text, reply_markup=keyboard, parse_mode='HTML')
     await query.answer()
 
@@ -2305,12 +3970,12 @@ async def my_broadcast_detail(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     user_id = query.from_user.id
 
-    info = get_broadcast_info(broadcast_id)
+    info = await run_db(get_broadcast_info, broadcast_id)
     if not info:
         await query.answer("❌ Рассылка не найдена.", show_alert=True)
         return
 
-    choice, attended = get_user_choice_and_attendance(user_id, broadcast_id)
+    choice, attended = await run_db(get_user_choice_and_attendance, user_id, broadcast_id)
     choice_text = {
         'going': '✅ Пойду',
         'not_going': '❌ Не пойду',
@@ -2321,8 +3986,7 @@ async def my_broadcast_detail(update: Update, context: ContextTypes.DEFAULT_TYPE
     safe_text = html.escape(info['text'])
     safe_bid = html.escape(broadcast_id)
 
-    stats = get_vote_stats(broadcast_id)
-    total_votes = stats['going'] + stats['not_going']
+    total_votes = info['going'] + info['not_going']
 
     text = f"<b>📢 {safe_text}</b>\n"
     text += f"🆔 <code>{safe_bid}</code>\n"
@@ -2349,7 +4013,7 @@ async def change_nickname_start(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     user_id = query.from_user.id
 
-    can, remaining = can_change_nickname(user_id)
+    can, remaining = await run_db(can_change_nickname, user_id)
     if not can:
         hours = remaining // 3600
         minutes = (remaining % 3600) // 60
@@ -2379,14 +4043,14 @@ async def handle_nickname_change(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ Ник должен быть от 2 до 30 символов. Попробуй ещё раз:")
         return True
 
-    can, _ = can_change_nickname(user.id)
+    can, _ = await run_db(can_change_nickname, user.id)
     if not can:
         await update.message.reply_text("❌ Ты уже менял ник недавно. Подожди 24 часа.")
         context.user_data.pop('awaiting_nickname_change', None)
         return True
 
-    update_user_nickname(user.id, new_nick)
-    set_last_nickname_change(user.id, datetime.now().isoformat())
+    await run_db(update_user_nickname, user.id, new_nick)
+    await run_db(set_last_nickname_change, user.id, datetime.now().isoformat())
     context.user_data.pop('awaiting_nickname_change', None)
 
     safe_new_nick = html.escape(new_nick)
@@ -2395,23 +4059,146 @@ async def handle_nickname_change(update: Update, context: ContextTypes.DEFAULT_T
     return True
 
 # ========================== ЗАПУСК БОТА ==========================
-def main():
-    init_db()
-    recalc_all_stats()
-    application = Application.builder().token(TOKEN).build()
+# Режим вебхука включается переменной WEBHOOK_URL (публичный https-адрес бота);
+# без неё бот работает через long polling. Порт по умолчанию берётся из PORT,
+# который выставляет Railway. Секрет проверяется по заголовку
+# X-Telegram-Bot-Api-Secret-Token; если WEBHOOK_SECRET не задан, он выводится из токена.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT') or os.environ.get('PORT') or '8443')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_SECRET = (
+    os.environ.get('WEBHOOK_SECRET')
+    or hashlib.sha256(f'webhook:{TOKEN}'.encode()).hexdigest()
+)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+def allowed_update_types(application: Application):
+    """Типы апдейтов, которые реально разбирают зарегистрированные обработчики.
+
+    Команды и текстовые обработчики получают только новые сообщения (правки
+    сообщений боту не нужны). Если встретится незнакомый тип обработчика —
+    подписываемся на всё, чтобы ничего не потерять.
+    """
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CallbackQueryHandler):
+                types.add(Update.CALLBACK_QUERY)
+            elif isinstance(handler, ChatMemberHandler):
+                if handler.chat_member_types in (ChatMemberHandler.MY_CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(Update.MY_CHAT_MEMBER)
+                if handler.chat_member_types in (ChatMemberHandler.CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(Update.CHAT_MEMBER)
+            elif isinstance(handler, (CommandHandler, MessageHandler)):
+                types.add(Update.MESSAGE)
+            else:
+                return Update.ALL_TYPES
+    return sorted(types)
+
+def webhook_params(application: Application):
+    """Параметры для run_webhook / updater.start_webhook."""
+    return dict(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f'{WEBHOOK_URL}/{WEBHOOK_PATH}',
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed_update_types(application),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+async def on_startup(application: Application):
+    async def refresh(broadcast_ids):
+        for bid in broadcast_ids:
+            stats_refresher.mark(bid)
+    stats_refresher.bot = application.bot
+    vote_buffer.on_flush = refresh
+    vote_buffer.start()
+    application.bot_data['metrics_server'] = await start_metrics_server()
+
+async def on_stop(application: Application):
+    # Дописываем буферизованные голоса, пока пул потоков БД ещё жив
+    await vote_buffer.stop()
+    server = application.bot_data.pop('metrics_server', None)
+    if server:
+        server.close()
+        await server.wait_closed()
+
+async def on_shutdown(application: Application):
+    db_executor.shutdown(wait=True)
+    db.close()
+
+# Апдейты разных пользователей обрабатываются параллельно (до UPDATE_CONCURRENCY
+# одновременно), апдейты одного пользователя — строго по очереди: на этом держатся
+# пошаговые диалоги админки в user_data и проверка кулдауна при смене голоса.
+# Счётчики голосов согласованы и без этого — каждый голос пишется одной транзакцией,
+# а обновление статистики по рассылке идёт одной задачей StatsRefresher.
+# UPDATE_CONCURRENCY=1 возвращает последовательную обработку.
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', '16'))
+
+class PerUserUpdateProcessor(SimpleUpdateProcessor):
+    """Параллельная обработка апдейтов с очередью на каждого пользователя."""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}  # user_id -> [asyncio.Lock, число ожидающих]
+
+    async def process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        # Очередь пользователя занимаем до семафора, чтобы серия нажатий одного
+        # человека ждала своей очереди, не забирая слоты у остальных
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+
+def build_application(request=None):
+    """Собирает приложение с обработчиками и фоновыми задачами.
+
+    request — свой транспорт Bot API (например, заглушка в bench.py).
+    """
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
 
     job_queue = application.job_queue
     if job_queue:
-        job_queue.run_repeating(check_reminders, interval=60, first=10)
-        job_queue.run_repeating(check_expired_events, interval=60, first=20)
+        job_queue.run_once(schedule_pending_events, when=0)
+        job_queue.run_repeating(check_reminders, interval=EVENT_SWEEP_INTERVAL, first=10)
+        job_queue.run_repeating(check_expired_events, interval=EVENT_SWEEP_INTERVAL, first=20)
+        job_queue.run_once(resume_deliveries, when=5)
+        if stats_need_recalc():
+            job_queue.run_once(recalc_stats_job, when=0)
     else:
         logger.warning("Job queue not available – reminders and expired events disabled")
+        if stats_need_recalc():
+            recalc_all_stats()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin))
     application.add_handler(CommandHandler("verify", verify))
     application.add_handler(CommandHandler("broadcast", broadcast))
     application.add_handler(CommandHandler("me", me_command))
+    application.add_handler(CommandHandler("recalc", recalc_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("sqltrace", sqltrace_command))
 
     application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, track_chat_members))
 
@@ -2421,9 +4208,21 @@ def main():
         filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
         handle_all_text
     ))
+    return application
 
-    print("Бот запущен...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+def main():
+    init_db()
+    roster.load()
+    application = build_application()
+    if WEBHOOK_URL:
+        params = webhook_params(application)
+        logger.info("Бот запущен (вебхук %s, порт %s, апдейты: %s)...",
+                    params['webhook_url'], params['port'], ', '.join(params['allowed_updates']))
+        application.run_webhook(**params)
+    else:
+        allowed = allowed_update_types(application)
+        logger.info("Бот запущен (polling, апдейты: %s)...", ', '.join(allowed))
+        application.run_polling(allowed_updates=allowed)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,29 @@
+"""Общие фикстуры тестов. Запуск: python -m pytest
+
+bot.py читает настройки из окружения при импорте, поэтому временная БД и токен
+задаются до импорта модуля.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix='clanbot-test-')
+os.environ['DB_PATH'] = os.path.join(_workdir, 'test.db')
+os.environ.setdefault('TOKEN', '0:test')
+
+
+@pytest.fixture(scope='session')
+def bot():
+    """Модуль bot с применёнными миграциями на чистой БД."""
+    import bot as module
+    module.init_db()
+    yield module
+    module.db_executor.shutdown(wait=True)
+    module.db.close()
+    shutil.rmtree(_workdir, ignore_errors=True)
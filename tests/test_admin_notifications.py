@@ -0,0 +1,55 @@
+"""Массовые уведомления из админки уходят в фоне и не держат обработчик админа."""
+import asyncio
+import time
+
+from telegram import Update
+
+from bench import FakeBotAPI
+
+CLAN_SIZE = 30
+
+
+def _callback(app, user_id, data):
+    return Update.de_json({
+        'update_id': 1,
+        'callback_query': {
+            'id': '1', 'chat_instance': 'test', 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'A'},
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': 'panel'},
+        },
+    }, app.bot)
+
+
+def test_reset_stats_replies_before_fanout(bot):
+    for user_id in range(9001, 9001 + CLAN_SIZE):
+        bot.add_user(user_id, f'user{user_id}', 'U', f'nick{user_id}')
+    admin_id = bot.ADMIN_IDS[0]
+    api = FakeBotAPI(latency=0.05)
+    app = bot.build_application(request=api)
+    for job in app.job_queue.jobs():
+        job.schedule_removal()
+    clan = len(bot.get_all_users())
+
+    async def scenario():
+        await app.initialize()
+        await app.start()
+        try:
+            start = time.perf_counter()
+            await app.process_update(_callback(app, admin_id, 'confirm_reset_stats'))
+            handler_seconds = time.perf_counter() - start
+            draining_when_replied = bool(bot._draining_jobs)
+            for _ in range(500):
+                if api.calls.get('sendMessage', 0) == clan + 1 and not bot._draining_jobs:
+                    break
+                await asyncio.sleep(0.02)
+            return handler_seconds, draining_when_replied
+        finally:
+            await app.stop()
+            await app.shutdown()
+
+    handler_seconds, draining_when_replied = asyncio.run(scenario())
+    assert draining_when_replied, "обработчик дождался рассылки уведомлений"
+    assert handler_seconds < 1.0
+    assert api.calls['answerCallbackQuery'] == 1
+    # уведомление каждому и итог админу
+    assert api.calls['sendMessage'] == clan + 1
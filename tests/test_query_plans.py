@@ -0,0 +1,65 @@
+"""Планы запросов после миграций: планировщик и статистика идут по индексам, а не SCAN."""
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def traced(bot, monkeypatch):
+    """Включает трассировку SQL и возвращает функцию «вызов -> {sql: план}»."""
+    monkeypatch.setattr(bot.sql_tracer, 'enabled', True)
+    monkeypatch.setattr(bot.sql_tracer, 'slow_ms', float('inf'))
+
+    def run(call, *args):
+        bot.sql_tracer.reset()
+        call(*args)
+        return {sql: explain(bot, sql) for sql, *_ in bot.sql_tracer.top(limit=None)}
+
+    yield run
+    bot.sql_tracer.reset()
+
+
+def explain(bot, sql):
+    with bot.db.read() as conn:
+        rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}', (None,) * sql.count('?')).fetchall()
+    return [detail for *_, detail in rows]
+
+
+def scans(plan, *tables):
+    """Шаги полного перебора указанных таблиц (или их псевдонимов)."""
+    return [step for step in plan if step.startswith('SCAN ') and step.split()[1] in tables]
+
+
+def only(plans, fragment):
+    matching = [plan for sql, plan in plans.items() if fragment in sql]
+    assert len(matching) == 1, f"ожидался один запрос с «{fragment}»: {list(plans)}"
+    return matching[0]
+
+
+def test_due_reminders_use_partial_index(traced, bot):
+    now = datetime.now()
+    plan = only(traced(bot.get_due_reminders, now, now + timedelta(hours=1)), 'FROM broadcast_texts')
+    assert any('idx_broadcast_pending_reminder' in step for step in plan), plan
+
+
+def test_expired_events_use_partial_index(traced, bot):
+    plan = only(traced(bot.get_expired_events, datetime.now()), 'FROM broadcast_texts')
+    assert any('idx_broadcast_pending_expiry' in step for step in plan), plan
+
+
+def test_broadcast_lookups_avoid_scans(traced, bot):
+    broadcast_id = uuid.uuid4().hex
+    bot.save_broadcast_text(broadcast_id, 'план запроса')
+    plans = traced(bot.get_formatted_stats, broadcast_id)
+    plans.update(traced(bot.get_attendance_roster, broadcast_id))
+    plans[bot.BROADCAST_COUNTS_SQL] = explain(bot, bot.BROADCAST_COUNTS_SQL)
+
+    touching = {sql: plan for sql, plan in plans.items() if 'votes' in sql or 'user_activity' in sql}
+    assert touching
+    for sql, plan in touching.items():
+        assert not scans(plan, 'votes', 'v', 'user_activity', 'a', 'ua'), (sql, plan)
+
+    steps = [step for plan in touching.values() for step in plan]
+    assert any('idx_votes_broadcast_choice' in step for step in steps), steps
+    assert any('idx_activity_broadcast_attended' in step for step in steps), steps
@@ -0,0 +1,76 @@
+"""Живая статистика: удаление рассылки во время отложенного обновления."""
+import asyncio
+import itertools
+import uuid
+from types import SimpleNamespace
+
+
+class RecordingBot:
+    """Минимальная замена Bot для StatsRefresher: запоминает вызовы."""
+
+    def __init__(self):
+        self.calls = []
+        self._message_ids = itertools.count(1000)
+
+    async def edit_message_text(self, **kwargs):
+        self.calls.append('editMessageText')
+
+    async def send_message(self, **kwargs):
+        self.calls.append('sendMessage')
+        return SimpleNamespace(message_id=next(self._message_ids))
+
+
+def _broadcast_with_stats(bot):
+    broadcast_id = uuid.uuid4().hex
+    bot.save_broadcast_text(broadcast_id, 'обновление статистики')
+    bot.save_stats_message(broadcast_id, bot.ADMIN_IDS[0], 1)
+    return broadcast_id
+
+
+def _pending_refresh(bot, deleted_before_refresh):
+    """Первая отметка рисует сразу, вторая ждёт интервал; за это время рассылку удаляют."""
+    refresher = bot.StatsRefresher(0.3)
+    refresher.bot = RecordingBot()
+    broadcast_id = _broadcast_with_stats(bot)
+
+    async def scenario():
+        refresher.mark(broadcast_id)
+        await asyncio.sleep(0.05)
+        refresher.mark(broadcast_id)
+        assert broadcast_id in refresher._tasks
+        bot.delete_broadcast_data(broadcast_id)
+        deleted_before_refresh(refresher, broadcast_id)
+        await asyncio.sleep(0.5)
+
+    asyncio.run(scenario())
+    return refresher, broadcast_id
+
+
+def test_forget_cancels_pending_refresh(bot):
+    refresher, broadcast_id = _pending_refresh(bot, lambda refresher, bid: refresher.forget(bid))
+    assert refresher.bot.calls == ['editMessageText']
+    assert not refresher._tasks and not refresher._dirty
+    assert bot.get_stats_message(broadcast_id) is None
+
+
+def test_render_skips_deleted_broadcast(bot):
+    refresher, broadcast_id = _pending_refresh(bot, lambda refresher, bid: None)
+    assert refresher.bot.calls == ['editMessageText']
+    assert bot.get_stats_message(broadcast_id) is None
+
+
+def test_forget_all_cancels_every_refresh(bot):
+    refresher = bot.StatsRefresher(0.3)
+    refresher.bot = RecordingBot()
+    broadcast_ids = [_broadcast_with_stats(bot) for _ in range(3)]
+
+    async def scenario():
+        for broadcast_id in broadcast_ids:
+            refresher._last_edit[broadcast_id] = asyncio.get_running_loop().time()
+            refresher.mark(broadcast_id)
+        refresher.forget()
+        await asyncio.sleep(0.5)
+
+    asyncio.run(scenario())
+    assert refresher.bot.calls == []
+    assert not refresher._tasks and not refresher._dirty
@@ -0,0 +1,31 @@
+"""Буфер голосов: голоса за удалённые рассылки не пишутся и не будят обновление статистики."""
+import asyncio
+import uuid
+from datetime import datetime
+
+
+def test_flush_reports_only_written_broadcasts(bot):
+    kept, deleted = uuid.uuid4().hex, uuid.uuid4().hex
+    for broadcast_id in (kept, deleted):
+        bot.save_broadcast_text(broadcast_id, 'буфер голосов')
+
+    buffer = bot.VoteBuffer(interval_ms=60_000, max_size=1000)
+    flushed = []
+
+    async def on_flush(broadcast_ids):
+        flushed.append(set(broadcast_ids))
+
+    buffer.on_flush = on_flush
+
+    async def scenario():
+        now = datetime.now().isoformat()
+        buffer.add(701, kept, 'going', now)
+        buffer.add(702, deleted, 'not_going', now)
+        bot.delete_broadcast_data(deleted)
+        await buffer.flush()
+
+    asyncio.run(scenario())
+    assert flushed == [{kept}]
+    assert bot.get_broadcast_info(kept)['going'] == 1
+    with bot.db.read() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM votes WHERE broadcast_id = ?', (deleted,)).fetchone()[0] == 0
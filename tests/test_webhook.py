@@ -0,0 +1,85 @@
+"""Режим вебхука: локальный HTTP-клиент против updater.start_webhook."""
+import asyncio
+import socket
+
+import httpx
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from bench import FakeBotAPI
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_update(update_id, user_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': '/start',
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'U'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+async def _wait_for(predicate, timeout=2.0):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+def test_allowed_updates_follow_handlers(bot):
+    app = bot.build_application(request=FakeBotAPI())
+    assert bot.allowed_update_types(app) == [Update.CALLBACK_QUERY, Update.MESSAGE]
+
+    app.add_handler(TypeHandler(Update, lambda update, context: None))
+    assert bot.allowed_update_types(app) == Update.ALL_TYPES
+
+
+def test_webhook_checks_secret_and_dispatches(bot, monkeypatch):
+    port = _free_port()
+    monkeypatch.setattr(bot, 'WEBHOOK_URL', 'https://bot.example')
+    monkeypatch.setattr(bot, 'WEBHOOK_LISTEN', '127.0.0.1')
+    monkeypatch.setattr(bot, 'WEBHOOK_PORT', port)
+
+    api = FakeBotAPI()
+    app = bot.build_application(request=api)
+    for job in app.job_queue.jobs():
+        job.schedule_removal()
+    params = bot.webhook_params(app)
+    assert params['webhook_url'] == f'https://bot.example/{bot.WEBHOOK_PATH}'
+    assert params['allowed_updates'] == [Update.CALLBACK_QUERY, Update.MESSAGE]
+
+    async def scenario():
+        await app.initialize()
+        await app.start()
+        await app.updater.start_webhook(**params)
+        try:
+            url = f'http://127.0.0.1:{port}/{bot.WEBHOOK_PATH}'
+            async with httpx.AsyncClient() as client:
+                missing = await client.post(url, json=_start_update(1, 501))
+                wrong = await client.post(url, json=_start_update(2, 501),
+                                          headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+                await asyncio.sleep(0.1)
+                assert api.calls.get('sendMessage', 0) == 0
+
+                accepted = await client.post(url, json=_start_update(3, 501),
+                                             headers={'X-Telegram-Bot-Api-Secret-Token': bot.WEBHOOK_SECRET})
+                handled = await _wait_for(lambda: api.calls.get('sendMessage', 0) == 1)
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            await app.shutdown()
+        return missing.status_code, wrong.status_code, accepted.status_code, handled
+
+    missing, wrong, accepted, handled = asyncio.run(scenario())
+    assert api.calls.get('setWebhook') == 1
+    assert (missing, wrong, accepted) == (403, 403, 200)
+    assert handled, "обработчик /start не ответил на апдейт из вебхука"